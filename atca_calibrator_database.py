@@ -23,7 +23,15 @@ def readCalibratorList():
     calibrators = b['caldb']
     return calibrators
 
-# Do this by default.
-calibrators = readCalibratorList()
+# The list is only read the first time it is wanted, as it is large
+# and most uses of the pipeline never need it.
+calibrators = None
+
+def getCalibrators():
+    # Return the list of calibrators, reading it if necessary.
+    global calibrators
+    if calibrators is None:
+        calibrators = readCalibratorList()
+    return calibrators
 
 
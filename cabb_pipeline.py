@@ -5,13 +5,27 @@ sys.path.append('/n/ste616/atcacode/cabb_pipeline')
 sys.path.append('/home/jstevens/usr/src/atcacode/cabb_pipeline')
 from cabb_pipeline_main_modules import *
 from cabb_pipeline_rfi_calculator import USER_rfi_calculator
+from cabb_pipeline_rpfits import scanRPFITSFiles, estimateLoadSize
+from cabb_pipeline_resources import makeController
+from cabb_pipeline_costmodel import (openHistory, saveHistory, setStage,
+                                     datasetCosts, longestFirst, predictRun,
+                                     formatDuration)
+from cabb_pipeline_catalogue import (openCatalogue, recordRun, recordProducts,
+                                     mergeCatalogue, CATALOGUE_NAME)
+from cabb_pipeline_staging import startStaging
+from cabb_pipeline_products import makeProductManager
+from cabb_pipeline_rfimask import openLibrary, maskDatasets, recordOccupancy
+from cabb_pipeline_plots import startPlotting
+from cabb_pipeline_logs import LogSink
+from cabb_pipeline_batch import COMPLETED_NAME
 
 version = '0.1'
 
 #print('CABB pipeline v' + version)
 
 # Go through the arguments.
-usage = "usage: %prog [options] rpfits-file [rpfits-file ...]"
+usage = ("usage: %prog [options] rpfits-file [rpfits-file ...]\n" +
+         "       %prog [options] --batch manifest-or-directory")
 parser = OptionParser(usage=usage, version="CABB pipeline " + version)
 parser.add_option('--no-atlod',
                   help='disable loading step, if data has already been loaded',
@@ -20,11 +34,84 @@ parser.add_option('--no-split',
                   help='disable split step, if data has already been split' +
                   ' (cannot be used without --no-atlod)',
                   action='store_true')
+parser.add_option('--parallel-load', action='store_true',
+                  help='load each IF directly with its own atlod, running ' +
+                  'in parallel, instead of loading once and splitting')
+parser.add_option('--load-processes', type='int', default=0,
+                  help='the maximum number of atlod processes to run at ' +
+                  'once with --parallel-load (default: number of CPUs)')
+parser.add_option('--plan', action='store_true',
+                  help='scan the RPFITS headers, describe the observation ' +
+                  'and the expected size of the load, then exit')
+parser.add_option('--watch', metavar='DIR',
+                  help='watch a directory for RPFITS files and reduce each ' +
+                  'new file as it closes')
+parser.add_option('--watch-interval', type='int', default=60,
+                  help='the number of seconds between checks for new files ' +
+                  '(default: 60)')
+parser.add_option('--watch-settle', type='int', default=120,
+                  help='the number of seconds a file must be unchanged ' +
+                  'before it is treated as closed (default: 120)')
+parser.add_option('--watch-once', action='store_true',
+                  help='reduce all the new files in the watched directory ' +
+                  'and then exit')
+parser.add_option('--batch', metavar='PATH',
+                  help='reduce all the observations in a manifest file or ' +
+                  'directory tree of RPFITS files')
+parser.add_option('--batch-dir', default='.', metavar='DIR',
+                  help='make a directory for each observation of a batch ' +
+                  'in DIR (default: this directory)')
+parser.add_option('--batch-jobs', type='int', default=1,
+                  help='the number of observations of a batch to reduce ' +
+                  'at once (default: 1)')
+parser.add_option('--archive-catalogue', metavar='FILE',
+                  help='also add this run to the archive catalogue FILE')
+parser.add_option('--max-tasks', type='int',
+                  help='the number of Miriad tasks that may run at once ' +
+                  'when flagging and gathering statistics (default: 1), ' +
+                  'and the most that may when solving for the gains of ' +
+                  'the calibrators (default: one for each calibrator, up ' +
+                  'to the number of CPUs)')
+parser.add_option('--max-memory', type='float', default=0,
+                  help='the memory (GB) that concurrent Miriad tasks may ' +
+                  'use between them (default: what is available)')
+parser.add_option('--history', metavar='FILE',
+                  help='keep the history of task times in FILE (default: ' +
+                  '~/.cabb_pipeline/history.sqlite)')
+parser.add_option('--scratch', metavar='DIR',
+                  help='work in a new directory under DIR (usually on a ' +
+                  'local disk), copying the products back to this ' +
+                  'directory as they are finished')
+parser.add_option('--scratch-quota', type='float', default=0,
+                  help='the space (GB) the working directory may use; ' +
+                  'intermediate products that can be made again are ' +
+                  'deleted, least recently used first, to stay within it')
 parser.add_option('--no-midweek', action='store_true',
                   help='disable midweek RFI detection step')
 parser.add_option('--no-flag',
                   help='disable automatic flagging step',
                   action='store_true')
+parser.add_option('--no-rfi-mask', action='store_true',
+                  help='do not flag the known RFI before automatic flagging')
+parser.add_option('--rfi-masks', metavar='FILE',
+                  help='keep the library of known RFI in FILE (default: ' +
+                  '~/.cabb_pipeline/rfi_masks.sqlite)')
+parser.add_option('--rfi-mask-version', type='int', metavar='N',
+                  help='use version N of the known RFI masks (default: ' +
+                  'the latest)')
+parser.add_option('--no-solution-cache', action='store_true',
+                  help='always solve for the bandpass, flux and leakage ' +
+                  'calibration, even if it has been done before')
+parser.add_option('--solution-cache', metavar='DIR',
+                  help='keep the calibration solutions in DIR (default: ' +
+                  '~/.cabb_pipeline/solutions)')
+parser.add_option('--no-vis-stats', action='store_true',
+                  help='do not summarise the visibility amplitudes')
+parser.add_option('--no-plots', action='store_true',
+                  help='do not make the diagnostic plots')
+parser.add_option('--plot-processes', type='int', default=0,
+                  help='the maximum number of diagnostic plots to draw at ' +
+                  'once (default: number of CPUs)')
 parser.add_option('--keep-flags',
                   help='use the current flagging table to begin with',
                   action='store_true')
@@ -50,8 +137,34 @@ parser.add_option('-q', '--quiet', action='store_true', dest='quiet',
 ioptions = {}
 ioptions['no_atlod'] = options.no_atlod
 ioptions['no_split'] = options.no_split
+ioptions['parallel_load'] = options.parallel_load
+ioptions['load_processes'] = options.load_processes
+ioptions['plan'] = options.plan
+ioptions['watch'] = options.watch
+ioptions['watch_interval'] = options.watch_interval
+ioptions['watch_settle'] = options.watch_settle
+ioptions['watch_once'] = options.watch_once
+ioptions['batch'] = options.batch
+ioptions['batch_dir'] = options.batch_dir
+ioptions['batch_jobs'] = options.batch_jobs
+ioptions['archive_catalogue'] = options.archive_catalogue
+ioptions['max_tasks'] = (options.max_tasks if options.max_tasks is not None
+                         else 1)
+ioptions['limit_tasks'] = options.max_tasks is not None
+ioptions['max_memory'] = options.max_memory
+ioptions['history'] = options.history
+ioptions['scratch'] = options.scratch
+ioptions['scratch_quota'] = options.scratch_quota
 ioptions['no_midweek'] = options.no_midweek
 ioptions['no_flag'] = options.no_flag
+ioptions['no_rfi_mask'] = options.no_rfi_mask
+ioptions['rfi_masks'] = options.rfi_masks
+ioptions['no_solution_cache'] = options.no_solution_cache
+ioptions['solution_cache'] = options.solution_cache
+ioptions['no_vis_stats'] = options.no_vis_stats
+ioptions['no_plots'] = options.no_plots
+ioptions['plot_processes'] = options.plot_processes
+ioptions['rfi_mask_version'] = options.rfi_mask_version
 ioptions['keep_flags'] = options.keep_flags
 ioptions['use_flags'] = options.use_flags
 ioptions['no_user'] = options.no_user
@@ -67,6 +180,10 @@ if ioptions['no_split'] and not ioptions['no_atlod']:
 if ioptions['verbose'] and ioptions['quiet']:
     # Can't be quiet and verbose: we choose verbose.
     ioptions['quiet'] = False
+if ioptions['scratch'] is not None and ioptions['no_atlod']:
+    # The scratch area starts empty, so the data has to be loaded.
+    ioptions['no_atlod'] = False
+    ioptions['no_split'] = False
 if ((not ioptions['no_atlod'] or not ioptions['no_split']) and ioptions['keep_flags']):
     # Can't keep flags for a newly split or loaded set.
     ioptions['keep_flags'] = False
@@ -75,6 +192,21 @@ if not cmd_exists('uv2ms'):
     # Won't be able to convert to MeasurementSet format.
     ioptions['no_casa'] = True
 
+# What we know about how long each task takes.
+openHistory(ioptions['history'])
+
+if ioptions['watch'] is not None:
+    # Incremental reduction as the files arrive.
+    from cabb_pipeline_watch import watchDirectory
+    watchDirectory(ioptions['watch'], ioptions)
+    sys.exit(0)
+
+if ioptions['batch'] is not None:
+    # Many observations, each in its own directory.
+    from cabb_pipeline_batch import runBatch
+    summary = runBatch(ioptions['batch'], sys.argv[1:], ioptions)
+    sys.exit(0 if summary['failed'] == 0 else 1)
+
 # The positional arguments to the script are the RPFITS files to load.
 rpfitsFiles = args
 
@@ -83,38 +215,139 @@ if len(rpfitsFiles) < 1:
     parser.print_usage()
     sys.exit(0)
 
+if ioptions['plan']:
+    # Describe what we would do, without loading anything.
+    planDict = scanRPFITSFiles(rpfitsFiles, ioptions)
+    if planDict is None:
+        sys.exit(0)
+    loadSize = estimateLoadSize(planDict)
+    for fc in planDict['freqConfigs']:
+        sfc = planDict['freqConfigs'][fc]
+        print('Frequency Configuration ' + fc + ':')
+        for j in range(0, len(sfc['channels'])):
+            print(' IF ' + str(j + 1) + ': ' +
+                  sfc['classification'][j]['bandType'] + ' band' +
+                  ' NCHAN=' + str(sfc['channels'][j]) +
+                  ' CFREQ=' + str(sfc['centreFreq'][j]) + ' [GHz]' +
+                  ' SIZE=%.1f [MB]' % (loadSize[fc][j] / 1e6))
+        cals = determineCalibrators(planDict, fc, ioptions)
+        print(' Bandpass: ' + str(cals['bandpass']))
+        print(' Flux Density: ' + str(cals['flux']))
+        print(' Leakages: ' + str(cals['leakages']))
+        print(' Gain: ' + ", ".join(cals['gain']))
+        for w in cals['warnings']:
+            print(' Warning: ' + w)
+    print('Sources:', ", ".join(sorted(planDict['sources'].keys())))
+    sys.exit(0)
+
+# Work on local scratch space if we've been asked to. From here on the
+# working directory holds the intermediate products, and the run
+# directory gets the logs and the finished products. Without staging
+# they are the same directory.
+sharedDir = os.getcwd()
+if os.path.exists(os.path.join(sharedDir, COMPLETED_NAME)):
+    # This run hasn't completed yet.
+    os.remove(os.path.join(sharedDir, COMPLETED_NAME))
+stager = startStaging(ioptions)
+workDir = sharedDir
+if stager is not None:
+    workDir = stager.workDir
+    rpfitsFiles = stager.stageInputs(rpfitsFiles)
+
+def workPath(name):
+    # Where a product of this run is.
+    return os.path.join(workDir, name)
+
+# Keep track of the products that can be made again.
+products = makeProductManager(ioptions, workDir,
+                              stager.busy if stager is not None else None,
+                              stager.saved if stager is not None else None)
+if ioptions['no_atlod']:
+    # The master dataset may have been deleted to save space.
+    products.ensure(miriadDataName(rpfitsFiles))
+if ioptions['no_split']:
+    # And so may the datasets split from it.
+    for p in products.byRecipe('uvsplit'):
+        products.ensure(p)
+
 # Load the files and start the results dictionary.
-progressDict = cabbLoad(rpfitsFiles, ioptions)
-if ioptions['verbose']:
-    print('Miriad data file:', progressDict['miriadData'])
+progressDict = None
+setStage('load')
+if ioptions['parallel_load']:
+    progressDict = cabbParallelLoad(rpfitsFiles, ioptions, workDir)
+if progressDict is None:
+    progressDict = cabbLoad(rpfitsFiles, ioptions, workDir)
+    if ioptions['verbose']:
+        print('Miriad data file:', progressDict['miriadData'])
+
+    # Split the master file into its component IFs.
+    progressDict['datasets'] = splitIFs(workPath(progressDict['miriadData']),
+                                        progressDict['freqConfigs'], ioptions)
+if stager is not None:
+    # Describe the files we were given, not the staged copies.
+    progressDict['rpfitsFiles'] = [ os.path.join(sharedDir, f)
+                                    for f in args ]
+if 'fromMetadata' not in progressDict:
+    # Save what we've learnt so the next run can start quickly.
+    recordMetadata(progressDict, ioptions)
+else:
+    indexDatasets(progressDict)
+if os.path.isdir(workPath(progressDict['miriadData'])):
+    # Once split, the master dataset is only needed to split it again.
+    products.register(progressDict['miriadData'], 'load',
+                      rpfitsFiles=[ os.path.abspath(f) for f in rpfitsFiles ])
+
+# Keep the run catalogue up to date.
+catalogue = openCatalogue(os.path.join(sharedDir, CATALOGUE_NAME))
+progressDict['catalogueRun'] = recordRun(catalogue, progressDict,
+                                         frequencyBand, sharedDir)
+saveHistory()
 
-# Split the master file into its component IFs.
-progressDict['datasets'] = splitIFs(progressDict['miriadData'],
-                                    progressDict['freqConfigs'], ioptions)
+if not ioptions['quiet']:
+    print('Predicted runtime:',
+          formatDuration(predictRun(progressDict, ioptions)))
+
+def manyFlagStats(uvFiles, stage):
+    # Get the flagging statistics of several datasets, concurrently if
+    # we're allowed to run more than one task at a time, in which case
+    # the biggest are started first.
+    setStage(stage)
+    if ioptions['max_tasks'] > 1 and len(uvFiles) > 1:
+        import cabb_pipeline_async
+        cabb_pipeline_async.setPoolLimit(ioptions['max_tasks'],
+                                         makeController(ioptions))
+        costs = datasetCosts(uvFiles, stage, [ ('uvfstats', 4) ], workDir)
+        stats = cabb_pipeline_async.flagStatsMany(
+            [ workPath(u) for u in longestFirst(uvFiles, costs) ], ioptions)
+        return dict([ (u, stats[workPath(u)]) for u in uvFiles ])
+    return dict([ (u, flagStats(workPath(u), ioptions)) for u in uvFiles ])
 
 # Determine the flagging fraction of these data sets.
-progressDict['loadFlagStats'] = {}
 origLoad = {}
 for n in range(0, len(progressDict['datasets'])):
     p = progressDict['datasets'][n]
     # Load the original flags for this step.
     origLoad[p] = False
-    if checkMiriadFlagTable(p, 'original', ioptions):
+    if checkMiriadFlagTable(workPath(p), 'original', ioptions):
         origLoad[p] = True
-        keepMiriadFlagTable(p, 'pipelineStart', ioptions)
-        restoreMiriadFlagTable(p, 'original', ioptions)
-    progressDict['loadFlagStats'][p] = flagStats(p, ioptions)
+        keepMiriadFlagTable(workPath(p), 'pipelineStart', ioptions)
+        restoreMiriadFlagTable(workPath(p), 'original', ioptions)
+progressDict['loadFlagStats'] = manyFlagStats(progressDict['datasets'],
+                                              'loadstats')
+for n in range(0, len(progressDict['datasets'])):
+    p = progressDict['datasets'][n]
     if origLoad[p]:
-        restoreMiriadFlagTable(p, 'pipelineStart', ioptions)
+        restoreMiriadFlagTable(workPath(p), 'pipelineStart', ioptions)
 
 if ioptions['no_split'] and not ioptions['keep_flags']:
     # Restore the user-specified flag table if it is present.
     for n in range(0, len(progressDict['datasets'])):
-        restoreMiriadFlagTable(progressDict['datasets'][n],
+        restoreMiriadFlagTable(workPath(progressDict['datasets'][n]),
                                ioptions['use_flags'], ioptions)
 
 # Output a summary of the dataset and determine future actions.
-masterLog = open('log.' + progressDict['miriadData'], 'w')
+logSink = LogSink(sharedDir)
+masterLog = logSink.stream(progressDict['miriadData'], fresh=True)
 masterLog.write('CABB pipeline v' + version + '\n')
 masterLog.write('Files loaded:\n')
 for i in range(0, len(progressDict['rpfitsFiles'])):
@@ -149,7 +382,8 @@ for fc in progressDict['freqConfigs']:
 # Open some logs for each dataset.
 progressDict['logs'] = []
 for l in range(0, len(progressDict['datasets'])):
-    progressDict['logs'].append(open('log.' + progressDict['datasets'][l], 'w'))
+    progressDict['logs'].append(
+        logSink.stream(progressDict['datasets'][l], fresh=True))
                 
 """
 The progress dictionary layout:
@@ -182,7 +416,13 @@ progressDict
      -> 'zoomType': if a zoom band, the type of zoom ('single', 'consolidated')
      -> 'zoomConfig': if a zoom band, the zoom config ('1', '4', '16', '64')
  -> 'datasets': an array listing all the datasets from the main file
- -> 'logs': an array, a log for each of the datasets
+ -> 'datasetIF': each key is the name of a dataset, and the value is the
+                 frequency config and the index of its IF in that config
+ -> 'chains': each key is a frequency config
+   -> each key is an IF chain (as a string), and the value is an array of
+      the datasets in that chain
+ -> 'logs': an array, a log stream for each of the datasets, written to
+            like a file (see cabb_pipeline_logs)
  -> 'measurementSets': an array listing all the MS from the main file (same length
                        and direct correspondence to 'datasets')
  -> 'calibrationSources': the calibration to use for each dataset, and the
@@ -193,6 +433,7 @@ progressDict
    -> 'gain': an array of gain calibrator names
    -> 'warnings': an array of text warnings about the potential problems with
                   the calibration
+ -> 'catalogueRun': the identifier of this run in the run catalogue
  -> 'reductionDir': the directory being used for the Miriad reduction, and the
                     dataset name is the key for this dictionary
  -> 'loadFlagStats': the flag statistics immediately after atlod and uvsplit;
@@ -207,26 +448,51 @@ progressDict
                  percentage of visibilities flagged
  -> 'startFlagStats': the flag statistics upon starting this run of the pipeline;
                       the layout is the same as for 'loadFlagStats'
- -> 'autoFlagStats': the flag statistics after automatic flagging; the layout
-                     is the same as for 'loadFlagStats'
+ -> 'autoFlagStats': the flag statistics after automatic flagging, with the
+                     zoom datasets having the flags of their wide band; the
+                     layout is the same as for 'loadFlagStats'
+ -> 'visibilityStats': a summary of the unflagged amplitudes of each dataset
+                       after flagging, and the dataset name is the key for
+                       this dictionary; the spectra are kept in 'file'
+   -> 'records', 'channels', 'baselines': the size of the dataset
+   -> 'pols': each key is the name of a polarisation, each value has the
+              median over the channels of the 'mean', 'std' and 'median'
+ -> 'plots': the diagnostic plots made of each dataset, and the dataset
+             name is the key for this dictionary; each value is a list of
+             the files, in the plots directory
+ -> 'rfiMaskVersion': the version of the known RFI masks that were flagged
+                      before automatic flagging
+ -> 'gainCalibration': the gain calibration of each dataset, and the dataset
+                       name is the key for this dictionary
+   -> 'solutions': the gpcal results for the flux and gain calibrators,
+                   keyed by source name
+   -> 'bootstrap': the flux scaling factor of each gain calibrator
+   -> 'merged': the gain calibrator dataset holding the merged gains of all
+                the gain calibrators, or None if there are none
+ -> 'calibrationQA': the checks of the calibration solutions of each dataset,
+                     and the dataset name is the key for this dictionary
+   -> each key is the name of a calibrator, and each value is the checks of
+      the solutions in its dataset, from cabb_pipeline_caltables.calibrationQA
      
 """
 
 # Keep a copy of this original flagging table.
-progressDict['startFlagStats'] = {}
 for n in range(0, len(progressDict['datasets'])):
     p = progressDict['datasets'][n]
     if ioptions['keep_flags']:
-        keepMiriadFlagTable(p, 'user', ioptions)
-    else:
-        keepMiriadFlagTable(p, 'original', ioptions)
-    # Get the flagging statistics again.
-    if origLoad[p]:
-        progressDict['startFlagStats'][p] = flagStats(p, ioptions)
+        keepMiriadFlagTable(workPath(p), 'user', ioptions)
     else:
+        keepMiriadFlagTable(workPath(p), 'original', ioptions)
+# Get the flagging statistics again.
+progressDict['startFlagStats'] = manyFlagStats(
+    [ p for p in progressDict['datasets'] if origLoad[p] ], 'startstats')
+for n in range(0, len(progressDict['datasets'])):
+    p = progressDict['datasets'][n]
+    if not origLoad[p]:
         progressDict['startFlagStats'][p] = progressDict['loadFlagStats'][p]
 
 # Check for mid-week RFI.
+setStage('midweek')
 progressDict['midweekRFI'] = {}
 progressDict['midweekStats'] = {}
 for n in range(0, len(progressDict['datasets'])):
@@ -241,8 +507,10 @@ for n in range(0, len(progressDict['datasets'])):
     d = chainDatasets(progressDict, t['freqConfig'], t['ifChain'])
     if not ioptions['no_midweek']:
         progressDict['logs'][n].write('Checking this dataset for midweek RFI.\n')
-        progressDict['midweekRFI'][p] = midweekDetector(p, ioptions)
-        if midweekFlagger(p, progressDict['midweekRFI'][p]['flagRegions'], ioptions):
+        progressDict['midweekRFI'][p] = midweekDetector(workPath(p), ioptions)
+        if midweekFlagger(workPath(p),
+                          progressDict['midweekRFI'][p]['flagRegions'],
+                          ioptions):
             didMidweek = True
             progressDict['logs'][n].write('Detected and flagged midweek RFI in the ' +
                                           'time ranges:\n')
@@ -250,57 +518,134 @@ for n in range(0, len(progressDict['datasets'])):
                 progressDict['logs'][n].write(
                     progressDict['midweekRFI'][p]['flagRegions'][i]['start'] + ' - ' +
                     progressDict['midweekRFI'][p]['flagRegions'][i]['stop'] + '\n')
-            keepMiriadFlagTable(p, 'midweek', ioptions)
+            keepMiriadFlagTable(workPath(p), 'midweek', ioptions)
             for i in range(0, len(d)):
                 if d[i] == p:
                     continue
-                midweekFlagger(d[i], progressDict['midweekRFI'][p]['flagRegions'],
+                midweekFlagger(workPath(d[i]),
+                               progressDict['midweekRFI'][p]['flagRegions'],
                                ioptions)
-                keepMiriadFlagTable(d[i], 'midweek', ioptions)
+                keepMiriadFlagTable(workPath(d[i]), 'midweek', ioptions)
         else:
             progressDict['logs'][n].write('No midweek RFI detected.\n')
-    elif checkMiriadFlagTable(p, 'midweek', ioptions):
+    elif checkMiriadFlagTable(workPath(p), 'midweek', ioptions):
         for i in range(0, len(d)):
-            restoreMiriadFlagTable(d[i], 'midweek', ioptions)
+            restoreMiriadFlagTable(workPath(d[i]), 'midweek', ioptions)
         didMidweek = True
     # New flagging statistics.
     for i in range(0, len(d)):
         if didMidweek:
-            progressDict['midweekStats'][d[i]] = flagStats(d[i], ioptions)
+            progressDict['midweekStats'][d[i]] = flagStats(workPath(d[i]),
+                                                           ioptions)
         else:
             progressDict['midweekStats'][d[i]] = progressDict['startFlagStats'][d[i]]
 
-progressDict['autoFlagStats'] = {}
+autoFlagged = []
+zoomFlagged = []
+autoRestored = {}
 for n in range(0, len(progressDict['datasets'])):
     p = progressDict['datasets'][n]
-    autoRestored = False
+    autoRestored[p] = False
     # Check for zoom bands.
     t = getIF(progressDict, p)
-    if (t is None or t['classification']['bandType'] != 'wide'):
-        # Don't flag zoom bands.
+    if t is None:
         continue
-    if not ioptions['no_flag']:
-        autoPgflag(p, ioptions)
-        # Keep a copy of this flagging.
-        keepMiriadFlagTable(p, 'auto', ioptions)
+    if t['classification']['bandType'] != 'wide':
+        # Don't flag zoom bands; they get the flags of the wide band in
+        # their IF chain instead.
+        zoomFlagged.append(p)
     else:
+        autoFlagged.append(p)
+    if ioptions['no_flag']:
         # Check if we should restore a previous automatic flag set.
-        if checkMiriadFlagTable(p, 'auto', ioptions):
-            autoRestored = True
-            keepMiriadFlagTable(p, 'pipelineAutoSwitch', ioptions)
-            restoreMiriadFlagTable(p, 'auto', ioptions)
-
-    # Determine the flagging fraction now.
-    progressDict['autoFlagStats'][p] = flagStats(p, ioptions)
-    if autoRestored:
-        restoreMiriadFlagTable(p, 'pipelineAutoSwitch', ioptions)
+        if checkMiriadFlagTable(workPath(p), 'auto', ioptions):
+            autoRestored[p] = True
+            keepMiriadFlagTable(workPath(p), 'pipelineAutoSwitch', ioptions)
+            restoreMiriadFlagTable(workPath(p), 'auto', ioptions)
+channelMasks = {}
+if not ioptions['no_flag']:
+    setStage('autoflag')
+    maskLibrary = openLibrary(ioptions['rfi_masks'])
+    if not ioptions['no_rfi_mask']:
+        # Flag what we already know is there.
+        channelMasks = maskDatasets(maskLibrary, progressDict, autoFlagged,
+                                    ioptions)
+    if ioptions['max_tasks'] > 1 and len(autoFlagged) > 1:
+        import cabb_pipeline_async
+        cabb_pipeline_async.setPoolLimit(ioptions['max_tasks'],
+                                         makeController(ioptions))
+        costs = datasetCosts(autoFlagged, 'autoflag', [ ('pgflag', 4) ],
+                             workDir)
+        cabb_pipeline_async.runTasks(
+            [ cabb_pipeline_async.autoPgflag(workPath(p), ioptions)
+              for p in longestFirst(autoFlagged, costs) ])
+    else:
+        for p in autoFlagged:
+            autoPgflag(workPath(p), ioptions)
+    for p in autoFlagged:
+        # Keep a copy of this flagging.
+        keepMiriadFlagTable(workPath(p), 'auto', ioptions)
+    for p in zoomFlagged:
+        w = chainWideband(progressDict, p)
+        if w is not None:
+            propagateWideFlags(w, p, progressDict, ioptions)
+        keepMiriadFlagTable(workPath(p), 'auto', ioptions)
+
+# Determine the flagging fraction now.
+progressDict['autoFlagStats'] = manyFlagStats(autoFlagged + zoomFlagged,
+                                              'autostats')
+if not ioptions['no_flag']:
+    # Remember what the flagger found, for the next version of the masks.
+    recordOccupancy(maskLibrary, progressDict, autoFlagged, channelMasks)
+for p in autoFlagged + zoomFlagged:
+    if autoRestored[p]:
+        restoreMiriadFlagTable(workPath(p), 'pipelineAutoSwitch', ioptions)
+
+# Summarise the amplitudes of what is left after flagging.
+progressDict['visibilityStats'] = {}
+if not ioptions['no_vis_stats']:
+    setStage('visstats')
+    for n in range(0, len(progressDict['datasets'])):
+        p = progressDict['datasets'][n]
+        s = visibilityStatistics(workPath(p), ioptions)
+        if s is None:
+            continue
+        progressDict['visibilityStats'][p] = s
+        progressDict['logs'][n].write(
+            'Visibility statistics of ' + str(s['records']) + ' records ' +
+            'written to ' + os.path.basename(s['file']) + '\n')
+        if stager is not None:
+            stager.writeBack(os.path.basename(s['file']))
+
+# Draw the diagnostic plots in the background while the reduction carries on.
+plotter = None
+if not ioptions['no_plots']:
+    plotter = startPlotting(progressDict, ioptions)
+if stager is not None:
+    # The flagging of the datasets is now finished.
+    for p in progressDict['datasets']:
+        stager.writeBack(p)
+if os.path.isdir(workPath(progressDict['miriadData'])):
+    # With their flagging finished, the datasets can be split again if
+    # they have to be deleted to save space. They are kept until they
+    # have been copied into their reduction directories.
+    for p in progressDict['datasets']:
+        products.pin(p)
+        products.register(p, 'uvsplit', needs=[ progressDict['miriadData'] ],
+                          miriadData=progressDict['miriadData'], dataset=p)
 
 # Turn the dataset into a measurement set.
 progressDict['measurementSets'] = []
+setStage('casa')
 if not ioptions['no_casa']:
     for n in range(0, len(progressDict['datasets'])):
-        progressDict['measurementSets'].append(
-            uvToMeasurementSet(progressDict['datasets'][n], ioptions))
+        progressDict['measurementSets'].append(os.path.basename(
+            uvToMeasurementSet(workPath(progressDict['datasets'][n]),
+                               ioptions)))
+        if stager is not None:
+            stager.writeBack(progressDict['measurementSets'][n])
+        products.register(progressDict['measurementSets'][n], 'uv2ms',
+                          final=True, dataset=progressDict['datasets'][n])
 
 # USER routines go here.
 if not ioptions['no_user']:
@@ -340,21 +685,86 @@ for n in range(0, len(progressDict['datasets'])):
                                           ", ".join(fcSources[c]['gain']) + '\n')
             break
 
+def solveGains(calSets, refant, reflagged):
+    # Flag (unless that's been done already) and solve for the gains of
+    # each of the calibrators in calSets. They are independent datasets,
+    # so they are all done at once, up to one for each CPU (or
+    # --max-tasks, if that was given), with the admission controller
+    # keeping them within the node's memory. Returns the gpcal results
+    # for each calibrator.
+    import cabb_pipeline_async
+    limit = min(len(calSets), os.cpu_count() or 1)
+    if ioptions['limit_tasks']:
+        limit = min(limit, ioptions['max_tasks'])
+    cabb_pipeline_async.setPoolLimit(limit, makeController(ioptions))
+    async def solve(c):
+        if c not in reflagged or reflagged[c] == False:
+            reflagged[c] = await cabb_pipeline_async.autoPgflag(calSets[c],
+                                                                ioptions)
+        # The leakages have already been solved for.
+        return await cabb_pipeline_async.calibrateGains(
+            calSets[c], refant, { 'leakages': False }, ioptions)
+    costs = datasetCosts([ calSets[c] for c in calSets ], 'calibrate',
+                         [ ('pgflag', 4), ('gpcal', 1) ])
+    names = sorted(calSets, key=lambda c: costs[calSets[c]], reverse=True)
+    return dict(zip(names, cabb_pipeline_async.runTasks(
+        [ solve(c) for c in names ])))
+
+def bootstrapMany(gainSets, fluxset):
+    # Scale the gains of all the gain calibrators to the flux calibrator
+    # at once, and return the scaling factor for each.
+    import cabb_pipeline_async
+    names = list(gainSets)
+    return dict(zip(names, cabb_pipeline_async.runTasks(
+        [ cabb_pipeline_async.bootstrapGains(gainSets[g], fluxset, ioptions)
+          for g in names ])))
+
+def calibratorSets(sources, reductionDir):
+    # The datasets of the bandpass, flux and leakage calibrators, or None
+    # if any of them can't be found.
+    calSets = {}
+    for r in [ 'bandpass', 'flux', 'leakages' ]:
+        if sources[r] is not None:
+            calSets[sources[r]] = findDataset(sources[r], reductionDir)
+            if calSets[sources[r]] is None:
+                return None
+    return calSets
+
 # Perform calibration.
+setStage('calibrate')
+solutionCache = None
+if not ioptions['no_solution_cache']:
+    from cabb_pipeline_solcache import (openCache, solutionKey,
+                                        restoreSolutions, storeSolutions)
+    solutionCache = openCache(ioptions['solution_cache'])
 progressDict['reductionDir'] = {}
 progressDict['refAnt'] = {}
-for n in range(0, len(progressDict['datasets'])):
+progressDict['calibrationQA'] = {}
+progressDict['gainCalibration'] = {}
+# Calibrate the biggest datasets first, so their products are the first
+# to be written back.
+costs = datasetCosts(progressDict['datasets'], 'calibrate',
+                     [ ('uvsplit', 1), ('mfcal', 2), ('pgflag', 4),
+                       ('gpcal', 1) ], workDir)
+calibrationOrder = [ progressDict['datasets'].index(p) for p in
+                     longestFirst(progressDict['datasets'], costs) ]
+for n in calibrationOrder:
     p = progressDict['datasets'][n]
     ourLog = progressDict['logs'][n]
     reflagged = {}
     # Make a directory for the overall reduction and split this dataset
-    # into it.
-    progressDict['reductionDir'][p] = prepareReductionDir(p, ioptions)
-    reductionDir = progressDict['reductionDir'][p]
-
-    # Change into this directory now.
-    if not chReductionDir(reductionDir, ioptions):
-        sys.exit(0)
+    # into it. Everything after this works on paths within it.
+    redName = 'reduction.' + p
+    products.ensure(p)
+    if ioptions['keep_reduction']:
+        products.ensure(redName)
+    reductionDir = prepareReductionDir(workPath(p), ioptions)
+    progressDict['reductionDir'][p] = os.path.basename(reductionDir)
+    products.pin(redName)
+    products.register(redName, 'reduction', needs=[ p ], dataset=p)
+    products.unpin(p)
+    # Once calibration starts in it, it can't be made again.
+    products.markFinal(redName)
 
     # Determine the reference antenna we will use.
     if not ioptions['no_flag']:
@@ -371,49 +781,69 @@ for n in range(0, len(progressDict['datasets'])):
         print('Unable to bandpass calibrate dataset', p)
         sys.exit(0)
 
-    bpset = findDataset(bpcal)
+    bpset = findDataset(bpcal, reductionDir)
     if bpset is None:
         print('Cannot find bandpass calibrator dataset.')
         sys.exit(0)
 
-    bandpassState = calibrateBandpass(bpset, refant, ioptions)
-    if not bandpassState['converged']:
-        if not ioptions['quiet']:
-            print('Bandpass calibration with ' + bpcal +
-                  ' failed to converge!')
-        ourLog.write('Bandpass calibration did not ' +
-                                      'converge.\n')
-    else:
-        ourLog.write('Bandpass calibration converged ' +
-                     'in ' + str(bandpassState['iterations']) +
-                     ' iterations.\n')
-
-    # Flag the bandpass calibrator again.
-    reflagged[bpcal] = autoPgflag(bpset, ioptions)
-
-    # And redo the bandpass calibration.
-    bandpassState = calibrateBandpass(bpset, refant, ioptions)
-    if not bandpassState['converged']:
+    # Use the solutions from an earlier run on the same calibrators, if
+    # there are any.
+    fluxcal = progressDict['calibrationSources'][p]['flux']
+    leakagecal = progressDict['calibrationSources'][p]['leakages']
+    cacheRoles = { 'bandpass': bpcal, 'flux': fluxcal,
+                   'leakages': leakagecal }
+    cacheSets = None
+    restored = None
+    if solutionCache is not None:
+        cacheSets = calibratorSets(progressDict['calibrationSources'][p],
+                                   reductionDir)
+    if cacheSets is not None:
+        cacheKey = solutionKey(cacheRoles, cacheSets, refant)
+        restored = restoreSolutions(solutionCache, cacheKey, cacheSets)
+    if restored is not None:
+        reflagged = restored['info']['reflagged']
         if not ioptions['quiet']:
-            print('Bandpass calibration with ' + bpcal +
-                  ' failed to converge!')
-        ourLog.write('Bandpass calibration did not ' +
-                                      'converge.\n')
+            print('Restored the calibration solutions from the cache.')
+        ourLog.write('Bandpass, flux and leakage solutions restored from ' +
+                     'the solution cache.\n')
     else:
-        ourLog.write('Bandpass calibration converged ' +
-                     'in ' + str(bandpassState['iterations']) +
-                     ' iterations.\n')
+        bandpassState = calibrateBandpass(bpset, refant, ioptions)
+        if not bandpassState['converged']:
+            if not ioptions['quiet']:
+                print('Bandpass calibration with ' + bpcal +
+                      ' failed to converge!')
+            ourLog.write('Bandpass calibration did not ' +
+                                          'converge.\n')
+        else:
+            ourLog.write('Bandpass calibration converged ' +
+                         'in ' + str(bandpassState['iterations']) +
+                         ' iterations.\n')
+
+        # Flag the bandpass calibrator again.
+        reflagged[bpcal] = autoPgflag(bpset, ioptions)
+
+        # And redo the bandpass calibration.
+        bandpassState = calibrateBandpass(bpset, refant, ioptions)
+        if not bandpassState['converged']:
+            if not ioptions['quiet']:
+                print('Bandpass calibration with ' + bpcal +
+                      ' failed to converge!')
+            ourLog.write('Bandpass calibration did not ' +
+                                          'converge.\n')
+        else:
+            ourLog.write('Bandpass calibration converged ' +
+                         'in ' + str(bandpassState['iterations']) +
+                         ' iterations.\n')
 
     # Fix the bandpass solution if required.
-    fluxcal = progressDict['calibrationSources'][p]['flux']
     if fluxcal is None:
       print('Unable to flux calibrate dataset', p)
     else:
-        fluxset = findDataset(fluxcal)
+        fluxset = findDataset(fluxcal, reductionDir)
         if fluxset is None:
             print('Cannot find flux calibrator dataset.')
             sys.exit(0)
-        if bpcal != fluxcal:
+        if bpcal != fluxcal and restored is None:
             # Copy the bandpass table to the flux calibrator.
             copyCalTables(bpset, fluxset, {}, ioptions)
             # If required, flag the flux calibrator.
@@ -427,44 +857,142 @@ for n in range(0, len(progressDict['datasets'])):
                                             'pass': True }, ioptions)
 
     # Calibrate the leakages.
-    leakagecal = progressDict['calibrationSources'][p]['leakages']
     if leakagecal is None:
         print('Unable to calibrate leakages for dataset', p)
     else:
-        leakageset = findDataset(leakagecal)
+        leakageset = findDataset(leakagecal, reductionDir)
         if leakageset is None:
             print('Cannot find leakage calibrator dataset.')
             sys.exit(0)
-        if leakagecal != bpcal:
-            # Copy the bandpass table to the leakage calibrator.
-            copyCalTables(bpset, leakageset, {}, ioptions)
-        # If required, flag the leakage calibrator.
-        if (leakagecal not in reflagged or
-            reflagged[leakagecal] == False):
-            reflagged[leakagecal] = autoPgflag(leakageset, ioptions)
-        # Do the gain calibration.
-        if leakagecal != '1934-638':
-            leakageState = calibrateGains(leakageset, refant, {}, ioptions)
-        else:
-            leakageState = calibrateGains(leakageset, refant,
-                                          { 'leakages': True }, ioptions)
-        if leakagecal != bpcal:
-            # Transfer the gains back to the bandpass calibrator.
-            copyCalTables(leakageset, bpset, { 'cal': False, 'pass': False },
-                          ioptions)
-
-    # Calibrate the flux density calibrator.
-    
-
-    # Go back to the previous directory.
-    if reductionDir != '.':
-        if not chReductionDir('..', options):
+        if restored is None:
+            if leakagecal != bpcal:
+                # Copy the bandpass table to the leakage calibrator.
+                copyCalTables(bpset, leakageset, {}, ioptions)
+            # If required, flag the leakage calibrator.
+            if (leakagecal not in reflagged or
+                reflagged[leakagecal] == False):
+                reflagged[leakagecal] = autoPgflag(leakageset, ioptions)
+            # Do the gain calibration.
+            if leakagecal != '1934-638':
+                leakageState = calibrateGains(leakageset, refant, {},
+                                              ioptions)
+            else:
+                leakageState = calibrateGains(leakageset, refant,
+                                              { 'leakages': True }, ioptions)
+            if leakagecal != bpcal:
+                # Transfer the gains back to the bandpass calibrator.
+                copyCalTables(leakageset, bpset,
+                              { 'cal': False, 'pass': False }, ioptions)
+
+    # Keep the solutions for next time.
+    if cacheSets is not None and restored is None:
+        storeSolutions(solutionCache, cacheKey, cacheRoles, cacheSets, refant,
+                       { 'reflagged': reflagged, 'bandpass': bandpassState })
+
+    # Calibrate the flux density calibrator and the gain calibrators,
+    # which all get the bandpass and leakages of the bandpass calibrator.
+    # The calibrator list makes every known calibrator a gain calibrator,
+    # but the bandpass and leakage calibrators already have their
+    # solutions, and must not be solved again or bootstrapped.
+    gaincals = []
+    for g in progressDict['calibrationSources'][p]['gain']:
+        if g == fluxcal:
+            continue
+        if g == bpcal or g == leakagecal:
+            ourLog.write(g + ' is the ' +
+                         ('bandpass' if g == bpcal else 'leakage') +
+                         ' calibrator, so is not used as a gain ' +
+                         'calibrator.\n')
+            continue
+        gaincals.append(g)
+    calSets = {}
+    if fluxcal is not None and fluxcal != leakagecal:
+        calSets[fluxcal] = fluxset
+    gainSets = {}
+    for g in gaincals:
+        gainSets[g] = findDataset(g, reductionDir)
+        if gainSets[g] is None:
+            print('Cannot find gain calibrator dataset', g)
             sys.exit(0)
+        calSets[g] = gainSets[g]
+    for c in calSets:
+        if calSets[c] != bpset:
+            copyCalTables(bpset, calSets[c], { 'cal': False }, ioptions)
+    gainState = { 'solutions': {}, 'bootstrap': {}, 'merged': None }
+    if len(calSets) > 0:
+        gainState['solutions'] = solveGains(calSets, refant, reflagged)
+    for c in sorted(gainState['solutions']):
+        s = gainState['solutions'][c]
+        if not s['converged']:
+            if not ioptions['quiet']:
+                print('Gain calibration with ' + c + ' failed to converge!')
+            ourLog.write('Gain calibration with ' + c +
+                         ' did not converge.\n')
+        else:
+            ourLog.write('Gain calibration with ' + c + ' converged ' +
+                         'in ' + str(s['iterations']) + ' iterations.\n')
+
+    # Put the gain calibrators on the flux scale and merge their gains.
+    if fluxcal is not None and len(gainSets) > 0:
+        gainState['bootstrap'] = bootstrapMany(gainSets, fluxset)
+        for g in sorted(gainState['bootstrap']):
+            if gainState['bootstrap'][g] is not None:
+                ourLog.write('Flux scale of ' + g + ' bootstrapped from ' +
+                             fluxcal + ' with factor ' +
+                             str(gainState['bootstrap'][g]) + '.\n')
+    if len(gaincals) > 0:
+        gainState['merged'] = gainSets[gaincals[0]]
+        for g in gaincals[1:]:
+            mergeGains(gainSets[g], gainState['merged'], ioptions)
+        ourLog.write('Gains of ' + ', '.join(gaincals) + ' merged into ' +
+                     gainState['merged'] + '.\n')
+    progressDict['gainCalibration'][p] = gainState
+
+    # Check the solutions of each of the calibrators.
+    qaSets = { bpcal: bpset }
+    if fluxcal is not None:
+        qaSets[fluxcal] = fluxset
+    if leakagecal is not None:
+        qaSets[leakagecal] = leakageset
+    qaSets.update(gainSets)
+    progressDict['calibrationQA'][p] = {}
+    for c in sorted(qaSets):
+        (qa, qaLines) = checkCalibration(qaSets[c], ioptions)
+        if qa is None:
+            continue
+        progressDict['calibrationQA'][p][c] = qa
+        ourLog.write('Calibration checks of ' + c + ':\n')
+        for l in qaLines:
+            ourLog.write(l + '\n')
+
+    products.unpin(redName)
+    products.touch(redName)
+    if stager is not None:
+        stager.writeBack(redName)
 
 # Wrap it all up.
-masterLog.close()
-for n in range(0, len(progressDict['datasets'])):
-    progressDict['logs'][n].close()
+progressDict['plots'] = {}
+if plotter is not None:
+    progressDict['plots'] = plotter.finish()
+recordProducts(catalogue, progressDict['catalogueRun'], progressDict,
+               workDir)
+if ioptions['archive_catalogue'] is not None:
+    archive = openCatalogue(ioptions['archive_catalogue'])
+    mergeCatalogue(archive, catalogue, sharedDir)
+    archive.close()
+catalogue.close()
+saveHistory()
+if stager is not None:
+    # Everything but the loaded data is worth keeping.
+    stager.writeBackRemaining([ progressDict['miriadData'],
+                                re.sub(r'\.uv$', '.plan.uv',
+                                       progressDict['miriadData']) ])
+    if not ioptions['quiet']:
+        print('Waiting for the products to be written back.')
+    stager.finish()
+logSink.close()
+with open(os.path.join(sharedDir, COMPLETED_NAME), 'w') as f:
+    f.write(time.strftime('%Y-%m-%d %H:%M:%S') + '\n')
 if not ioptions['quiet']:
     print('Pipeline operation completed.')
 
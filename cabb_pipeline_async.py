@@ -0,0 +1,210 @@
+import os
+import sys
+import math
+import time
+import asyncio
+from cabb_pipeline_main_modules import datasetDir, uvPresent
+from cabb_pipeline_resources import datasetShape, estimateFootprint
+from cabb_pipeline_costmodel import recordTask
+from cabb_pipeline_parsers import (UvfstatsParser, MfbootParser, MfcalParser,
+                                   GpcalParser, GpbootParser)
+
+"""
+Asyncio versions of the routines in cabb_pipeline_main_modules that run
+Miriad tasks. Each task is started as an asyncio subprocess, and its
+output is parsed line by line as it arrives, so a single event loop can
+keep many small tasks (like the statistics of every zoom dataset) going
+at once while the Python process does other work.
+
+All tasks share one pool, which limits how many Miriad processes run at
+the same time and, if it has an admission controller, only starts a task
+when its predicted memory and scratch use fit on the node. The routines
+take the same arguments and return the same results as their blocking
+counterparts, for example:
+
+  stats = await flagStats(uvFile, options)
+
+and runTasks() will run a list of them from ordinary code.
+"""
+
+class MiriadPool(object):
+    # Limit the number of Miriad tasks that run at once.
+    def __init__(self, limit, controller=None):
+        self.limit = limit
+        self.controller = controller
+        self.semaphore = None
+        self.loop = None
+
+    def slot(self):
+        # The semaphore has to belong to the running event loop.
+        loop = asyncio.get_event_loop()
+        if self.semaphore is None or self.loop is not loop:
+            self.semaphore = asyncio.Semaphore(self.limit)
+            self.loop = loop
+        return self.semaphore
+
+    async def run(self, task, workDir, parser=None, footprint=None,
+                  **params):
+        # Run a Miriad task, passing each line of its output to the
+        # parser as it arrives. Parameters are named as for miriadTask.
+        args = [ task ]
+        for k in params:
+            args.append(k.lower() + '=' + str(params[k]))
+        if footprint is None and 'vis' in params:
+            footprint = estimateFootprint(task, datasetShape(params['vis']))
+        async with self.slot():
+            if self.controller is not None:
+                await self.controller.acquireAsync(footprint)
+            try:
+                startTime = time.time()
+                p = await asyncio.create_subprocess_exec(
+                    *args, cwd=workDir, stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE)
+                # Read the errors at the same time so neither pipe fills.
+                errTask = asyncio.ensure_future(p.stderr.read())
+                while True:
+                    l = await p.stdout.readline()
+                    if not l:
+                        break
+                    if parser is not None:
+                        parser.feed(l.decode('utf-8',
+                                             'replace').rstrip('\n'))
+                err = await errTask
+                await p.wait()
+            finally:
+                if self.controller is not None:
+                    await self.controller.releaseAsync(footprint)
+        if p.returncode != 0:
+            raise RuntimeError(task + ' failed: ' +
+                               err.decode('utf-8', 'replace'))
+        recordTask(task, workDir, params, time.time() - startTime)
+        if parser is not None:
+            return parser.result
+        return None
+
+# The pool used by everything in this module.
+pool = MiriadPool(os.cpu_count() or 1)
+
+def setPoolLimit(limit, controller=None):
+    # Change the number of Miriad tasks that may run at once, and
+    # optionally how much of the node they may use between them.
+    global pool
+    pool = MiriadPool(max(1, limit), controller)
+    return pool
+
+# The routines themselves.
+
+def checkDataset(uvFile, options):
+    # Fail in the same way the blocking routines do.
+    if not uvPresent(uvFile, options):
+        sys.exit(0)
+
+async def flagStats(uvFile, options):
+    # Determine the amount of data flagged in a uv dataset, running
+    # uvfstats for each mode at the same time.
+    if not options['quiet']:
+        print('Checking flagging in dataset', uvFile)
+    checkDataset(uvFile, options)
+    modes = [ 'stokes', 'baseline', 'antenna', 'channel' ]
+    results = await asyncio.gather(*[
+        pool.run('uvfstats', datasetDir(uvFile), UvfstatsParser(),
+                 vis=os.path.abspath(uvFile), mode=mode) for mode in modes ])
+    if not options['quiet']:
+        print('Flagging check complete.')
+    return dict(zip(modes, results))
+
+async def autoPgflag(uvFile, options):
+    # Flag a dataset with pgflag; the stages have to run in turn.
+    if not options['quiet']:
+        print('Automatically flagging dataset', uvFile)
+    checkDataset(uvFile, options)
+    stokes = [ 'i,q,u,v', 'v,q,u,i', 'v,q,u', 'u,v,q' ]
+    flagpar = [ '8,5,5,3,6,3', '10,2,2,3,7,3',
+                '8,2,2,3,6,3', '8,2,2,3,6,3' ]
+    for n in range(0, len(stokes)):
+        if options['verbose']:
+            print(' Stage', (n+1), 'of', uvFile)
+        await pool.run('pgflag', datasetDir(uvFile),
+                       vis=os.path.abspath(uvFile), stokes=stokes[n],
+                       flagpar=flagpar[n], options='nodisp', command='<b')
+    if not options['quiet']:
+        print('Flagging complete.')
+    return True
+
+async def midweekFlagger(uvFile, timeRegions, options):
+    # Flag times when midweek RFI was detected.
+    if len(timeRegions) == 0:
+        return False
+    checkDataset(uvFile, options)
+    for r in timeRegions:
+        await pool.run('uvflag', datasetDir(uvFile),
+                       vis=os.path.abspath(uvFile), flagval='flag',
+                       select='time(' + r['start'] + ',' + r['stop'] + ')')
+    return True
+
+async def uvToMeasurementSet(uvFile, options):
+    # Convert a dataset with uv2ms.
+    import shutil
+    msFile = uvFile + '.ms'
+    if not options['quiet']:
+        print('Converting Miriad dataset', uvFile,
+              'into MeasurementSet', msFile)
+    checkDataset(uvFile, options)
+    if os.path.isdir(msFile):
+        shutil.rmtree(msFile)
+    await pool.run('uv2ms', datasetDir(uvFile), vis=os.path.abspath(uvFile),
+                   ms=os.path.abspath(msFile))
+    return msFile
+
+async def calibrateBandpass(calSet, refAnt, options):
+    # Perform a bandpass calibration with mfcal.
+    checkDataset(calSet, options)
+    return await pool.run('mfcal', datasetDir(calSet), MfcalParser(),
+                          vis=os.path.abspath(calSet), refant=refAnt,
+                          interval=0.1)
+
+async def calibrateGains(calSet, refAnt, calOptions, options):
+    # Perform a gain calibration with gpcal.
+    checkDataset(calSet, options)
+    optList = [ 'xyvary' ]
+    if 'leakages' in calOptions:
+        optList.append('qusolve')
+        if calOptions['leakages'] == False:
+            optList.append('nopol')
+    return await pool.run('gpcal', datasetDir(calSet), GpcalParser(),
+                          vis=os.path.abspath(calSet), refant=refAnt,
+                          interval=0.1, options=','.join(optList))
+
+async def bootstrapGains(gainSet, fluxSet, options):
+    # Scale the gains of a gain calibrator with gpboot.
+    checkDataset(gainSet, options)
+    checkDataset(fluxSet, options)
+    return await pool.run('gpboot', datasetDir(gainSet), GpbootParser(),
+                          vis=os.path.abspath(gainSet),
+                          cal=os.path.abspath(fluxSet))
+
+async def correctBandpass(fluxCal, fluxSet, options):
+    # Correct a bandpass with mfboot until it stops changing.
+    checkDataset(fluxSet, options)
+    specCorr = 1e6
+    corrCount = 0
+    while (math.fabs(specCorr) > 0.005 and corrCount < 5):
+        r = await pool.run('mfboot', datasetDir(fluxSet), MfbootParser(),
+                           vis=os.path.abspath(fluxSet),
+                           select='source(' + fluxCal + ')', device='/null')
+        corrCount += 1
+        if r is not None:
+            specCorr = r
+    return corrCount != 5
+
+def runTasks(coroutines):
+    # Run a list of these routines to completion from blocking code, and
+    # return their results in the same order.
+    async def gatherAll():
+        return await asyncio.gather(*coroutines)
+    return asyncio.run(gatherAll())
+
+def flagStatsMany(uvFiles, options):
+    # Get the flagging statistics of many datasets at once.
+    results = runTasks([ flagStats(u, options) for u in uvFiles ])
+    return dict(zip(uvFiles, results))
@@ -0,0 +1,242 @@
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import time
+from datetime import datetime, timedelta
+from cabb_pipeline_daemon import warmUp, runJob
+
+"""
+Batch mode for the CABB pipeline: reduce many observations with one
+command. The RPFITS files can be given as a directory tree, which is
+searched for them, or as a manifest listing files and directories, one
+or more to a line. Lines starting with # are ignored, and a line like
+  C999_day1: 2015-01-01_0000.C999 2015-01-01_0312.C999
+names an observation and its files explicitly. All other files are
+put into observations automatically: files with the same project code,
+each starting within a few hours of the one before, are one
+observation.
+
+Each observation is reduced in its own directory under the batch
+directory, with the same options the pipeline was given. The pipeline
+modules and the calibrator database are loaded once, and each
+observation runs in a forked copy of this process, with several running
+at once if asked. They all share the task history and add themselves to
+one batch catalogue. A summary of how long each took, and the overall
+throughput, is printed at the end and kept in batch.summary.json.
+"""
+
+# The file the pipeline leaves in its directory when it has completed.
+COMPLETED_NAME = 'pipeline.completed'
+
+# The names the correlator gives to RPFITS files.
+rpfitsName = re.compile(r'^(\d\d\d\d-\d\d-\d\d_\d\d\d\d)\.(.+)$')
+
+# The longest gap (between the starts of consecutive files) within an
+# observation.
+MAX_GAP = timedelta(hours=8)
+
+# The batch options, which aren't passed on to each observation.
+batchOptions = { '--batch': True, '--batch-dir': True, '--batch-jobs': True }
+
+# The pipeline options naming files or directories, which have to be made
+# absolute before each observation is reduced in its own directory.
+pathOptions = [ '--history', '--scratch', '--rfi-masks', '--solution-cache',
+                '--archive-catalogue' ]
+
+def findRPFITS(path):
+    # All the RPFITS files in a directory tree.
+    found = []
+    for (d, dirs, files) in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            if rpfitsName.match(f) is not None:
+                found.append(os.path.abspath(os.path.join(d, f)))
+    return found
+
+def readManifest(manifest):
+    # Return the explicitly named observations, and the other files.
+    named = {}
+    loose = []
+    baseDir = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest) as f:
+        for l in f:
+            l = l.strip()
+            if l == '' or l.startswith('#'):
+                continue
+            name = None
+            a = re.match(r'^([^\s:]+):\s*(.*)$', l)
+            if a is not None and not os.path.exists(a.group(1)):
+                name = a.group(1)
+                l = a.group(2)
+            files = []
+            for p in l.split():
+                p = os.path.join(baseDir, os.path.expanduser(p))
+                if os.path.isdir(p):
+                    files += findRPFITS(p)
+                else:
+                    files.append(os.path.abspath(p))
+            if name is None:
+                loose += files
+            else:
+                named[name] = named.get(name, []) + files
+    return (named, loose)
+
+def groupObservations(files):
+    # Put RPFITS files into observations by their project and times.
+    timed = []
+    for f in files:
+        a = rpfitsName.match(os.path.basename(f))
+        if a is None:
+            print('Skipping', f, 'as it is not named like an RPFITS file.')
+            continue
+        timed.append((a.group(2), datetime.strptime(a.group(1),
+                                                    '%Y-%m-%d_%H%M'), f))
+    timed.sort()
+    observations = {}
+    current = None
+    last = None
+    for (project, t, f) in timed:
+        if (current is None or project != last[0] or
+            t - last[1] > MAX_GAP):
+            current = t.strftime('%Y-%m-%d_%H%M') + '.' + project
+            observations[current] = []
+        observations[current].append(f)
+        last = (project, t)
+    return observations
+
+def findObservations(path):
+    # The observations to reduce, from a manifest or a directory.
+    if os.path.isdir(path):
+        return groupObservations(findRPFITS(path))
+    (named, loose) = readManifest(path)
+    observations = groupObservations(loose)
+    for n in named:
+        observations[n] = sorted(named[n])
+    return observations
+
+def observationArguments(argv, files, catalogue):
+    # The pipeline arguments for one observation: everything we were
+    # given apart from the batch options, with the paths made absolute,
+    # then its files.
+    args = []
+    skip = False
+    path = False
+    for a in argv:
+        if skip:
+            skip = False
+            continue
+        if path:
+            path = False
+            args.append(os.path.abspath(a))
+            continue
+        if a in batchOptions:
+            skip = batchOptions[a]
+            continue
+        if a.split('=', 1)[0] in batchOptions:
+            continue
+        if a in pathOptions:
+            path = True
+        elif a.split('=', 1)[0] in pathOptions:
+            (o, v) = a.split('=', 1)
+            a = o + '=' + os.path.abspath(v)
+        args.append(a)
+    return args + [ '--archive-catalogue', catalogue ] + files
+
+def runBatch(path, argv, options):
+    # Reduce every observation found in a manifest or directory.
+    observations = findObservations(path)
+    if len(observations) == 0:
+        print('No RPFITS files found in', path)
+        sys.exit(0)
+    batchDir = os.path.abspath(options['batch_dir'])
+    if not os.path.isdir(batchDir):
+        os.makedirs(batchDir)
+    catalogue = os.path.join(batchDir, 'cabb_catalogue.sqlite')
+    if not options['quiet']:
+        print('Found', len(observations), 'observations.')
+    warmUp(options)
+
+    # Make the jobs.
+    waiting = []
+    for n in sorted(observations):
+        workDir = os.path.join(batchDir, n)
+        if not os.path.isdir(workDir):
+            os.makedirs(workDir)
+        waiting.append({ 'job': n, 'cwd': workDir,
+                         'argv': observationArguments(argv, observations[n],
+                                                      catalogue),
+                         'log': os.path.join(workDir, 'log.pipeline'),
+                         'bytes': sum([ os.path.getsize(f)
+                                        for f in observations[n] ]),
+                         'files': len(observations[n]) })
+
+    # Run them, a few at a time.
+    maxJobs = max(1, options['batch_jobs'])
+    running = {}
+    finished = []
+    startTime = time.time()
+    while len(waiting) > 0 or len(running) > 0:
+        while len(waiting) > 0 and len(running) < maxJobs:
+            job = waiting.pop(0)
+            if not options['quiet']:
+                print('Starting', job['job'])
+            job['started'] = time.time()
+            pid = os.fork()
+            if pid == 0:
+                runJob(job)
+            running[pid] = job
+        (pid, status) = os.wait()
+        if pid not in running:
+            continue
+        job = running.pop(pid)
+        job['finished'] = time.time()
+        if os.WIFSIGNALED(status):
+            job['exitCode'] = -os.WTERMSIG(status)
+        else:
+            job['exitCode'] = os.WEXITSTATUS(status)
+        # The pipeline stops early, but without an error, when it can't
+        # go on; it leaves a file behind only when it has completed.
+        job['completed'] = (job['exitCode'] == 0 and
+                            os.path.isfile(os.path.join(job['cwd'],
+                                                        COMPLETED_NAME)))
+        if not options['quiet']:
+            print('Finished', job['job'],
+                  'successfully' if job['completed'] else
+                  '(see ' + job['log'] + ')')
+        finished.append(job)
+    totalTime = time.time() - startTime
+    return batchSummary(finished, totalTime, batchDir, options)
+
+def batchSummary(finished, totalTime, batchDir, options):
+    # Print and keep a summary of the batch.
+    summary = { 'observations': [], 'totalTime': totalTime,
+                'completed': 0, 'failed': 0, 'bytes': 0 }
+    for job in sorted(finished, key=lambda j: j['job']):
+        elapsed = job['finished'] - job['started']
+        summary['observations'].append({
+            'name': job['job'], 'directory': job['cwd'],
+            'files': job['files'], 'bytes': job['bytes'],
+            'seconds': elapsed, 'exitCode': job['exitCode'],
+            'completed': job['completed'] })
+        summary['bytes'] += job['bytes']
+        if job['completed']:
+            summary['completed'] += 1
+        else:
+            summary['failed'] += 1
+    with open(os.path.join(batchDir, 'batch.summary.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+    if not options['quiet']:
+        print('Batch summary:')
+        for o in summary['observations']:
+            print(' %-30s %3d files %8.1f MB %8.1f s %s' %
+                  (o['name'], o['files'], o['bytes'] / 1e6, o['seconds'],
+                   'ok' if o['completed'] else 'FAILED'))
+        print(' %d observations completed, %d failed, in %.1f s' %
+              (summary['completed'], summary['failed'], totalTime))
+        if totalTime > 0:
+            print(' Throughput: %.2f MB/s, %.2f observations/hour' %
+                  (summary['bytes'] / 1e6 / totalTime,
+                   len(finished) * 3600.0 / totalTime))
+    return summary
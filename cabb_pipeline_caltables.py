@@ -0,0 +1,482 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import struct
+import warnings
+import numpy as np
+from optparse import OptionParser
+from cabb_pipeline_miriadio import (readHeader, readItem, copyItems,
+                                    deleteItems, headerEntries,
+                                    stageHeader, H_INT, H_DBLE)
+
+"""
+Read the calibration tables Miriad keeps in a dataset, and check the
+solutions in them, without running any Miriad task.
+
+The gains item holds each solution interval in turn: its time (a
+double) and then the complex gains of each antenna, with nfeeds gains
+and ntau delays to each antenna. The bandpass item holds the complex
+gain of each channel for each feed of each antenna, and the freqs item
+says which channels are in which spectral window. The leakage item
+holds the two leakage terms of each antenna. All of them start 8 bytes
+into the item, and how many of everything there are is kept in the
+header (ngains, nsols, nfeeds, ntau, nchan0, nspect0, nbpsols and
+interval).
+
+The checks are of how much the amplitudes and phases of the solutions
+scatter, how many solutions have dropped out (Miriad leaves a zero gain
+where it couldn't find a solution), and which antennas stand out from
+the rest. Run this file directly to check the solutions in datasets.
+
+The tables can also be copied between datasets and deleted from them
+here, as gpcopy and delhd would, but all at once for each dataset and
+without starting a Miriad task for each table. Run this file with
+--check-miriad to compare what it does against gpcopy and delhd, or
+with --check to try it on small made-up datasets where Miriad isn't
+installed.
+"""
+
+# Where the solutions start in each item.
+TABLE_OFFSET = 8
+
+# How far (in robust standard deviations) an antenna has to be from the
+# rest to stand out, and the most of its solutions that may drop out.
+OUTLIER_SIGMA = 5.0
+DROPOUT_LIMIT = 0.5
+# The largest leakage we'd expect at the ATCA.
+LEAKAGE_LIMIT = 0.15
+
+def calibrationHeader(uvFile):
+    # The header items that describe the calibration tables.
+    h = readHeader(uvFile)
+    nfeeds = h.get('nfeeds', 1)
+    ntau = h.get('ntau', 0)
+    ngains = h.get('ngains', 0)
+    return { 'nfeeds': nfeeds, 'ntau': ntau, 'ngains': ngains,
+             'nants': ngains // (nfeeds + ntau) if ngains > 0 else 0,
+             'nsols': h.get('nsols', 0), 'interval': h.get('interval', None),
+             'nchan0': h.get('nchan0', 0), 'nspect0': h.get('nspect0', 0),
+             'nbpsols': h.get('nbpsols', 1) }
+
+def readGains(uvFile, header=None):
+    # The gain solutions: their times, and the gains as an array of
+    # (solution, antenna, feed).
+    if header is None:
+        header = calibrationHeader(uvFile)
+    data = readItem(uvFile, 'gains')
+    if data is None or header['ngains'] == 0:
+        return None
+    sol = np.dtype([ ('time', '>f8'), ('gains', '>c8', (header['ngains'],)) ])
+    nsols = min(header['nsols'], (len(data) - TABLE_OFFSET) // sol.itemsize)
+    sols = np.frombuffer(data, dtype=sol, count=nsols, offset=TABLE_OFFSET)
+    g = sols['gains'].reshape(nsols, header['nants'],
+                              header['nfeeds'] + header['ntau'])
+    return { 'time': sols['time'].astype(float),
+             'gains': g[:, :, :header['nfeeds']].astype(complex),
+             'interval': header['interval'] }
+
+def readFreqs(uvFile, nspect):
+    # The number of channels, first frequency and channel width (GHz)
+    # of each spectral window of the bandpass.
+    data = readItem(uvFile, 'freqs')
+    if data is None:
+        return None
+    window = np.dtype([ ('nschan', '>i4'), ('pad', '>i4'), ('sfreq', '>f8'),
+                        ('sdf', '>f8') ])
+    w = np.frombuffer(data, dtype=window, count=nspect, offset=TABLE_OFFSET)
+    return { 'nschan': w['nschan'].astype(int),
+             'sfreq': w['sfreq'].astype(float), 'sdf': w['sdf'].astype(float) }
+
+def readBandpass(uvFile, header=None):
+    # The bandpass solutions as an array of (solution, antenna, feed,
+    # channel), and the frequency of each channel.
+    if header is None:
+        header = calibrationHeader(uvFile)
+    data = readItem(uvFile, 'bandpass')
+    if data is None or header['nants'] == 0 or header['nchan0'] == 0:
+        return None
+    n = header['nants'] * header['nfeeds'] * header['nchan0']
+    nbpsols = max(1, min(header['nbpsols'],
+                         (len(data) - TABLE_OFFSET) // (8 * n)))
+    p = np.frombuffer(data, dtype='>c8', count=nbpsols * n,
+                      offset=TABLE_OFFSET)
+    freqs = readFreqs(uvFile, header['nspect0'])
+    chanFreqs = None
+    if freqs is not None:
+        chanFreqs = np.concatenate([
+            freqs['sfreq'][i] + freqs['sdf'][i] * np.arange(freqs['nschan'][i])
+            for i in range(0, len(freqs['nschan'])) ])
+    return { 'bandpass': p.reshape(nbpsols, header['nants'], header['nfeeds'],
+                                   header['nchan0']).astype(complex),
+             'chanFreqs': chanFreqs }
+
+def readLeakage(uvFile, header=None):
+    # The leakage terms as an array of (antenna, feed).
+    if header is None:
+        header = calibrationHeader(uvFile)
+    data = readItem(uvFile, 'leakage')
+    if data is None:
+        return None
+    d = np.frombuffer(data, dtype='>c8',
+                      count=(len(data) - TABLE_OFFSET) // 8,
+                      offset=TABLE_OFFSET)
+    return d.reshape(-1, 2).astype(complex)
+
+# The items of each kind of calibration table, the first of which has to
+# be there for it to be copied, and the header variables that go with
+# them, as gpcopy copies them.
+tableItems = {
+    'cal': ([ 'gains', 'gainsf' ],
+            [ 'interval', 'ngains', 'nsols', 'nfeeds', 'ntau', 'freq0',
+              'senmodel', 'nfbin' ]),
+    'pol': ([ 'leakage', 'leakagef' ], [ 'nfbin' ]),
+    'pass': ([ 'bandpass', 'freqs' ],
+             [ 'ngains', 'nfeeds', 'ntau', 'nchan0', 'nspect0', 'nbpsols' ]) }
+
+# The tables removed when a dataset is cleared of calibration.
+calTables = [ 'bandpass', 'gains', 'leakage', 'gainsf', 'leakagef' ]
+
+def copyCalibration(origSet, destSet, kinds=('pol', 'cal', 'pass')):
+    # Copy some kinds of calibration table from one dataset to another,
+    # and return the items that were copied.
+    items = []
+    variables = []
+    for k in kinds:
+        if not os.path.isfile(os.path.join(origSet, tableItems[k][0][0])):
+            continue
+        items.extend([ i for i in tableItems[k][0]
+                       if os.path.isfile(os.path.join(origSet, i)) and
+                       i not in items ])
+        variables.extend([ v for v in tableItems[k][1]
+                           if v not in variables ])
+    if len(items) > 0:
+        copyItems(origSet, destSet, items, variables)
+    return items
+
+def deleteCalibration(uvFile, tables=calTables):
+    # Delete the calibration tables of a dataset, and return the ones
+    # that were there to delete.
+    return deleteItems(uvFile, tables)
+
+def robustOutliers(values):
+    # Which of the values stand out from the rest, by how many robust
+    # standard deviations they are from the median.
+    v = np.asarray(values, dtype=float)
+    med = np.nanmedian(v)
+    spread = 1.4826 * np.nanmedian(np.abs(v - med))
+    if not np.isfinite(spread) or spread == 0:
+        return np.zeros(v.shape, dtype=bool)
+    return np.abs(v - med) / spread > OUTLIER_SIGMA
+
+def solutionQA(sols, axis):
+    # The amplitude and phase scatter and the dropouts of some complex
+    # solutions along one axis, for each of the others.
+    amp = np.abs(sols)
+    good = amp > 0
+    amp = np.where(good, amp, np.nan)
+    median = np.nanmedian(amp, axis=axis)
+    # The phase change from one solution to the next.
+    s = np.moveaxis(sols, axis, 0)
+    g = np.moveaxis(good, axis, 0)
+    step = np.angle(s[1:] * np.conj(s[:-1]))
+    step = np.where(g[1:] & g[:-1], step, np.nan)
+    return { 'amplitude': median,
+             'ampScatter': np.nanstd(amp, axis=axis) / median,
+             'phaseScatter': np.degrees(np.sqrt(np.nanmean(step ** 2,
+                                                           axis=0))),
+             'dropouts': 1.0 - good.mean(axis=axis) }
+
+def antennaReport(qa):
+    # Turn the arrays of (antenna, feed) into lists for each antenna,
+    # and find the antennas that stand out.
+    nants = qa['dropouts'].shape[0]
+    outlier = qa['dropouts'] > DROPOUT_LIMIT
+    for k in [ 'amplitude', 'ampScatter', 'phaseScatter' ]:
+        outlier |= robustOutliers(qa[k])
+    report = { 'antennas': {}, 'outliers': [] }
+    for a in range(0, nants):
+        report['antennas'][str(a + 1)] = dict(
+            [ (k, [ None if not np.isfinite(x) else float(x)
+                    for x in qa[k][a] ]) for k in qa ])
+        if outlier[a].any():
+            report['outliers'].append(str(a + 1))
+    return report
+
+def calibrationQA(uvFile):
+    # Check all the calibration solutions in a dataset.
+    header = calibrationHeader(uvFile)
+    qa = { 'dataset': uvFile, 'interval': header['interval'] }
+    with warnings.catch_warnings():
+        # Antennas with no solutions at all give empty averages.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        gains = readGains(uvFile, header)
+        if gains is not None and len(gains['time']) > 0:
+            qa['gains'] = antennaReport(solutionQA(gains['gains'], 0))
+            qa['gains']['nsols'] = len(gains['time'])
+        bandpass = readBandpass(uvFile, header)
+        if bandpass is not None:
+            # Use the channels of the latest solution.
+            qa['bandpass'] = antennaReport(
+                solutionQA(bandpass['bandpass'][-1], 2))
+            qa['bandpass']['nchan'] = header['nchan0']
+            qa['bandpass']['nbpsols'] = bandpass['bandpass'].shape[0]
+        leakage = readLeakage(uvFile, header)
+        if leakage is not None:
+            size = np.abs(leakage)
+            outlier = (size > LEAKAGE_LIMIT) | robustOutliers(size)
+            qa['leakage'] = { 'antennas': dict(
+                [ (str(a + 1), [ float(x) for x in size[a] ])
+                  for a in range(0, len(size)) ]),
+                              'outliers': [ str(a + 1)
+                                            for a in range(0, len(size))
+                                            if outlier[a].any() ] }
+    return qa
+
+def medianOver(report, key):
+    # The median of some check over all the antennas.
+    v = [ x for a in report['antennas'] for x in report['antennas'][a][key]
+          if x is not None ]
+    if len(v) == 0:
+        return float('nan')
+    return float(np.median(v))
+
+def summariseQA(qa):
+    # Some lines describing the checks, for the logs.
+    lines = []
+    if 'gains' in qa:
+        lines.append('Gains: %d solutions; median amplitude scatter %.3f, '
+                     'median phase scatter %.1f deg.' %
+                     (qa['gains']['nsols'],
+                      medianOver(qa['gains'], 'ampScatter'),
+                      medianOver(qa['gains'], 'phaseScatter')))
+    for k in [ 'gains', 'bandpass', 'leakage' ]:
+        if k not in qa:
+            continue
+        for a in qa[k]['outliers']:
+            r = qa[k]['antennas'][a]
+            if k == 'leakage':
+                desc = 'leakages ' + ', '.join([ '%.3f' % x for x in r ])
+            else:
+                desc = ('dropouts ' +
+                        ', '.join([ '%.0f%%' % (x * 100.0) for x in
+                                    r['dropouts'] if x is not None ]) +
+                        '; amplitude scatter ' +
+                        ', '.join([ '%.3f' % x for x in r['ampScatter']
+                                    if x is not None ]) +
+                        '; phase scatter ' +
+                        ', '.join([ '%.1f deg' % x for x in r['phaseScatter']
+                                    if x is not None ]))
+            lines.append('The ' + k.rstrip('s') + ' solutions of CA0' + a +
+                         ' stand out: ' + desc)
+    if len(lines) == 0:
+        lines.append('No calibration solutions found.')
+    return lines
+
+def datasetState(uvFile):
+    # The items and header variables of a dataset, for comparing. The
+    # Miriad tasks add to the history, and we don't.
+    items = {}
+    for name in os.listdir(uvFile):
+        if name not in [ 'header', 'history' ] and not name.startswith('.'):
+            items[name] = readItem(uvFile, name)
+    return (items, dict([ (k, repr(v)) for (k, v) in
+                          readHeader(uvFile).items() ]))
+
+def compareStates(what, miriad, native):
+    # Describe how what Miriad did differs from what we did.
+    differences = []
+    for (n, m, o) in [ ('item', miriad[0], native[0]),
+                       ('header variable', miriad[1], native[1]) ]:
+        for k in sorted(set(m) | set(o)):
+            if m.get(k, None) != o.get(k, None):
+                differences.append(what + ': ' + n + ' ' + k + ' differs')
+    return differences
+
+def checkMiriad(origSet, destSet):
+    # Copy and delete the tables with Miriad and with us, on copies of
+    # the datasets, and return how the results differ.
+    import shutil
+    import tempfile
+    import itertools
+    from cabb_pipeline_main_modules import miriadTask
+    differences = []
+    workDir = tempfile.mkdtemp(prefix='caltables.')
+    try:
+        for use in itertools.product([ True, False ], repeat=3):
+            copyOptions = dict(zip([ 'pol', 'cal', 'pass' ], use))
+            what = 'copy ' + ','.join([ k for k in copyOptions
+                                        if copyOptions[k] ])
+            sets = [ os.path.join(workDir, s) for s in [ 'miriad', 'native' ] ]
+            for s in sets:
+                if os.path.isdir(s):
+                    shutil.rmtree(s)
+                shutil.copytree(destSet, s)
+            noList = [ 'no' + k for k in copyOptions if not copyOptions[k] ]
+            if len(noList) < 3:
+                params = { 'vis': os.path.abspath(origSet), 'out': sets[0] }
+                if len(noList) > 0:
+                    params['options'] = ','.join(noList)
+                miriadTask('gpcopy', workDir, **params)
+            copyCalibration(origSet, sets[1],
+                            [ k for k in copyOptions if copyOptions[k] ])
+            differences.extend(compareStates(what, datasetState(sets[0]),
+                                             datasetState(sets[1])))
+            if use == (True, True, True):
+                for t in calTables:
+                    if os.path.isfile(os.path.join(sets[0], t)):
+                        miriadTask('delhd', workDir,
+                                   In=os.path.join(sets[0], t))
+                deleteCalibration(sets[1])
+                differences.extend(compareStates('delete',
+                                                 datasetState(sets[0]),
+                                                 datasetState(sets[1])))
+    finally:
+        shutil.rmtree(workDir)
+    return differences
+
+def headerValue(value):
+    # The bytes of a small item holding an integer or a double.
+    if isinstance(value, int):
+        return struct.pack('>3xBi', H_INT, value)
+    return struct.pack('>3xB4xd', H_DBLE, value)
+
+def makeDataset(uvFile, variables, items):
+    # A made-up dataset with some header variables and items.
+    os.makedirs(uvFile)
+    for (name, data) in items.items():
+        with open(os.path.join(uvFile, name), 'wb') as f:
+            f.write(data)
+    os.rename(stageHeader(uvFile, [ (n, headerValue(v))
+                                    for (n, v) in variables ]),
+              os.path.join(uvFile, 'header'))
+
+def checkCopies():
+    # Copy and delete the tables of made-up datasets, for each choice of
+    # tables, and return how the results differ from what gpcopy and
+    # delhd would leave.
+    import shutil
+    import tempfile
+    import itertools
+    differences = []
+    workDir = tempfile.mkdtemp(prefix='caltables.')
+    origVariables = [ ('interval', 0.1), ('ngains', 12), ('nsols', 4),
+                      ('nfeeds', 2), ('ntau', 0), ('freq0', 2.1),
+                      ('senmodel', 1), ('nfbin', 0), ('nchan0', 64),
+                      ('nspect0', 1), ('nbpsols', 1) ]
+    # The dataset copied to has old solutions, a table that is
+    # replaced, and variables of its own that are kept.
+    destVariables = [ ('vislen', 4096), ('nsols', 9), ('ngains', 6),
+                      ('nfeeds', 1) ]
+    origItems = dict([ (i, (i + ' new ').encode('ascii') * 7)
+                       for k in tableItems for i in tableItems[k][0] ])
+    destItems = { 'visdata': b'records' * 11, 'gains': b'old gains' * 5 }
+    try:
+        origSet = os.path.join(workDir, 'orig.uv')
+        makeDataset(origSet, origVariables, origItems)
+        for use in itertools.product([ True, False ], repeat=3):
+            kinds = [ k for (k, u) in zip([ 'pol', 'cal', 'pass' ], use)
+                      if u ]
+            what = 'copy ' + ','.join(kinds)
+            destSet = os.path.join(workDir, 'dest.uv')
+            if os.path.isdir(destSet):
+                shutil.rmtree(destSet)
+            makeDataset(destSet, destVariables, destItems)
+            copied = copyCalibration(origSet, destSet, kinds)
+            # What should be there afterwards.
+            wanted = []
+            items = dict(destItems)
+            header = [ (n, headerValue(v)) for (n, v) in destVariables ]
+            for k in kinds:
+                wanted.extend([ i for i in tableItems[k][0]
+                                if i not in wanted ])
+                items.update([ (i, origItems[i]) for i in tableItems[k][0] ])
+                for v in tableItems[k][1]:
+                    new = headerValue(dict(origVariables)[v])
+                    if v in [ h[0] for h in header ]:
+                        header = [ (n, new if n == v else d)
+                                   for (n, d) in header ]
+                    else:
+                        header.append((v, new))
+            if copied != wanted:
+                differences.append(what + ': copied ' + ','.join(copied))
+            for name in sorted(set(items) | set(os.listdir(destSet)) -
+                               set([ 'header' ])):
+                if readItem(destSet, name) != items.get(name, None):
+                    differences.append(what + ': item ' + name + ' differs')
+            if headerEntries(destSet) != header:
+                differences.append(what + ': header differs')
+            if use == (True, True, True):
+                deleted = deleteCalibration(destSet)
+                if sorted(deleted) != sorted(calTables):
+                    differences.append('delete: deleted ' +
+                                       ','.join(deleted))
+                left = sorted(os.listdir(destSet))
+                if left != sorted([ 'header' ] + [ i for i in items
+                                                   if i not in calTables ]):
+                    differences.append('delete: left ' + ','.join(left))
+                if headerEntries(destSet) != header:
+                    differences.append('delete: header differs')
+        # A copy that fails part way leaves the dataset as it was.
+        destSet = os.path.join(workDir, 'failed.uv')
+        makeDataset(destSet, destVariables, destItems)
+        try:
+            copyItems(origSet, destSet, [ 'gains', 'missing' ], [ 'nsols' ])
+            differences.append('failed copy: no error')
+        except (IOError, OSError):
+            pass
+        if (sorted(os.listdir(destSet)) != [ 'gains', 'header', 'visdata' ]
+            or readItem(destSet, 'gains') != destItems['gains'] or
+            headerEntries(destSet) != [ (n, headerValue(v))
+                                        for (n, v) in destVariables ]):
+            differences.append('failed copy: dataset changed')
+    finally:
+        shutil.rmtree(workDir)
+    return differences
+
+if __name__ == '__main__':
+    usage = "usage: %prog [options] dataset [dataset ...]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--json', action='store_true',
+                      help='print the full checks as JSON')
+    parser.add_option('--check-miriad', action='store_true',
+                      help='copy the tables of the first dataset to the ' +
+                      'second, and delete them, with gpcopy and delhd and ' +
+                      'without, and compare the results')
+    parser.add_option('--check', action='store_true',
+                      help='copy and delete the tables of made-up ' +
+                      'datasets, and check the results')
+    (options, args) = parser.parse_args()
+    if options.check:
+        differences = checkCopies()
+        for d in differences:
+            print(d)
+        if len(differences) > 0:
+            sys.exit(1)
+        print('The copies and deletions of the made-up datasets are right.')
+        sys.exit(0)
+    if len(args) == 0:
+        parser.print_help()
+        sys.exit(1)
+    if options.check_miriad:
+        if len(args) != 2:
+            parser.print_help()
+            sys.exit(1)
+        differences = checkMiriad(args[0], args[1])
+        for d in differences:
+            print(d)
+        if len(differences) > 0:
+            sys.exit(1)
+        print('The copies and deletions match gpcopy and delhd.')
+        sys.exit(0)
+    for uvFile in args:
+        if not os.path.isfile(os.path.join(uvFile, 'header')):
+            print('Dataset', uvFile, 'is not accessible.')
+            continue
+        qa = calibrationQA(uvFile)
+        if options.json:
+            print(json.dumps(qa, indent=1))
+        else:
+            print(uvFile + ':')
+            for l in summariseQA(qa):
+                print(' ' + l)
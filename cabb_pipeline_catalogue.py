@@ -0,0 +1,238 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import sqlite3
+from optparse import OptionParser
+
+"""
+A catalogue of what the pipeline has made, kept in an SQLite database.
+Each run directory has its own catalogue (cabb_catalogue.sqlite) listing
+its datasets, IFs, IF chains, sources, scans, flag versions and
+reduction directories, all indexed so lookups don't need to search.
+
+Runs can also be added to a catalogue shared by a whole archive, which
+can then answer questions like "all observations of 1934-638 at 4cm"
+without visiting each run directory. Run this file directly to query a
+catalogue, or to build one for an archive tree.
+"""
+
+CATALOGUE_NAME = 'cabb_catalogue.sqlite'
+
+schema = [
+    """CREATE TABLE IF NOT EXISTS runs (
+         id INTEGER PRIMARY KEY, directory TEXT, miriad_data TEXT,
+         updated REAL, UNIQUE (directory, miriad_data))""",
+    """CREATE TABLE IF NOT EXISTS rpfits_files (
+         run_id INTEGER, path TEXT)""",
+    """CREATE TABLE IF NOT EXISTS datasets (
+         run_id INTEGER, name TEXT, freq_config TEXT, if_index INTEGER,
+         if_chain INTEGER, band TEXT, band_type TEXT, centre_freq REAL,
+         centre_mhz INTEGER, channels INTEGER, chan_width REAL,
+         bandwidth REAL)""",
+    """CREATE TABLE IF NOT EXISTS sources (
+         run_id INTEGER, name TEXT, right_ascension TEXT, declination TEXT)""",
+    """CREATE TABLE IF NOT EXISTS scans (
+         run_id INTEGER, source TEXT, start_time TEXT, cal_code TEXT,
+         freq_config TEXT)""",
+    """CREATE TABLE IF NOT EXISTS flag_versions (
+         run_id INTEGER, dataset TEXT, version TEXT, size INTEGER,
+         modified REAL)""",
+    """CREATE TABLE IF NOT EXISTS reduction_dirs (
+         run_id INTEGER, dataset TEXT, directory TEXT)""",
+    """CREATE TABLE IF NOT EXISTS reduction_datasets (
+         run_id INTEGER, directory TEXT, source TEXT, dataset TEXT)""",
+    "CREATE INDEX IF NOT EXISTS datasets_name ON datasets (run_id, name)",
+    """CREATE INDEX IF NOT EXISTS datasets_chain ON datasets
+         (run_id, freq_config, if_chain)""",
+    "CREATE INDEX IF NOT EXISTS datasets_freq ON datasets (run_id, centre_mhz)",
+    "CREATE INDEX IF NOT EXISTS datasets_band ON datasets (band, run_id)",
+    "CREATE INDEX IF NOT EXISTS sources_name ON sources (name, run_id)",
+    "CREATE INDEX IF NOT EXISTS scans_source ON scans (source, run_id)",
+    """CREATE INDEX IF NOT EXISTS flag_versions_dataset ON flag_versions
+         (run_id, dataset)""",
+    """CREATE INDEX IF NOT EXISTS reduction_datasets_source ON
+         reduction_datasets (run_id, directory, source)""" ]
+
+# Tables that hold rows belonging to a run.
+runTables = [ 'rpfits_files', 'datasets', 'sources', 'scans',
+              'flag_versions', 'reduction_dirs', 'reduction_datasets' ]
+
+def openCatalogue(path=CATALOGUE_NAME):
+    # Open (and make if necessary) a catalogue.
+    db = sqlite3.connect(path, timeout=60)
+    for s in schema:
+        db.execute(s)
+    db.commit()
+    return db
+
+def runId(db, directory, miriadData):
+    # Get the identifier of a run, starting a new one if needed.
+    r = db.execute('SELECT id FROM runs WHERE directory=? AND miriad_data=?',
+                   (directory, miriadData)).fetchone()
+    if r is not None:
+        return r[0]
+    c = db.execute('INSERT INTO runs (directory, miriad_data, updated) ' +
+                   'VALUES (?, ?, ?)', (directory, miriadData, time.time()))
+    return c.lastrowid
+
+def recordRun(db, progressDict, frequencyBand, directory=None):
+    # Put the description of an observation into the catalogue,
+    # replacing anything recorded about it before.
+    if directory is None:
+        directory = os.getcwd()
+    rid = runId(db, directory, progressDict['miriadData'])
+    for t in runTables:
+        db.execute('DELETE FROM ' + t + ' WHERE run_id=?', (rid,))
+    db.execute('UPDATE runs SET updated=? WHERE id=?', (time.time(), rid))
+    db.executemany('INSERT INTO rpfits_files VALUES (?, ?)',
+                   [ (rid, f) for f in progressDict['rpfitsFiles'] ])
+    rows = []
+    for fc in progressDict['freqConfigs']:
+        sfc = progressDict['freqConfigs'][fc]
+        for i in range(0, len(sfc['channels'])):
+            rows.append((rid, sfc['dataset'][i], fc, i, sfc['ifChain'][i],
+                         frequencyBand(sfc['centreFreq'][i]),
+                         sfc['classification'][i]['bandType'],
+                         sfc['centreFreq'][i],
+                         int(round(sfc['centreFreq'][i] * 1000)),
+                         sfc['channels'][i], sfc['chanWidth'][i],
+                         sfc['classification'][i]['bandwidth']))
+    db.executemany('INSERT INTO datasets VALUES ' +
+                   '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    rows = []
+    scans = []
+    for s in progressDict['sources']:
+        src = progressDict['sources'][s]
+        rows.append((rid, s, src.get('rightAscension', None),
+                     src.get('declination', None)))
+        for i in range(0, len(src['startTime'])):
+            scans.append((rid, s, src['startTime'][i], src['calCode'][i],
+                          src['freqConfig'][i]))
+    db.executemany('INSERT INTO sources VALUES (?, ?, ?, ?)', rows)
+    db.executemany('INSERT INTO scans VALUES (?, ?, ?, ?, ?)', scans)
+    db.commit()
+    return rid
+
+def recordProducts(db, rid, progressDict, directory=None):
+    # Record the flag versions and reduction directories made for each
+    # dataset.
+    if directory is None:
+        directory = os.getcwd()
+    for t in [ 'flag_versions', 'reduction_dirs', 'reduction_datasets' ]:
+        db.execute('DELETE FROM ' + t + ' WHERE run_id=?', (rid,))
+    rows = []
+    for d in progressDict['datasets']:
+        dd = os.path.join(directory, d)
+        if not os.path.isdir(dd):
+            continue
+        for f in os.listdir(dd):
+            if f.startswith('flags.'):
+                st = os.stat(os.path.join(dd, f))
+                rows.append((rid, d, f[6:], st.st_size, st.st_mtime))
+    db.executemany('INSERT INTO flag_versions VALUES (?, ?, ?, ?, ?)', rows)
+    if 'reductionDir' in progressDict:
+        rows = []
+        sets = []
+        for d in progressDict['reductionDir']:
+            r = progressDict['reductionDir'][d]
+            rows.append((rid, d, r))
+            rd = os.path.join(directory, r)
+            if not os.path.isdir(rd):
+                continue
+            for s in os.listdir(rd):
+                if os.path.isfile(os.path.join(rd, s, 'visdata')):
+                    sets.append((rid, r, s.split('.')[0], s))
+        db.executemany('INSERT INTO reduction_dirs VALUES (?, ?, ?)', rows)
+        db.executemany('INSERT INTO reduction_datasets VALUES (?, ?, ?, ?)',
+                       sets)
+    db.commit()
+    return True
+
+def findObservations(db, source=None, band=None, bandType=None):
+    # Find the datasets in the catalogue that contain a source and/or
+    # are in a band.
+    query = ('SELECT DISTINCT runs.directory, runs.miriad_data, ' +
+             'datasets.name, datasets.band, datasets.centre_freq ' +
+             'FROM datasets JOIN runs ON runs.id = datasets.run_id')
+    conds = []
+    args = []
+    if source is not None:
+        query += (' JOIN scans ON scans.run_id = datasets.run_id AND ' +
+                  'scans.freq_config = datasets.freq_config')
+        conds.append('scans.source = ?')
+        args.append(source)
+    if band is not None:
+        conds.append('datasets.band = ?')
+        args.append(band)
+    if bandType is not None:
+        conds.append('datasets.band_type = ?')
+        args.append(bandType)
+    if len(conds) > 0:
+        query += ' WHERE ' + ' AND '.join(conds)
+    query += ' ORDER BY runs.directory, datasets.centre_freq'
+    return db.execute(query, args).fetchall()
+
+def mergeCatalogue(db, runDb, directory):
+    # Copy all the runs in a run catalogue into an archive catalogue.
+    for (oldId, miriadData) in runDb.execute(
+            'SELECT id, miriad_data FROM runs').fetchall():
+        rid = runId(db, directory, miriadData)
+        for t in runTables:
+            db.execute('DELETE FROM ' + t + ' WHERE run_id=?', (rid,))
+            rows = runDb.execute('SELECT * FROM ' + t + ' WHERE run_id=?',
+                                 (oldId,)).fetchall()
+            if len(rows) == 0:
+                continue
+            marks = ', '.join([ '?' ] * len(rows[0]))
+            db.executemany('INSERT INTO ' + t + ' VALUES (' + marks + ')',
+                           [ (rid,) + tuple(r[1:]) for r in rows ])
+    db.commit()
+    return True
+
+def indexArchive(db, archiveDir, options, archivePath=None):
+    # Find every run catalogue under a directory and add it to an
+    # archive catalogue, which is kept in archivePath.
+    n = 0
+    for (d, dirs, files) in os.walk(archiveDir):
+        # Don't descend into the datasets themselves.
+        dirs[:] = [ s for s in dirs if not s.startswith('uvsplit.') and
+                    not s.startswith('reduction.') ]
+        if CATALOGUE_NAME in files:
+            p = os.path.join(d, CATALOGUE_NAME)
+            # The archive itself may be under the directory too.
+            if (archivePath is not None and os.path.exists(archivePath) and
+                os.path.samefile(p, archivePath)):
+                continue
+            if options['verbose']:
+                print('Adding run catalogue', p)
+            runDb = sqlite3.connect(p, timeout=60)
+            mergeCatalogue(db, runDb, os.path.abspath(d))
+            runDb.close()
+            n += 1
+    return n
+
+if __name__ == '__main__':
+    usage = "usage: %prog [options] catalogue"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--index', metavar='DIR',
+                      help='add all the run catalogues found under DIR')
+    parser.add_option('--source', help='only show observations of SOURCE')
+    parser.add_option('--band', help='only show observations in BAND ' +
+                      '(16cm, 4cm, 15mm, 7mm or 3mm)')
+    parser.add_option('--band-type', help='only show wide or zoom bands')
+    parser.add_option('-v', '--verbose', action='store_true')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_usage()
+        sys.exit(0)
+    db = openCatalogue(args[0])
+    if options.index is not None:
+        n = indexArchive(db, options.index, { 'verbose': options.verbose },
+                         args[0])
+        print('Indexed', n, 'run catalogues.')
+    if (options.source is not None or options.band is not None or
+        options.band_type is not None or options.index is None):
+        for r in findObservations(db, options.source, options.band,
+                                  options.band_type):
+            print(os.path.join(r[0], r[2]), r[3], '%.3f' % r[4])
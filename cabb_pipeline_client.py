@@ -0,0 +1,93 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import socket
+from cabb_pipeline_daemon import SOCKET_PATH, request
+
+"""
+Submit a reduction to the CABB pipeline daemon. Everything on the
+command line is passed on to cabb_pipeline.py, which is run in this
+directory, so
+  python cabb_pipeline_client.py --no-casa 2015-01-01_0000.C999
+does the same as
+  python cabb_pipeline.py --no-casa 2015-01-01_0000.C999
+without having to start the pipeline from scratch. The output of the
+job is shown as it runs, and the client exits with the job's exit code.
+
+These options are used by the client itself and not passed on:
+  --daemon-socket=FILE  the socket the daemon is listening on
+  --detach              print the job number and exit straight away
+  --jobs                list the jobs the daemon knows about
+  --cancel=N            cancel job N
+  --shutdown            stop the daemon once its jobs have finished
+"""
+
+def splitArguments(argv):
+    # Separate the client's own options from the pipeline's.
+    clientOptions = { 'socket': SOCKET_PATH, 'detach': False,
+                      'command': 'submit', 'job': None }
+    pipelineArgs = []
+    for a in argv:
+        if a.startswith('--daemon-socket='):
+            clientOptions['socket'] = a.split('=', 1)[1]
+        elif a == '--detach':
+            clientOptions['detach'] = True
+        elif a == '--jobs':
+            clientOptions['command'] = 'list'
+        elif a.startswith('--cancel='):
+            clientOptions['command'] = 'cancel'
+            clientOptions['job'] = int(a.split('=', 1)[1])
+        elif a == '--shutdown':
+            clientOptions['command'] = 'shutdown'
+        else:
+            pipelineArgs.append(a)
+    return (clientOptions, pipelineArgs)
+
+def followJob(socketPath, job):
+    # Show the log of a job until it finishes, and return its exit code.
+    offset = 0
+    while True:
+        status = request(socketPath, { 'command': 'status', 'job': job })
+        if os.path.isfile(status['log']):
+            with open(status['log']) as f:
+                f.seek(offset)
+                text = f.read()
+                offset = f.tell()
+            if len(text) > 0:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+        if status['state'] not in [ 'queued', 'running' ]:
+            break
+        time.sleep(1)
+    if status['exitCode'] is None:
+        return 1
+    return status['exitCode']
+
+if __name__ == '__main__':
+    (clientOptions, pipelineArgs) = splitArguments(sys.argv[1:])
+    socketPath = clientOptions['socket']
+    try:
+        if clientOptions['command'] == 'list':
+            for j in request(socketPath, { 'command': 'list' })['jobs']:
+                print(j['job'], j['state'], j['cwd'], " ".join(j['argv']))
+            sys.exit(0)
+        if clientOptions['command'] in [ 'cancel', 'shutdown' ]:
+            r = request(socketPath, { 'command': clientOptions['command'],
+                                      'job': clientOptions['job'] })
+            if 'error' in r:
+                print(r['error'])
+                sys.exit(1)
+            sys.exit(0)
+        r = request(socketPath, { 'command': 'submit', 'argv': pipelineArgs,
+                                  'cwd': os.getcwd() })
+    except socket.error:
+        print('Cannot reach the pipeline daemon on', socketPath)
+        sys.exit(1)
+    if 'error' in r:
+        print(r['error'])
+        sys.exit(1)
+    if clientOptions['detach']:
+        print('Submitted job', r['job'], '; its log is', r['log'])
+        sys.exit(0)
+    sys.exit(followJob(socketPath, r['job']))
@@ -0,0 +1,248 @@
+from __future__ import print_function
+import os
+import re
+import time
+import sqlite3
+import threading
+from cabb_pipeline_metadata import readMetadata
+from cabb_pipeline_resources import datasetShape
+
+"""
+A history of how long each Miriad task has taken, and a simple model of
+the cost of a task fitted to it. Every task the pipeline runs is timed
+and recorded with the stage it was part of and the shape of the dataset
+it worked on: the band, the bandwidth, the number of channels and the
+number of records.
+
+For each stage, task, band and bandwidth, the time is fitted as a fixed
+overhead plus a cost for each channel of each record. Groups without
+enough history fall back to the fit for the task as a whole, and tasks
+that have never been run to a guess based on the size of the data.
+The predictions are used to start the biggest datasets first, so a
+large wide band is not left until the end while the small zoom bands
+finish early, and to predict how long the whole run will take.
+
+The history is kept in ~/.cabb_pipeline/history.sqlite unless another
+file is given.
+"""
+
+HISTORY_PATH = os.path.join(os.path.expanduser('~'), '.cabb_pipeline',
+                            'history.sqlite')
+
+# The fewest runs of a task we'll fit a model to.
+MIN_SAMPLES = 3
+
+# The guess for tasks we know nothing about: a few seconds to start,
+# then reading through the data at this rate (bytes per second).
+DEFAULT_OVERHEAD = 5.0
+DEFAULT_RATE = 50.0 * 1024 * 1024
+
+schema = [
+    """CREATE TABLE IF NOT EXISTS task_times (
+         stage TEXT, task TEXT, band TEXT, bandwidth REAL, channels INTEGER,
+         records INTEGER, seconds REAL, recorded REAL)""",
+    """CREATE INDEX IF NOT EXISTS task_times_task ON task_times
+         (task, stage, band)""" ]
+
+# What we know, and what we've learnt during this run.
+history = { 'path': None, 'rows': [], 'new': [], 'models': None,
+            'stage': 'unknown' }
+historyLock = threading.Lock()
+
+def openHistory(path=None):
+    # Read the task history and fit the models to it.
+    if path is None:
+        path = HISTORY_PATH
+    rows = []
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        db = sqlite3.connect(path, timeout=60)
+        for s in schema:
+            db.execute(s)
+        db.commit()
+        rows = db.execute('SELECT stage, task, band, bandwidth, channels, ' +
+                          'records, seconds FROM task_times').fetchall()
+        db.close()
+    except (OSError, sqlite3.Error):
+        # We can still time the tasks, we just won't keep them.
+        path = None
+    with historyLock:
+        history['path'] = path
+        history['rows'] = [ tuple(r) for r in rows ]
+        history['new'] = []
+        history['models'] = fitModels(history['rows'])
+    return history
+
+def saveHistory():
+    # Add the tasks timed during this run to the history.
+    with historyLock:
+        new = history['new']
+        history['new'] = []
+    if history['path'] is None or len(new) == 0:
+        return False
+    try:
+        db = sqlite3.connect(history['path'], timeout=60)
+        for s in schema:
+            db.execute(s)
+        db.executemany('INSERT INTO task_times VALUES ' +
+                       '(?, ?, ?, ?, ?, ?, ?, ?)', new)
+        db.commit()
+        db.close()
+    except sqlite3.Error:
+        return False
+    return True
+
+def setStage(stage):
+    # Name the stage of the pipeline the following tasks belong to.
+    history['stage'] = stage
+
+def bandName(frequency):
+    # The band a frequency (GHz) is in; the same as frequencyBand.
+    from cabb_pipeline_main_modules import frequencyBand
+    if frequency is None:
+        return 'unknown'
+    return frequencyBand(frequency)
+
+def datasetFeatures(uvFile):
+    # Describe a dataset by the things its processing time depends on.
+    shape = datasetShape(uvFile)
+    features = { 'band': 'unknown', 'bandwidth': 0.0,
+                 'channels': shape['channels'], 'records': shape['records'],
+                 'visBytes': shape['visBytes'] }
+    name = os.path.basename(os.path.normpath(uvFile))
+    meta = readMetadata(uvFile)
+    if (meta is not None and 'datasetIF' in meta and
+        name in meta['datasetIF']):
+        (fc, i) = meta['datasetIF'][name]
+        sfc = meta['freqConfigs'][fc]
+        features['band'] = bandName(sfc['centreFreq'][i])
+        features['bandwidth'] = round(
+            sfc['classification'][i]['bandwidth'], 4)
+    else:
+        # Source datasets in a reduction directory are named after their
+        # centre frequency (MHz).
+        a = re.search(r'\.(\d+)$', name)
+        if a is not None:
+            features['band'] = bandName(float(a.group(1)) / 1000.0)
+    return features
+
+def recordTask(task, workDir, params, seconds):
+    # Add the time taken by a Miriad task to the history.
+    uvFile = None
+    for k in [ 'vis', 'out' ]:
+        if k in params and params[k] is not None:
+            uvFile = os.path.join(workDir, str(params[k]).split(',')[0])
+            break
+    if uvFile is None or not os.path.isdir(uvFile):
+        return False
+    f = datasetFeatures(uvFile)
+    row = (history['stage'], task, f['band'], f['bandwidth'], f['channels'],
+           f['records'], seconds, time.time())
+    with historyLock:
+        history['new'].append(row)
+    return True
+
+def fitLine(samples):
+    # Fit seconds = overhead + rate * work by least squares; the samples
+    # are (work, seconds) pairs.
+    n = float(len(samples))
+    sx = sum([ s[0] for s in samples ])
+    sy = sum([ s[1] for s in samples ])
+    sxx = sum([ s[0] * s[0] for s in samples ])
+    sxy = sum([ s[0] * s[1] for s in samples ])
+    d = n * sxx - sx * sx
+    if d <= 0:
+        # All the same size, so all we know is the average.
+        return (sy / n, 0.0)
+    rate = (n * sxy - sx * sy) / d
+    if rate < 0:
+        return (sy / n, 0.0)
+    overhead = max(0.0, (sy - rate * sx) / n)
+    return (overhead, rate)
+
+def fitModels(rows):
+    # Fit a model for each group of tasks, and each task on its own.
+    groups = {}
+    for (stage, task, band, bandwidth, channels, records, seconds) in rows:
+        work = float(channels) * float(records)
+        for k in [ (stage, task, band, bandwidth), (task, band), (task,) ]:
+            if k not in groups:
+                groups[k] = []
+            groups[k].append((work, seconds))
+    models = {}
+    for k in groups:
+        if len(groups[k]) >= MIN_SAMPLES:
+            models[k] = fitLine(groups[k])
+    return models
+
+def predictTask(stage, task, features):
+    # Predict how long (seconds) a task will take on a dataset.
+    models = history['models']
+    if models is None:
+        models = {}
+    work = float(features['channels']) * float(features['records'])
+    for k in [ (stage, task, features['band'], features['bandwidth']),
+               (task, features['band']), (task,) ]:
+        if k in models:
+            return models[k][0] + models[k][1] * work
+    return DEFAULT_OVERHEAD + features['visBytes'] / DEFAULT_RATE
+
+def datasetCosts(uvFiles, stage, tasks, workDir='.'):
+    # Predict the cost of running a list of (task, count) pairs on each
+    # of a list of datasets.
+    costs = {}
+    for u in uvFiles:
+        f = datasetFeatures(os.path.join(workDir, u))
+        costs[u] = sum([ predictTask(stage, t, f) * c for (t, c) in tasks ])
+    return costs
+
+def longestFirst(uvFiles, costs):
+    # Order the datasets so the longest are started first.
+    return sorted(uvFiles, key=lambda u: costs[u], reverse=True)
+
+def predictMakespan(costs, workers):
+    # Predict how long a set of jobs will take when the longest is
+    # always given to the next free worker.
+    finish = [ 0.0 ] * max(1, workers)
+    for c in sorted(costs, reverse=True):
+        i = finish.index(min(finish))
+        finish[i] += c
+    return max(finish)
+
+def formatDuration(seconds):
+    # Write a time in a way people can read.
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return str(seconds) + 's'
+    if seconds < 3600:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%dh%02dm' % (seconds // 3600, (seconds % 3600) // 60)
+
+def predictRun(progressDict, options):
+    # Predict how long the rest of the pipeline will take on the loaded
+    # datasets. The flagging stages run their datasets concurrently when
+    # we're allowed more than one task at a time; the rest run in turn.
+    # Only the wide bands are flagged, but the zoom bands get their
+    # flags and so have their statistics taken afterwards too.
+    from cabb_pipeline_main_modules import getIF
+    workDir = progressDict.get('workDir', '.')
+    datasets = progressDict['datasets']
+    wide = [ p for p in datasets if getIF(progressDict, p) is not None and
+             getIF(progressDict, p)['classification']['bandType'] == 'wide' ]
+    workers = max(1, options['max_tasks'])
+    stages = [ ('loadstats', datasets, [ ('uvfstats', 4) ], workers),
+               ('startstats', datasets, [ ('uvfstats', 4) ], workers) ]
+    if not options['no_flag']:
+        stages.append(('autoflag', wide, [ ('pgflag', 4) ], workers))
+    stages.append(('autostats', datasets, [ ('uvfstats', 4) ], workers))
+    if not options['no_casa']:
+        stages.append(('casa', datasets, [ ('uv2ms', 1) ], 1))
+    stages.append(('calibrate', datasets,
+                   [ ('uvsplit', 1), ('mfcal', 2), ('pgflag', 4),
+                     ('gpcal', 1) ], 1))
+    total = 0.0
+    for (stage, uvFiles, tasks, n) in stages:
+        costs = datasetCosts(uvFiles, stage, tasks, workDir)
+        total += predictMakespan(list(costs.values()), n)
+    return total
@@ -0,0 +1,389 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import threading
+from collections import deque
+from optparse import OptionParser
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+"""
+A long-lived CABB pipeline process that accepts reduction jobs over a
+Unix socket. Starting the pipeline costs a lot more than many small
+reprocessing jobs need: importing NumPy, reading the calibrator
+database and looking for uv2ms. The pipeline leaves these until they
+are needed, but nearly every job needs them eventually. The daemon does
+all that once, then runs each job in a forked copy of itself, so every
+job starts with everything already loaded.
+
+The copies are forked by a helper process, which is itself forked as
+soon as everything is loaded, before the daemon starts the threads that
+serve requests and schedule jobs. A fork copies only the thread that
+made it, so forking from the daemon could leave a job holding a lock
+that one of the other threads had at the time; the helper has only the
+one thread. The daemon sends it each job to start over a pipe, and it
+sends back the process ID of each job and how it finished.
+
+Jobs wait in a queue until one of the job slots is free. Each job runs
+cabb_pipeline.py with the arguments it was given, in the directory it
+was submitted from, with its output going to its own log.
+
+Start the daemon with
+  python cabb_pipeline_daemon.py [--socket FILE] [--max-jobs N]
+and submit jobs with cabb_pipeline_client.py, which takes the same
+options as cabb_pipeline.py.
+
+Each request is a single line of JSON, and so is each reply.
+"""
+
+DAEMON_DIR = os.path.join(os.path.expanduser('~'), '.cabb_pipeline')
+SOCKET_PATH = os.path.join(DAEMON_DIR, 'daemon.sock')
+PIPELINE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'cabb_pipeline.py')
+
+def warmUp(options):
+    # Load everything a job would otherwise have to load itself.
+    if not options['quiet']:
+        print('Loading the pipeline modules...')
+    import cabb_pipeline_main_modules
+    import cabb_pipeline_rfi_calculator
+    import cabb_pipeline_rpfits
+    import cabb_pipeline_catalogue
+    import cabb_pipeline_costmodel
+    import cabb_pipeline_watch
+    import numpy
+    import atca_calibrator_database
+    atca_calibrator_database.getCalibrators()
+    cabb_pipeline_main_modules.cmd_exists('uv2ms')
+    if not options['quiet']:
+        print('Pipeline modules loaded.')
+    return True
+
+class JobForker(object):
+    # The single-threaded helper process that forks the jobs.
+    def __init__(self):
+        (requestRead, requestWrite) = os.pipe()
+        (replyRead, replyWrite) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(requestWrite)
+            os.close(replyRead)
+            forkJobs(requestRead, replyWrite)
+        os.close(requestRead)
+        os.close(replyWrite)
+        self.pid = pid
+        self.requests = os.fdopen(requestWrite, 'w', 1)
+        self.replies = os.fdopen(replyRead, 'r', 1)
+
+    def start(self, job):
+        self.requests.write(json.dumps(job) + '\n')
+
+    def events(self):
+        # What happens to the jobs, until the helper has stopped.
+        for l in self.replies:
+            yield json.loads(l)
+
+    def close(self):
+        # Let the helper stop once its jobs have finished.
+        self.requests.close()
+
+    def join(self):
+        os.waitpid(self.pid, 0)
+        self.replies.close()
+
+def forkJobs(requestFd, replyFd):
+    # The helper: fork each job we're sent, tell the daemon when it
+    # starts and finishes, and never return.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    running = {}
+    pending = b''
+    reading = True
+
+    def reply(event):
+        b = (json.dumps(event) + '\n').encode('utf-8')
+        while len(b) > 0:
+            b = b[os.write(replyFd, b):]
+
+    while reading or len(running) > 0:
+        if reading and len(select.select([ requestFd ], [], [], 0.5)[0]) > 0:
+            data = os.read(requestFd, 65536)
+            if len(data) == 0:
+                # The daemon is stopping.
+                reading = False
+            pending += data
+            while b'\n' in pending:
+                (l, pending) = pending.split(b'\n', 1)
+                job = json.loads(l.decode('utf-8'))
+                pid = os.fork()
+                if pid == 0:
+                    os.close(requestFd)
+                    os.close(replyFd)
+                    signal.signal(signal.SIGINT, signal.default_int_handler)
+                    runJob(job)
+                running[pid] = job['job']
+                reply({ 'job': job['job'], 'pid': pid })
+        elif not reading:
+            time.sleep(0.5)
+        while len(running) > 0:
+            (pid, status) = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            if pid in running:
+                reply({ 'job': running.pop(pid), 'status': status })
+    os._exit(0)
+
+class JobQueue(object):
+    # The jobs we've been given, and the running of them.
+    def __init__(self, maxJobs, logDir, forker):
+        self.maxJobs = max(1, maxJobs)
+        self.logDir = logDir
+        self.forker = forker
+        self.jobs = {}
+        self.waiting = deque()
+        # The process of each running job, once the helper has told us.
+        self.running = {}
+        self.nextId = 1
+        self.lock = threading.Condition()
+        self.stopping = False
+
+    def submit(self, argv, cwd):
+        with self.lock:
+            jid = self.nextId
+            self.nextId += 1
+            job = { 'job': jid, 'argv': argv, 'cwd': cwd,
+                    'state': 'queued', 'submitted': time.time(),
+                    'started': None, 'finished': None, 'exitCode': None,
+                    'log': os.path.join(self.logDir,
+                                        'job.' + str(jid) + '.log') }
+            self.jobs[jid] = job
+            self.waiting.append(jid)
+            self.lock.notify_all()
+            return dict(job)
+
+    def status(self, jid):
+        with self.lock:
+            if jid not in self.jobs:
+                return None
+            return dict(self.jobs[jid])
+
+    def list(self):
+        with self.lock:
+            return [ dict(self.jobs[j]) for j in sorted(self.jobs) ]
+
+    def cancel(self, jid):
+        with self.lock:
+            if jid not in self.jobs:
+                return None
+            job = self.jobs[jid]
+            if job['state'] == 'queued':
+                self.waiting.remove(jid)
+                job['state'] = 'cancelled'
+                job['finished'] = time.time()
+            elif job['state'] == 'running':
+                if self.running.get(jid, None) is not None:
+                    os.kill(self.running[jid], signal.SIGTERM)
+                else:
+                    # It'll be stopped as soon as we know its process.
+                    job['cancelling'] = True
+            return dict(job)
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            self.lock.notify_all()
+
+    def jobEvent(self, event):
+        # The helper has started or collected a job.
+        with self.lock:
+            jid = event['job']
+            job = self.jobs[jid]
+            if 'pid' in event:
+                job['pid'] = event['pid']
+                self.running[jid] = event['pid']
+                if job.pop('cancelling', False):
+                    os.kill(event['pid'], signal.SIGTERM)
+                return
+            status = event['status']
+            self.running.pop(jid, None)
+            job['finished'] = time.time()
+            if os.WIFSIGNALED(status):
+                job['exitCode'] = -os.WTERMSIG(status)
+                job['state'] = 'cancelled'
+            else:
+                job['exitCode'] = os.WEXITSTATUS(status)
+                job['state'] = 'done' if job['exitCode'] == 0 else 'failed'
+            self.lock.notify_all()
+
+    def watchJobs(self):
+        # Follow the jobs the helper runs, until it has stopped.
+        for event in self.forker.events():
+            self.jobEvent(event)
+
+    def schedule(self):
+        # Start jobs as slots become free, until we're told to stop. The
+        # jobs are handed to the helper without holding the lock.
+        while True:
+            starting = []
+            with self.lock:
+                if self.stopping and len(self.running) == 0:
+                    break
+                while (not self.stopping and len(self.waiting) > 0 and
+                       len(self.running) < self.maxJobs):
+                    job = self.jobs[self.waiting.popleft()]
+                    job['state'] = 'running'
+                    job['started'] = time.time()
+                    self.running[job['job']] = None
+                    starting.append(dict(job))
+                if len(starting) == 0:
+                    self.lock.wait(0.5)
+            for job in starting:
+                self.forker.start(job)
+        self.forker.close()
+
+def runJob(job):
+    # Run a job in the forked child, and never return.
+    code = 1
+    try:
+        log = os.open(job['log'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                      0o644)
+        os.dup2(log, 1)
+        os.dup2(log, 2)
+        os.close(log)
+        sys.stdout = os.fdopen(1, 'w', 1)
+        sys.stderr = os.fdopen(2, 'w', 1)
+        os.chdir(job['cwd'])
+        sys.argv = [ PIPELINE_SCRIPT ] + job['argv']
+        import runpy
+        runpy.run_path(PIPELINE_SCRIPT, run_name='__main__')
+        code = 0
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code)
+    except:
+        import traceback
+        traceback.print_exc()
+    try:
+        # The logs would otherwise be left to the exit handlers, which
+        # don't run in the child.
+        from cabb_pipeline_logs import flushLogs
+        flushLogs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code)
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        queue = self.server.queue
+        try:
+            req = json.loads(self.rfile.readline().decode('utf-8'))
+            cmd = req.get('command', None)
+            if cmd == 'submit':
+                reply = queue.submit([ str(a) for a in req['argv'] ],
+                                     req['cwd'])
+            elif cmd == 'status':
+                reply = queue.status(int(req['job']))
+            elif cmd == 'list':
+                reply = { 'jobs': queue.list() }
+            elif cmd == 'cancel':
+                reply = queue.cancel(int(req['job']))
+            elif cmd == 'shutdown':
+                queue.stop()
+                threading.Thread(target=self.server.shutdown).start()
+                reply = { 'stopping': True }
+            else:
+                reply = { 'error': 'Unknown command ' + str(cmd) }
+            if reply is None:
+                reply = { 'error': 'No such job' }
+        except (ValueError, KeyError, TypeError) as e:
+            reply = { 'error': 'Bad request: ' + str(e) }
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+class DaemonServer(socketserver.ThreadingMixIn,
+                   socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(socketPath, options):
+    # Run the daemon until it is told to shut down.
+    if not os.path.isdir(os.path.dirname(socketPath)):
+        os.makedirs(os.path.dirname(socketPath))
+    if os.path.exists(socketPath):
+        # Only take over the socket if nothing is listening on it.
+        try:
+            request(socketPath, { 'command': 'list' })
+            print('A daemon is already listening on', socketPath)
+            sys.exit(0)
+        except socket.error:
+            os.unlink(socketPath)
+    logDir = options['log_dir']
+    if not os.path.isdir(logDir):
+        os.makedirs(logDir)
+    warmUp(options)
+    # This has to be done before any threads are started.
+    forker = JobForker()
+    queue = JobQueue(options['max_jobs'], logDir, forker)
+    server = DaemonServer(socketPath, RequestHandler)
+    server.queue = queue
+    watcher = threading.Thread(target=queue.watchJobs)
+    watcher.start()
+    scheduler = threading.Thread(target=queue.schedule)
+    scheduler.start()
+    if not options['quiet']:
+        print('Accepting jobs on', socketPath)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.stop()
+        scheduler.join()
+        watcher.join()
+        forker.join()
+        server.server_close()
+        os.unlink(socketPath)
+    if not options['quiet']:
+        print('Daemon stopped.')
+    return True
+
+def request(socketPath, req):
+    # Send a request to the daemon and return its reply.
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socketPath)
+        s.sendall((json.dumps(req) + '\n').encode('utf-8'))
+        f = s.makefile('rb')
+        reply = f.readline()
+        f.close()
+    finally:
+        s.close()
+    return json.loads(reply.decode('utf-8'))
+
+if __name__ == '__main__':
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--socket', default=SOCKET_PATH,
+                      help='the socket to accept jobs on (default: ' +
+                      SOCKET_PATH + ')')
+    parser.add_option('--max-jobs', type='int', default=1,
+                      help='the number of jobs that may run at once ' +
+                      '(default: 1)')
+    parser.add_option('--log-dir', default=os.path.join(DAEMON_DIR, 'jobs'),
+                      help='where to put the log of each job')
+    parser.add_option('-q', '--quiet', action='store_true',
+                      help='supress all output, except for errors')
+    (options, args) = parser.parse_args()
+    serve(options.socket, { 'max_jobs': options.max_jobs,
+                            'log_dir': options.log_dir,
+                            'quiet': options.quiet })
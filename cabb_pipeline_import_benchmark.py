@@ -0,0 +1,110 @@
+from __future__ import print_function
+import os
+import sys
+import subprocess
+from optparse import OptionParser
+
+"""
+Check that the pipeline still starts quickly. Each of the entry points
+below is imported (or run) in a fresh Python process several times, and
+the median time is compared to a budget. It also checks that the heavy
+modules are not loaded by the import alone; they should only be loaded
+by the stages that use them.
+
+Run it as
+  python cabb_pipeline_import_benchmark.py [--budget MS] [--repeats N]
+and it exits with status 1 if anything is over budget, or fails to run.
+"""
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# The things people start, and what each should cost (milliseconds) on
+# top of starting Python itself.
+entryPoints = [
+    ('cabb_pipeline_main_modules',
+     'import cabb_pipeline_main_modules', 1.0),
+    ('interactiveMode()',
+     'from cabb_pipeline_main_modules import interactiveMode; ' +
+     'interactiveMode()', 1.0),
+    ('cabb_pipeline_rfi_calculator',
+     'import cabb_pipeline_rfi_calculator', 1.0),
+    ('cabb_pipeline.py --help', None, 1.5) ]
+
+# Modules that should never be loaded just by importing the pipeline.
+heavyModules = [ 'numpy', 'matplotlib', 'mirpy' ]
+
+def timeCommand(args, repeats):
+    # The median time (milliseconds) it takes to run a command, or None
+    # if it fails: a command that stops early would look fast.
+    import time
+    times = []
+    for i in range(0, repeats):
+        start = time.time()
+        p = subprocess.Popen(args, cwd=here, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        (out, err) = p.communicate()
+        times.append((time.time() - start) * 1000.0)
+        if p.returncode != 0:
+            print(' '.join(args[1:]), 'exited with status', p.returncode)
+            err = err.decode('utf-8', 'replace').rstrip()
+            if len(err) > 0:
+                print(err)
+            return None
+    times.sort()
+    return times[len(times) // 2]
+
+def heavyModulesLoaded():
+    # Which of the heavy modules get loaded by the pipeline imports.
+    code = ('import sys, cabb_pipeline_main_modules, ' +
+            'cabb_pipeline_rfi_calculator, atca_calibrator_database; ' +
+            'print(",".join([ m for m in ' + repr(heavyModules) +
+            ' if m in sys.modules ])); ' +
+            'print(atca_calibrator_database.calibrators is not None)')
+    out = subprocess.check_output([ sys.executable, '-c', code ], cwd=here)
+    lines = out.decode('utf-8').splitlines()
+    loaded = [ m for m in lines[0].split(',') if m != '' ]
+    if lines[1] == 'True':
+        loaded.append('the calibrator database')
+    return loaded
+
+if __name__ == '__main__':
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--budget', type='float', default=150.0,
+                      help='the time (ms) each import may take on top of ' +
+                      'starting Python, scaled for each entry point ' +
+                      '(default: 150)')
+    parser.add_option('--repeats', type='int', default=7,
+                      help='the number of times to time each entry point ' +
+                      '(default: 7)')
+    (options, args) = parser.parse_args()
+
+    failed = False
+    base = timeCommand([ sys.executable, '-c', 'pass' ], options.repeats)
+    if base is None:
+        sys.exit(1)
+    print('Starting Python: %.1f ms' % base)
+    for (name, code, scale) in entryPoints:
+        if code is None:
+            cmd = [ sys.executable, 'cabb_pipeline.py', '--help' ]
+        else:
+            cmd = [ sys.executable, '-c', code ]
+        t = timeCommand(cmd, options.repeats)
+        budget = options.budget * scale
+        if t is None:
+            print('%s: FAILED' % name)
+            failed = True
+            continue
+        t -= base
+        status = 'ok'
+        if t > budget:
+            status = 'OVER BUDGET'
+            failed = True
+        print('%s: %.1f ms (budget %.1f ms) %s' % (name, t, budget, status))
+    loaded = heavyModulesLoaded()
+    if len(loaded) > 0:
+        print('Loaded at import:', ", ".join(loaded))
+        failed = True
+    else:
+        print('No heavy modules loaded at import.')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,169 @@
+from __future__ import print_function
+import os
+import json
+import time
+import atexit
+import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from cabb_pipeline_costmodel import history
+
+"""
+The logs the pipeline writes for the observation and for each dataset.
+
+Each log is a stream that the pipeline writes to as if it were a file,
+but nothing is held open: what is written is kept in memory and
+appended to the log in batches, when enough has built up, every few
+seconds in the background, and when the log is closed. Only whole lines
+are appended before then, and each batch is appended in one write while
+holding a lock on the file, so several threads, or several pipelines in
+other processes, can share a log without their lines being mixed up.
+
+Beside each text log log.<name> is log.<name>.jsonl, with one JSON
+object for each line of the text log, giving when it was written, the
+stage of the pipeline it was written in and the process that wrote it.
+"""
+
+LOG_PREFIX = 'log.'
+JSON_SUFFIX = '.jsonl'
+
+# Append a log once this much of it is waiting (bytes).
+FLUSH_SIZE = 64 * 1024
+
+# And append everything waiting this often (s).
+FLUSH_INTERVAL = 5.0
+
+# The sinks that haven't been closed, to be flushed before exiting.
+openSinks = []
+
+def logPath(directory, name):
+    return os.path.join(directory, LOG_PREFIX + name)
+
+def appendLocked(path, data):
+    # Append to a file in a single write, holding a lock on it.
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+        b = data.encode('utf-8')
+        while len(b) > 0:
+            b = b[os.write(fd, b):]
+    finally:
+        # Closing it also releases the lock.
+        os.close(fd)
+
+def lineRecord(name, text):
+    # The JSON line describing a line of a log.
+    return json.dumps({ 'time': round(time.time(), 3), 'log': name,
+                        'stage': history.get('stage', None),
+                        'pid': os.getpid(), 'text': text }) + '\n'
+
+def appendText(directory, name, text):
+    # Add some text to a log and its JSON twin straight away.
+    appendLocked(logPath(directory, name), text)
+    appendLocked(logPath(directory, name) + JSON_SUFFIX,
+                 ''.join([ lineRecord(name, l)
+                           for l in text.rstrip('\n').split('\n') ]))
+
+class LogStream(object):
+    # One log, which can be written to like a file.
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+        self.text = ''
+        self.records = []
+        self.line = ''
+
+    def write(self, text):
+        self.sink.add(self, text)
+
+    def flush(self):
+        self.sink.flushStream(self)
+
+    def close(self):
+        self.sink.flushStream(self, True)
+
+class LogSink(object):
+    # The logs in a directory, and the writing of them.
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.flusher = threading.Thread(target=self.flushLoop)
+        self.flusher.daemon = True
+        self.flusher.start()
+        openSinks.append(self)
+
+    def stream(self, name, fresh=False):
+        # The stream of a log, emptying the log first if it's fresh.
+        with self.lock:
+            if name not in self.streams:
+                self.streams[name] = LogStream(self, name)
+            if fresh:
+                for p in [ logPath(self.directory, name),
+                           logPath(self.directory, name) + JSON_SUFFIX ]:
+                    open(p, 'w').close()
+            return self.streams[name]
+
+    def add(self, stream, text):
+        with self.lock:
+            stream.text += text
+            lines = (stream.line + text).split('\n')
+            stream.line = lines.pop()
+            stream.records.extend([ lineRecord(stream.name, l)
+                                    for l in lines ])
+            full = len(stream.text) >= FLUSH_SIZE
+        if full:
+            self.flushStream(stream)
+
+    def flushStream(self, stream, final=False):
+        # Append the whole lines waiting to be written to a log, and the
+        # rest too if it's final.
+        with self.lock:
+            if final:
+                n = len(stream.text)
+                if len(stream.line) > 0:
+                    stream.records.append(lineRecord(stream.name,
+                                                     stream.line))
+                    stream.line = ''
+            else:
+                n = stream.text.rfind('\n') + 1
+            text = stream.text[:n]
+            stream.text = stream.text[n:]
+            records = stream.records
+            stream.records = []
+            if len(text) > 0:
+                appendLocked(logPath(self.directory, stream.name), text)
+            if len(records) > 0:
+                appendLocked(logPath(self.directory, stream.name) +
+                             JSON_SUFFIX, ''.join(records))
+
+    def flush(self, final=False):
+        with self.lock:
+            streams = list(self.streams.values())
+        for s in streams:
+            try:
+                self.flushStream(s, final)
+            except (IOError, OSError) as e:
+                print('Unable to write the log', s.name + ':', e)
+
+    def flushLoop(self):
+        while not self.stopping.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def close(self):
+        # Write everything that's left, and stop writing in the background.
+        if self in openSinks:
+            openSinks.remove(self)
+        self.stopping.set()
+        self.flush(True)
+
+def flushLogs():
+    # Write everything left in the logs that are still open.
+    for s in list(openSinks):
+        s.close()
+
+atexit.register(flushLogs)
@@ -3,18 +3,24 @@ import sys
 import os
 import re
 import math
-from mirpy import miriad
-import numpy as np
 import shutil
 import glob
 from datetime import datetime, timedelta
 import calendar
 import time
 import subprocess
-import atca_calibrator_database as caldb
+import tempfile
+from cabb_pipeline_metadata import (readMetadata, writeMetadata,
+                                    observationPayload, restoreObservation)
+from cabb_pipeline_costmodel import recordTask
+from cabb_pipeline_parsers import (UvindexParser, UvsplitParser,
+                                   UvfstatsParser, MfbootParser, MfcalParser,
+                                   GpcalParser, GpbootParser, splitFrequency)
 
 # A collection of routines used by the system part of the
 # CABB pipeline. Users should not need to alter this file.
+# NumPy and the calibrator database are only loaded by the routines
+# that need them, so that starting the pipeline stays quick.
 
 # The following routines are algorithmic only: they don't print
 # output to the screen.
@@ -23,12 +29,10 @@ def lineFilter(output):
     # Filter output from a Miriad task line-by-line.
     return output.splitlines()
 
-def num(s):
-    # Try to turn some string into a number.
-    try:
-        return int(s)
-    except ValueError:
-        return float(s)
+def datasetDir(uvFile):
+    # The directory holding a dataset, which is where we run the Miriad
+    # tasks that work on it.
+    return os.path.dirname(os.path.abspath(uvFile))
 
 def frequencyArray(firstFreq, chanWidth, channels):
     # Turn an IF specification into an array of channel frequencies.
@@ -73,8 +77,39 @@ def characteriseIF(channels, firstFreq, chanWidth):
             rDict['zoomConfig'] = '64'
     return rDict
 
+def indexDatasets(progressDict):
+    # Make the maps from each dataset to its IF, and from each IF chain
+    # to its datasets.
+    progressDict['datasetIF'] = {}
+    progressDict['chains'] = {}
+    for f in progressDict['freqConfigs']:
+        fc = progressDict['freqConfigs'][f]
+        progressDict['chains'][f] = {}
+        for i in range(0, len(fc['dataset'])):
+            if fc['dataset'][i] != '':
+                progressDict['datasetIF'][fc['dataset'][i]] = [ f, i ]
+            c = str(fc['ifChain'][i])
+            if c not in progressDict['chains'][f]:
+                progressDict['chains'][f][c] = []
+            progressDict['chains'][f][c].append(fc['dataset'][i])
+    return progressDict
+
 def getIF(progressDict, dataset):
     # Return the IF this dataset is from.
+    if 'datasetIF' in progressDict:
+        if dataset not in progressDict['datasetIF']:
+            return None
+        (f, i) = progressDict['datasetIF'][dataset]
+        return {
+            'freqConfig': f,
+            'channels': progressDict['freqConfigs'][f]['channels'][i],
+            'firstFreq': progressDict['freqConfigs'][f]['firstFreq'][i],
+            'chanWidth': progressDict['freqConfigs'][f]['chanWidth'][i],
+            'restFreq': progressDict['freqConfigs'][f]['restFreq'][i],
+            'centerFreq': progressDict['freqConfigs'][f]['centreFreq'][i],
+            'chanFreqs': progressDict['freqConfigs'][f]['chanFreqs'][i],
+            'classification': progressDict['freqConfigs'][f]['classification'][i],
+            'ifChain': progressDict['freqConfigs'][f]['ifChain'][i] }
     for f in progressDict['freqConfigs']:
         for i in range(0, len(progressDict['freqConfigs'][f]['dataset'])):
             if dataset == progressDict['freqConfigs'][f]['dataset'][i]:
@@ -108,6 +143,8 @@ def frequencyBand(frequency):
 
 def chainDatasets(progressDict, freqConfig, ifChain):
     # Return an array of all the datasets in this IF chain.
+    if 'chains' in progressDict:
+        return list(progressDict['chains'][freqConfig].get(str(ifChain), []))
     rArr = []
     for i in range(0, len(progressDict['freqConfigs'][freqConfig]['ifChain'])):
         if progressDict['freqConfigs'][freqConfig]['ifChain'][i] == ifChain:
@@ -119,27 +156,141 @@ def interactiveMode():
     options = { 'no_atlod': True, 'no_split': True, 'no_flag': True,
                 'use_flags': 'original', 'no_user': False, 'keep_flags': False,
                 'no_casa': False, 'keep_reduction': False,
+                'parallel_load': False, 'load_processes': 0, 'plan': False,
+                'watch': None, 'watch_interval': 60, 'watch_settle': 120,
+                'watch_once': False, 'no_midweek': False,
+                'archive_catalogue': None, 'max_tasks': 1,
+                'limit_tasks': False, 'max_memory': 0,
+                'history': None, 'scratch': None, 'scratch_quota': 0,
+                'batch': None, 'batch_dir': '.', 'batch_jobs': 1,
+                'no_rfi_mask': False, 'rfi_masks': None,
+                'rfi_mask_version': None, 'no_solution_cache': False,
+                'solution_cache': None, 'no_vis_stats': False,
+                'no_plots': False, 'plot_processes': 0,
                 'verbose': True, 'quiet': False }
     return options
 
-def cmd_exists(cmd):
-    # Check for the command in the user's PATH.
-    return subprocess.call("type " + cmd, shell=True,
-                           stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0
+def miriadTask(task, workDir, **params):
+    # Run a Miriad task with its own working directory and return its
+    # output line-by-line. The parameters are named as for mirpy, so
+    # 'In' is used for the 'in' keyword. Nothing here depends on the
+    # working directory of the pipeline itself, so tasks can be run
+    # from several threads at once. The time each task takes is kept
+    # in the task history.
+    args = [ task ]
+    for k in params:
+        args.append(k.lower() + '=' + str(params[k]))
+    startTime = time.time()
+    p = subprocess.Popen(args, cwd=workDir, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    (out, err) = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError(task + ' failed: ' +
+                           err.decode('utf-8', 'replace'))
+    recordTask(task, workDir, params, time.time() - startTime)
+    return lineFilter(out.decode('utf-8', 'replace'))
+
+def miriadParse(task, workDir, parser, **params):
+    # Run a Miriad task like miriadTask, but hand each line of its
+    # output to a parser as soon as it arrives, and return what the
+    # parser made of it.
+    args = [ task ]
+    for k in params:
+        args.append(k.lower() + '=' + str(params[k]))
+    startTime = time.time()
+    with tempfile.TemporaryFile() as err:
+        p = subprocess.Popen(args, cwd=workDir, stdout=subprocess.PIPE,
+                             stderr=err)
+        for l in p.stdout:
+            parser.feed(l.decode('utf-8', 'replace').rstrip('\r\n'))
+        p.wait()
+        if p.returncode != 0:
+            err.seek(0)
+            raise RuntimeError(task + ' failed: ' +
+                               err.read().decode('utf-8', 'replace'))
+    recordTask(task, workDir, params, time.time() - startTime)
+    return parser.result
+
+# The commands we've already looked for.
+foundCommands = {}
 
-def findDataset(prefix):
-    # Find a dataset that starts with the prefix.
-    po = glob.glob(prefix + '.*')
+def cmd_exists(cmd):
+    # Check for the command in the user's PATH. The answer is kept, so
+    # a long-lived process only has to look once.
+    if cmd not in foundCommands:
+        foundCommands[cmd] = subprocess.call(
+            "type " + cmd, shell=True, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE) == 0
+    return foundCommands[cmd]
+
+def findDataset(prefix, directory='.'):
+    # Find a dataset in the directory that starts with the prefix.
+    meta = readMetadata(directory)
+    if meta is not None and 'sourceDatasets' in meta:
+        po = meta['sourceDatasets'].get(prefix, [])
+        if len(po) == 1:
+            return os.path.join(directory, po[0])
+        return None
+    po = glob.glob(os.path.join(directory, prefix + '.*'))
     if len(po) == 1:
         return po[0]
     # We shouldn't get in this situation if we've done things right.
     return None
 
+def miriadDataName(rpfitsFiles):
+    # Form the name of the Miriad output file from the first RPFITS input.
+    outEls = re.split(r'^(....-..-..).*\.(.*)$', os.path.basename(rpfitsFiles[0]))
+    return outEls[2] + '_' + outEls[1] + '.uv'
+
+def splitDatasetName(centreFreq, usedNames):
+    # The name uvsplit would give to the dataset for an IF with
+    # this centre frequency (GHz).
+    name = 'uvsplit.' + str(int(round(centreFreq * 1000)))
+    if name in usedNames:
+        # Two IFs at the same frequency; keep the frequency first so
+        # the name still matches in splitIFs.
+        n = 1
+        while (name + '.' + str(n)) in usedNames:
+            n += 1
+        name += '.' + str(n)
+    return name
+
+def uvindexParser():
+    # A parser for the output of uvindex.
+    return UvindexParser(frequencyArray, characteriseIF)
+
+def loadMetadata(miriadData):
+    # Get the description of an observation from the sidecar of its
+    # master dataset, or of its per-IF datasets if it was loaded that way.
+    meta = readMetadata(miriadData)
+    if meta is None:
+        return None
+    return restoreObservation(meta, frequencyArray)
+
+def recordMetadata(progressDict, options):
+    # Write the sidecars describing an observation and its datasets.
+    indexDatasets(progressDict)
+    payload = observationPayload(progressDict)
+    workDir = progressDict.get('workDir', '.')
+    master = os.path.join(workDir, progressDict['miriadData'])
+    if os.path.isdir(master):
+        writeMetadata(master, payload)
+    else:
+        writeMetadata(master, payload,
+                      [ os.path.join(d, 'visdata')
+                        for d in progressDict['datasets'] ])
+    for d in progressDict['datasets']:
+        writeMetadata(os.path.join(workDir, d), payload)
+    if options['verbose']:
+        print('Dataset metadata recorded.')
+    return True
+
 # The following routines are for process control and may print
 # output to the screen.
 
-def cabbLoad(rpfitsFiles, options):
-    # Load a set of RPFITS files into a Miriad data set.
+def cabbLoad(rpfitsFiles, options, workDir=None):
+    # Load a set of RPFITS files into a Miriad data set, in the working
+    # directory if none is given.
     if not options['quiet']:
         print('Loading RPFITS files...', ", ".join(rpfitsFiles))
     
@@ -149,9 +300,11 @@ def cabbLoad(rpfitsFiles, options):
             print('File', f, 'is not accessible.')
             sys.exit(0)
     # Form the name of the output file from the first input.
-    outEls = re.split('^(....-..-..).*\.(.*)$', rpfitsFiles[0])
     rDict = {}
-    rDict['miriadData'] = outEls[2] + '_' + outEls[1] + '.uv'
+    rDict['miriadData'] = miriadDataName(rpfitsFiles)
+    rDict['workDir'] = os.path.abspath(workDir if workDir is not None
+                                       else '.')
+    uvFile = os.path.join(rDict['workDir'], rDict['miriadData'])
     # Store the RPFITS files as a list as well.
     rDict['rpfitsFiles'] = rpfitsFiles
     # Check if this dataset exists, and remove it if it does.
@@ -159,100 +312,212 @@ def cabbLoad(rpfitsFiles, options):
         if options['verbose']:
             print("Not deleting exisiting data set.")
     else:
-        if os.path.isdir(rDict['miriadData']):
+        if os.path.isdir(uvFile):
             try:
-                shutil.rmtree(rDict['miriadData'])
+                shutil.rmtree(uvFile)
             except:
                 print('Cannot delete existing data file.')
                 sys.exit(0)
             
     # Run atlod.
-    miriad.set_filter('atlod', lineFilter)
     loadOptions = ['birdie', 'rfiflag', 'xycorr', 'noauto']
     if options['no_atlod']:
         if options['verbose']:
             print("Not performing load operation.")
     else:
-        r = miriad.atlod(In=",".join(rpfitsFiles), out=rDict['miriadData'],
-                         options=",".join(loadOptions))
-    rDict['sources'] = {}
+        r = miriadTask('atlod', rDict['workDir'],
+                       In=",".join([ os.path.abspath(f) for f in rpfitsFiles ]),
+                       out=rDict['miriadData'], options=",".join(loadOptions))
     if not options['quiet']:
         print('Loading complete.')
 
+    # Use what we recorded last time if the data hasn't changed.
+    if options['no_atlod']:
+        meta = loadMetadata(uvFile)
+        if meta is not None:
+            if not options['quiet']:
+                print('Using recorded sources and frequencies.')
+            rDict.update(meta)
+            if not options['no_split']:
+                # The split is going to be done again.
+                for fc in rDict['freqConfigs']:
+                    rDict['freqConfigs'][fc]['dataset'] = [
+                        '' for d in rDict['freqConfigs'][fc]['dataset'] ]
+                for k in [ 'datasets', 'datasetIF', 'chains' ]:
+                    del rDict[k]
+            else:
+                rDict['fromMetadata'] = True
+            return rDict
+
     # Get the sources and frequencies from running uvindex.
     if not options['quiet']:
         print('Compiling sources and frequencies...')
-    miriad.set_filter('uvindex', lineFilter)
-    ur = miriad.uvindex(vis=rDict['miriadData'])
-    cc = 0
-    cs = 0
-    rDict['freqConfigs'] = {}
-    for l in ur:
-        lsp = re.split('\s+', l)
-        if (len(lsp) == 8 and
-            re.search('^\d\d\D\D\D\d\d\:\d\d\:\d\d\:\d\d\.\d$', lsp[0]) is not None):
-            if lsp[1] not in rDict['sources']:
-                rDict['sources'][lsp[1]] = { 'freqConfig': [ lsp[6] ],
-                                             'startTime': [ lsp[0] ],
-                                             'calCode': [ lsp[2] ] }
-            else:
-                rDict['sources'][lsp[1]]['freqConfig'].append(lsp[6])
-                rDict['sources'][lsp[1]]['startTime'].append(lsp[0])
-                rDict['sources'][lsp[1]]['calCode'].append(lsp[2])
-        elif len(lsp) == 6:
-            if lsp[0] in rDict['sources']:
-                rDict['sources'][lsp[0]]['rightAscension'] = lsp[2]
-                rDict['sources'][lsp[0]]['declination'] = lsp[3]
-        elif lsp[0] == 'Frequency' and lsp[1] == 'Configuration':
-            cc = lsp[2]
-            cs = -1
-        elif cs == 1:
-            cs = -1
-        elif cs == -1:
-            centreFreq = (num(lsp[1]) - 1) / 2 * num(lsp[3]) + num(lsp[2])
-            sideband = 'USB'
-            if num(lsp[2]) > centreFreq:
-                sideband = 'LSB'
-            rDict['freqConfigs'][cc] = {
-                'channels': [ num(lsp[1]) ],
-                'firstFreq': [ num(lsp[2]) ],
-                'chanWidth': [ num(lsp[3]) ],
-                'restFreq': [ num(lsp[4]) ],
-                'centreFreq': [ centreFreq ],
-                'sideband': [ sideband ],
-                'dataset': [ '' ],
-                'chanFreqs': [ frequencyArray(lsp[2], lsp[3], lsp[1]) ],
-                'classification': [ characteriseIF(lsp[1], lsp[2], lsp[3]) ] }
-            if len(lsp) == 7:
-                # We have zooms here probably.
-                rDict['freqConfigs'][cc]['ifChain'] = [ num(lsp[6]) ]
-            else:
-                rDict['freqConfigs'][cc]['ifChain'] = [ 1 ]
-            cs = -2
-        elif cs == -2:
-            if len(lsp) == 1:
-                cs = 0
-            else:
-                centreFreq = (num(lsp[1]) - 1) / 2 * num(lsp[3]) + num(lsp[2])
-                sideband = 'USB'
-                if num(lsp[2]) > centreFreq:
-                    sideband = 'LSB'
-                rDict['freqConfigs'][cc]['channels'].append(num(lsp[1]))
-                rDict['freqConfigs'][cc]['firstFreq'].append(num(lsp[2]))
-                rDict['freqConfigs'][cc]['chanWidth'].append(num(lsp[3]))
-                rDict['freqConfigs'][cc]['restFreq'].append(num(lsp[4]))
-                rDict['freqConfigs'][cc]['centreFreq'].append(centreFreq)
-                rDict['freqConfigs'][cc]['sideband'].append(sideband)
-                rDict['freqConfigs'][cc]['dataset'].append('')
-                rDict['freqConfigs'][cc]['chanFreqs'].append(
-                    frequencyArray(lsp[2], lsp[3], lsp[1]))
-                rDict['freqConfigs'][cc]['classification'].append(
-                    characteriseIF(lsp[1], lsp[2], lsp[3]))
-                if len(lsp) == 7:
-                    rDict['freqConfigs'][cc]['ifChain'].append(num(lsp[6]))
-                else:
-                    nn = len(rDict['freqConfigs'][cc]['ifChain']) + 1
-                    rDict['freqConfigs'][cc]['ifChain'].append(nn)
+    (rDict['sources'], rDict['freqConfigs']) = miriadParse(
+        'uvindex', rDict['workDir'], uvindexParser(), vis=rDict['miriadData'])
+    if not options['quiet']:
+        print('Source and frequency compilation complete.')
+        print('Load process complete.')
+    return rDict
+
+def cabbParallelLoad(rpfitsFiles, options, workDir=None):
+    # Load a set of RPFITS files directly into per-IF Miriad datasets,
+    # running one atlod per IF concurrently. The datasets get the same
+    # names that splitIFs would give them, so no master file or uvsplit
+    # pass is needed.
+    if not options['quiet']:
+        print('Loading RPFITS files per IF...', ", ".join(rpfitsFiles))
+
+    # Check first that each RPFITS file is accessible to us.
+    for f in rpfitsFiles:
+        if not os.path.isfile(f):
+            print('File', f, 'is not accessible.')
+            sys.exit(0)
+    rDict = {}
+    # We keep the master name for the logs, even though that dataset
+    # is never made.
+    rDict['miriadData'] = miriadDataName(rpfitsFiles)
+    rDict['workDir'] = os.path.abspath(workDir if workDir is not None
+                                       else '.')
+    rDict['rpfitsFiles'] = rpfitsFiles
+    inFiles = ",".join([ os.path.abspath(f) for f in rpfitsFiles ])
+    planData = re.sub(r'\.uv$', '.plan.uv', rDict['miriadData'])
+
+    # Use what we recorded last time if the data hasn't changed.
+    if options['no_atlod']:
+        meta = loadMetadata(os.path.join(rDict['workDir'],
+                                         rDict['miriadData']))
+        if meta is not None:
+            if not options['quiet']:
+                print('Using recorded sources and frequencies.')
+            rDict.update(meta)
+            rDict['fromMetadata'] = True
+            return rDict
+
+    # Work out the IF layout from the RPFITS headers, or failing that,
+    # by loading only the first scan.
+    loadOptions = ['birdie', 'rfiflag', 'xycorr', 'noauto']
+    from cabb_pipeline_rpfits import scanRPFITSFiles
+    plan = scanRPFITSFiles(rpfitsFiles, options)
+    if plan is not None:
+        freqConfigs = plan['freqConfigs']
+        if len(freqConfigs) > 1:
+            # IF selection numbers IFs within each configuration, so
+            # a frequency change during the observation mixes them up.
+            if not options['quiet']:
+                print('Multiple frequency configurations found; reverting ' +
+                      'to a single load.')
+            return None
+    else:
+        if not options['no_atlod']:
+            if os.path.isdir(os.path.join(rDict['workDir'], planData)):
+                try:
+                    shutil.rmtree(os.path.join(rDict['workDir'], planData))
+                except:
+                    print('Cannot delete existing data file.')
+                    sys.exit(0)
+            r = miriadTask('atlod', rDict['workDir'], In=inFiles,
+                           out=planData, options=",".join(loadOptions),
+                           nscans='0,1')
+        if not uvPresent(os.path.join(rDict['workDir'], planData), options):
+            print('Unable to determine the IF layout.')
+            sys.exit(0)
+        (planSources, freqConfigs) = miriadParse(
+            'uvindex', rDict['workDir'], uvindexParser(), vis=planData)
+    fc = list(freqConfigs.keys())[0]
+
+    # Name the output of each IF.
+    ifSets = []
+    for i in range(0, len(freqConfigs[fc]['centreFreq'])):
+        freqConfigs[fc]['dataset'][i] = splitDatasetName(
+            freqConfigs[fc]['centreFreq'][i], freqConfigs[fc]['dataset'])
+        ifSets.append({ 'ifsel': str(i + 1),
+                        'dataset': freqConfigs[fc]['dataset'][i] })
+
+    # Don't start more loads than the node has room for.
+    from cabb_pipeline_resources import (makeController, estimateFootprint,
+                                         DEFAULT_BASELINES,
+                                         DEFAULT_POLARISATIONS)
+    controller = makeController(options, rDict['workDir'])
+    loadSize = None
+    if plan is not None:
+        from cabb_pipeline_rpfits import estimateLoadSize
+        loadSize = estimateLoadSize(plan)[fc]
+
+    def loadIF(s):
+        if os.path.isdir(os.path.join(rDict['workDir'], s['dataset'])):
+            shutil.rmtree(os.path.join(rDict['workDir'], s['dataset']))
+        i = int(s['ifsel']) - 1
+        fp = estimateFootprint('atlod', {
+            'channels': freqConfigs[fc]['channels'][i],
+            'baselines': DEFAULT_BASELINES,
+            'polarisations': DEFAULT_POLARISATIONS, 'records': 0,
+            'visBytes': loadSize[i] if loadSize is not None else 0 })
+        controller.acquire(fp)
+        try:
+            if options['verbose']:
+                print(' Loading IF', s['ifsel'], 'into', s['dataset'])
+            return miriadTask('atlod', rDict['workDir'], In=inFiles,
+                              out=s['dataset'], options=",".join(loadOptions),
+                              ifsel=s['ifsel'])
+        finally:
+            controller.release(fp)
+
+    if options['no_atlod']:
+        if options['verbose']:
+            print("Not performing load operation.")
+    else:
+        import multiprocessing
+        from multiprocessing.pool import ThreadPool
+        nproc = options['load_processes']
+        if nproc < 1:
+            nproc = multiprocessing.cpu_count()
+        # Start the loads that will take longest first.
+        if loadSize is not None:
+            from cabb_pipeline_costmodel import predictTask, bandName
+            for s in ifSets:
+                i = int(s['ifsel']) - 1
+                nchan = freqConfigs[fc]['channels'][i]
+                s['cost'] = predictTask('load', 'atlod', {
+                    'band': bandName(freqConfigs[fc]['centreFreq'][i]),
+                    'bandwidth': round(
+                        freqConfigs[fc]['classification'][i]['bandwidth'], 4),
+                    'channels': nchan,
+                    'records': int(loadSize[i] / (nchan * 8 + 100)),
+                    'visBytes': loadSize[i] })
+            ifSets.sort(key=lambda s: s['cost'], reverse=True)
+        pool = ThreadPool(min(nproc, len(ifSets)))
+        try:
+            pool.map(loadIF, ifSets, 1)
+        except Exception as e:
+            print('Parallel load failed:', e)
+            sys.exit(0)
+        finally:
+            pool.close()
+            pool.join()
+    if not options['quiet']:
+        print('Loading complete.')
+
+    # The sources come from the full time range of any one of the IFs.
+    if not options['quiet']:
+        print('Compiling sources and frequencies...')
+    if not uvPresent(os.path.join(rDict['workDir'], ifSets[0]['dataset']),
+                     options):
+        sys.exit(0)
+    (rDict['sources'], loadedConfigs) = miriadParse(
+        'uvindex', rDict['workDir'], uvindexParser(),
+        vis=ifSets[0]['dataset'])
+    if len(loadedConfigs) > 1:
+        # IF selection numbers IFs within each configuration, so
+        # a frequency change during the observation mixes them up.
+        if not options['quiet']:
+            print('Multiple frequency configurations found; reverting ' +
+                  'to a single load.')
+        for s in ifSets:
+            if os.path.isdir(os.path.join(rDict['workDir'], s['dataset'])):
+                shutil.rmtree(os.path.join(rDict['workDir'], s['dataset']))
+        return None
+    rDict['freqConfigs'] = freqConfigs
+    rDict['datasets'] = [ s['dataset'] for s in ifSets ]
     if not options['quiet']:
         print('Source and frequency compilation complete.')
         print('Load process complete.')
@@ -266,61 +531,62 @@ def uvPresent(uvFile, options):
         return False
     return True
 
-def chReductionDir(redDir, options):
-    # Try to change directory.
-    try:
-        os.chdir(redDir)
-    except:
-        if options['verbose']:
-            print('Unable to change directory to', redDir)
-        return False
-    return True
-
-
 def splitIFs(uvFile, freqConfigs, options):
-    # Split out the component IFs from the master Miriad uv file.
+    # Split out the component IFs from the master Miriad uv file, into
+    # the directory that holds it.
     if not options['quiet']:
         print('Splitting out IFs from dataset', uvFile)
+    workDir = datasetDir(uvFile)
+
+    # We may already know the datasets from the recorded metadata.
+    if options['no_split']:
+        dsets = [ d for c in freqConfigs for d in freqConfigs[c]['dataset']
+                  if d != '' ]
+        if (len(dsets) > 0 and
+            all(os.path.isdir(os.path.join(workDir, d)) for d in dsets)):
+            if not options['quiet']:
+                print('Dataset splitting complete.')
+            return dsets
 
     # Check that the file is accessible to us.
     if not uvPresent(uvFile, options):
         sys.exit(0)
 
     # Check that there are no uvsplit directories already,
-    # excluding MeasurementSets.
-    uvsplits = [f for f in glob.glob('uvsplit.*') if '.ms' not in f and
-                '.def' not in f]
+    # excluding MeasurementSets and the flagging kept for the datasets
+    # that were deleted to save space.
+    uvsplits = [os.path.basename(f)
+                for f in glob.glob(os.path.join(workDir, 'uvsplit.*'))
+                if '.ms' not in f and '.def' not in f and
+                not f.endswith('.cabbmeta') and
+                not f.endswith('.flagversions')]
     if len(uvsplits) > 0 and not options['no_split']:
         for u in uvsplits:
             # Delete this tree.
             try:
-                shutil.rmtree(u)
+                shutil.rmtree(os.path.join(workDir, u))
             except:
                 print('Cannot delete uvsplit set', u)
                 sys.exit(0)
 
     # Split the set now.
-    ur = []
     if options['no_split']:
-        ur = uvsplits
+        dsets = uvsplits
     else:
-        miriad.set_filter('uvsplit', lineFilter)
-        ur = miriad.uvsplit(vis=uvFile, options='nosource')
-    dsets = []
-    for l in ur:
-        lsp = re.split('\s+', l)
-        if options['no_split']:
-            lsp.insert(0, 'Creating')
-        if lsp[0] == 'Creating':
-            dsets.append(lsp[1])
-            p = re.split('^uvsplit.([^\.]+)', lsp[1])
-            # Search for the matching frequency config.
-            for c in freqConfigs:
-                for f in range(0, len(freqConfigs[c]['centreFreq'])):
-                    m = int(round(freqConfigs[c]['centreFreq'][f] * 1000))
-                    if m == int(p[1]) and freqConfigs[c]['dataset'][f] == '':
-                        freqConfigs[c]['dataset'][f] = lsp[1]
-                        break
+        dsets = miriadParse('uvsplit', workDir, UvsplitParser(),
+                            vis=os.path.abspath(uvFile), options='nosource')
+    # Index the IFs by the frequency uvsplit will name them with.
+    freqIndex = {}
+    for c in freqConfigs:
+        for f in range(0, len(freqConfigs[c]['centreFreq'])):
+            m = int(round(freqConfigs[c]['centreFreq'][f] * 1000))
+            freqIndex.setdefault(m, []).append((c, f))
+    for d in dsets:
+        # Find the matching frequency config.
+        for (c, f) in freqIndex.get(splitFrequency(d), []):
+            if freqConfigs[c]['dataset'][f] == '':
+                freqConfigs[c]['dataset'][f] = d
+                break
 
     if not options['quiet']:
         print('Dataset splitting complete.')
@@ -341,17 +607,10 @@ def flagStats(uvFile, options):
               'antenna': {},
               'channel': {} }
     # Flagging stats by the parameters.
-    miriad.set_filter('uvfstats', lineFilter)
     for mode in rDict:
-        fr = miriad.uvfstats(vis=uvFile, mode=mode)
-        cc = 0
-        for l in fr:
-            lsp = re.split('\s+', l)
-            if len(lsp) > 1 and re.match('---', lsp[1]) is not None:
-                cc = 1
-            elif len(lsp) == 3 and cc == 1:
-                rDict[mode][lsp[1]] = float(
-                    re.sub('%', '', lsp[2])) / 100.0
+        rDict[mode] = miriadParse('uvfstats', datasetDir(uvFile),
+                                  UvfstatsParser(),
+                                  vis=os.path.abspath(uvFile), mode=mode)
 
     if not options['quiet']:
         print('Flagging check complete.')
@@ -361,7 +620,7 @@ def copySet(uvFile, suffix, options):
     # Make a new uvFile that is a copy of the other file.
     if not options['quiet']:
         print('Making a copy of dataset', uvFile)
-    prefix = re.split('^(.*)\.uv$', uvFile)
+    prefix = re.split(r'^(.*)\.uv$', uvFile)
     destFile = prefix[1] + '.' + suffix + '.uv'
 
     # Check if the file is accessible to us.
@@ -449,6 +708,69 @@ def checkMiriadFlagTable(uvFile, suffix, options):
             print('Flag version table does not exist.')
         return False
 
+def chainWideband(progressDict, uvFile):
+    # The wide-band dataset in the same IF chain as a zoom dataset.
+    t = getIF(progressDict, uvFile)
+    if t is None:
+        return None
+    for d in chainDatasets(progressDict, t['freqConfig'], t['ifChain']):
+        w = getIF(progressDict, d)
+        if w is not None and w['classification']['bandType'] == 'wide':
+            return d
+    return None
+
+def propagateWideFlags(wideSet, zoomSet, progressDict, options):
+    # Flag the channels of a zoom dataset wherever the wide-band dataset
+    # in its IF chain is flagged at the same frequency, time, baseline
+    # and polarisation. This is much cheaper than flagging the zoom
+    # itself, and the flags are changed directly in the dataset.
+    import numpy as np
+    from cabb_pipeline_miriadio import (readRecords, matchRecords,
+                                        readFlagColumns, updateFlags)
+    if options['verbose']:
+        print('Copying the flags of dataset', wideSet, 'to', zoomSet)
+    w = getIF(progressDict, wideSet)
+    z = getIF(progressDict, zoomSet)
+    workDir = progressDict.get('workDir', '.')
+    wideSet = os.path.join(workDir, wideSet)
+    zoomSet = os.path.join(workDir, zoomSet)
+    if not uvPresent(wideSet, options) or not uvPresent(zoomSet, options):
+        return None
+
+    # The wide-band channel each zoom channel falls in.
+    zoomFreqs = np.array(z['chanFreqs'])
+    wideChan = np.rint((zoomFreqs - w['firstFreq']) /
+                       w['chanWidth']).astype(np.int64)
+    inside = np.nonzero((wideChan >= 0) & (wideChan < w['channels']))[0]
+    if len(inside) == 0:
+        if options['verbose']:
+            print('Zoom', zoomSet, 'is outside the band of', wideSet)
+        return 0
+    (used, usedIndex) = np.unique(wideChan[inside], return_inverse=True)
+
+    try:
+        wideRecords = readRecords(wideSet)
+        zoomRecords = readRecords(zoomSet)
+        recordMap = matchRecords(wideRecords, zoomRecords)
+        wideGood = readFlagColumns(wideSet, w['channels'],
+                                   len(wideRecords['time']), used)
+
+        def addFlags(first, good):
+            m = recordMap[first:(first + len(good))]
+            rows = np.nonzero(m >= 0)[0]
+            sel = np.ix_(rows, inside)
+            good[sel] &= wideGood[m[rows]][:, usedIndex.ravel()]
+            return good
+
+        changed = updateFlags(zoomSet, z['channels'], len(recordMap),
+                              addFlags)
+    except (IOError, OSError, ValueError) as e:
+        print('Unable to copy the flags of', wideSet, 'to', zoomSet + ':', e)
+        return None
+    if options['verbose']:
+        print('Flagged', changed, 'more channels in', zoomSet)
+    return changed
+
 def autoPgflag(uvFile, options):
     # Use the AOFlagger function in pgflag.
     if not options['quiet']:
@@ -462,12 +784,12 @@ def autoPgflag(uvFile, options):
     stokes = [ 'i,q,u,v', 'v,q,u,i', 'v,q,u', 'u,v,q' ]
     flagpar = [ '8,5,5,3,6,3', '10,2,2,3,7,3',
                 '8,2,2,3,6,3', '8,2,2,3,6,3' ]
-    miriad.set_filter('pgflag', lineFilter)
     for n in range(0, len(stokes)):
         if options['verbose']:
             print(' Stage', (n+1))
-        pr = miriad.pgflag(vis=uvFile, stokes=stokes[n], flagpar=flagpar[n],
-                           options='nodisp', command='<b')
+        pr = miriadTask('pgflag', datasetDir(uvFile),
+                        vis=os.path.abspath(uvFile), stokes=stokes[n],
+                        flagpar=flagpar[n], options='nodisp', command='<b')
 
     if not options['quiet']:
         print('Flagging complete.')
@@ -493,8 +815,8 @@ def uvToMeasurementSet(uvFile, options):
             print('Cannot delete MeasurementSet', msFile)
             sys.exit(0)
 
-    miriad.set_filter('uv2ms', lineFilter)
-    ur = miriad.uv2ms(vis=uvFile, ms=msFile)
+    ur = miriadTask('uv2ms', datasetDir(uvFile), vis=os.path.abspath(uvFile),
+                    ms=os.path.abspath(msFile))
 
     if not options['quiet']:
         print('Conversion complete.')
@@ -532,6 +854,7 @@ def summariseFile(progressDict, options):
 def midweekDetector(uvFile, options):
     # We try to detect if we have been affected by midweek RFI
     # and if so, when it started and stopped.
+    import numpy as np
     if not options['quiet']:
         print('Checking for midweek RFI.')
 
@@ -544,21 +867,16 @@ def midweekDetector(uvFile, options):
     if not uvPresent(uvFile, options):
         sys.exit(0)
         
-    miriad.set_filter('varplt', lineFilter)
-    # We output the data from varplt to a file.
-    outLog = 'varplt.xyamp.out'
-    if os.path.isfile(outLog):
-        # Try to delete it.
-        try:
-            os.remove(outLog)
-        except:
-            print('Cannot delete existing varplt log.')
-            sys.exit(0)
-    rv = miriad.varplt(vis=uvFile, device='/null', xaxis='time',
-                       yaxis='xyamp', log=outLog)
+    # We output the data from varplt to a file, in a directory of its
+    # own so that checks of several datasets cannot collide.
+    tmpDir = tempfile.mkdtemp(prefix='varplt.', dir=datasetDir(uvFile))
+    outLog = os.path.join(tmpDir, 'varplt.xyamp.out')
+    rv = miriadTask('varplt', tmpDir, vis=os.path.abspath(uvFile),
+                    device='/null', xaxis='time', yaxis='xyamp', log=outLog)
     # Check for the output file.
     if not os.path.isfile(outLog):
         print('Failed to make output for midweek RFI detection.')
+        shutil.rmtree(tmpDir, ignore_errors=True)
         sys.exit(0)
     logData = []
     with open(outLog) as ol:
@@ -583,6 +901,7 @@ def midweekDetector(uvFile, options):
                     startN = 2
                 for i in range(startN, len(els)):
                     logData[-1]['xyamp'].append(float(els[i]))
+    shutil.rmtree(tmpDir, ignore_errors=True)
 
     # Bin the data into 1 minute bins.
     binSizeSeconds = 60
@@ -593,8 +912,10 @@ def midweekDetector(uvFile, options):
     # The quantity we want is the variance of the xy amplitudes.
     amps = np.array([np.ptp(logData[i]['xyamp']) for i, b in enumerate(logData)])
     # We classify as possible midweek RFI if the variance is greater than 200.
-    tinc = np.array(
-        [(amps[digTimes == i].var() > 200) for i in range(1, len(timeBins) + 1)])
+    varianceLimit = 200
+    binVariance = np.array(
+        [amps[digTimes == i].var() for i in range(1, len(timeBins) + 1)])
+    tinc = binVariance > varianceLimit
     # And now extend the areas where midweek RFI may have been detected, such
     # that if we have detected midweek RFI within the previous 5 minutes,
     # and there is more midweek RFI within 5 minutes, we say it is still on.
@@ -634,7 +955,9 @@ def midweekDetector(uvFile, options):
 
     # Our return dictionary.
     rDict = {
-        'onTimes': onTimes, 'offTimes': offTimes, 'flagRegions': flagRegions
+        'onTimes': onTimes, 'offTimes': offTimes, 'flagRegions': flagRegions,
+        'binTimes': timeBins, 'binVariance': binVariance,
+        'varianceLimit': varianceLimit
         }
 
     if not options['quiet']:
@@ -657,9 +980,9 @@ def midweekFlagger(uvFile, timeRegions, options):
         sys.exit(0)
 
     # Run the uvflag task as required.
-    miriad.set_filter('uvflag', lineFilter)
     for i in range(0, len(timeRegions)):
-        rf = miriad.uvflag(vis=uvFile, flagval='flag',
+        rf = miriadTask('uvflag', datasetDir(uvFile),
+                        vis=os.path.abspath(uvFile), flagval='flag',
                            select='time(' + timeRegions[i]['start'] + ',' +
                            timeRegions[i]['stop'] + ')')
 
@@ -669,6 +992,7 @@ def midweekFlagger(uvFile, timeRegions, options):
 
 def determineCalibrators(progressDict, freqConfig, options):
     # Work out which calibrators are present and how to use them.
+    from atca_calibrator_database import getCalibrators
     if options['verbose']:
         print('Finding calibrators.')
 
@@ -769,7 +1093,8 @@ def determineCalibrators(progressDict, freqConfig, options):
         else:
             # Check whether this is a source in the ATCA calibrator
             # database.
-            if s in caldb.calibrators:
+            calibrators = getCalibrators()
+            if calibrators is not None and s in calibrators:
                 rDict['gain'].append(s)
 
     # We're finished.
@@ -778,21 +1103,26 @@ def determineCalibrators(progressDict, freqConfig, options):
     return rDict
 
 def deleteCalTables(sets, options):
-    # In the current directory, delete the calibration tables
-    # from sets matching the glob-compatible 'sets' argument.
-    tables = [ 'bandpass', 'gains', 'leakage', 'gainsf', 'leakagef' ]
-    miriad.set_filter('delhd', lineFilter)
+    # Delete the calibration tables from sets matching the
+    # glob-compatible 'sets' argument.
+    from cabb_pipeline_caltables import calTables, deleteCalibration
     success = True
-    for t in tables:
-        dfiles = glob.glob(sets + '/' + t)
-        for d in dfiles:
-            if options['verbose']:
-                print('Deleting calibration table', d)
-            dhr = miriad.delhd(In=d)
-            # Check it did actually get deleted.
-            if os.path.isfile(d):
+    for d in sorted(glob.glob(sets)):
+        if not os.path.isfile(os.path.join(d, 'header')):
+            continue
+        try:
+            deleted = deleteCalibration(d, calTables)
+        except (IOError, OSError) as e:
+            print('Unable to delete the calibration tables of', d + ':', e)
+            deleted = []
+        if options['verbose']:
+            for t in deleted:
+                print('Deleting calibration table', os.path.join(d, t))
+        # Check they did actually get deleted.
+        for t in calTables:
+            if os.path.isfile(os.path.join(d, t)):
                 if options['verbose']:
-                    print(' Delete failed!')
+                    print(' Delete of', os.path.join(d, t), 'failed!')
                 success = False
     return success
 
@@ -808,22 +1138,19 @@ def copyCalTables(origSet, destSet, copyOptions, options):
     if not uvPresent(destSet, options):
         sys.exit(0)
 
-    # Determine the options required.
-    optionList = []
-    if 'pol' in copyOptions and copyOptions['pol'] == False:
-        optionList.append('nopol')
-    if 'cal' in copyOptions and copyOptions['cal'] == False:
-        optionList.append('nocal')
-    if 'pass' in copyOptions and copyOptions['pass'] == False:
-        optionList.append('nopass')
-    optionString = ','.join(optionList)
-
-    # Run gpcopy.
-    miriad.set_filter('gpcopy', lineFilter)
-    if len(optionList) > 0:
-        gcr = miriad.gpcopy(vis=origSet, out=destSet, options=optionString)
-    else:
-        gcr = miriad.gpcopy(vis=origSet, out=destSet)
+    # Determine the tables required.
+    kinds = [ k for k in [ 'pol', 'cal', 'pass' ]
+              if k not in copyOptions or copyOptions[k] != False ]
+
+    # Copy them as gpcopy would.
+    from cabb_pipeline_caltables import copyCalibration
+    try:
+        copied = copyCalibration(origSet, destSet, kinds)
+    except (IOError, OSError) as e:
+        print('Unable to copy calibration tables to', destSet + ':', e)
+        sys.exit(0)
+    if options['verbose'] and len(copied) == 0:
+        print('No calibration tables to copy from', origSet)
 
     if options['verbose']:
         print('Calibration tables copied.')
@@ -841,17 +1168,16 @@ def correctBandpass(fluxCal, fluxSet, options):
         sys.exit(0)
 
     # Run mfboot.
-    miriad.set_filter('mfboot', lineFilter)
     specCorr = 1e6
     selString = 'source(' + fluxCal + ')'
     corrCount = 0
     while (math.fabs(specCorr) > 0.005 and corrCount < 5):
-        mbr = miriad.mfboot(vis=fluxSet, select=selString, device='/null')
+        r = miriadParse('mfboot', datasetDir(fluxSet), MfbootParser(),
+                        vis=os.path.abspath(fluxSet), select=selString,
+                        device='/null')
         corrCount += 1
-        for l in mbr:
-            lsp = re.split('\s+', l)
-            if lsp[0] == 'Adjusting':
-                specCorr = float(lsp[4])
+        if r is not None:
+            specCorr = r
 
     if options['verbose']:
         print('Bandpass correction complete.')
@@ -862,8 +1188,9 @@ def correctBandpass(fluxCal, fluxSet, options):
 
 def prepareReductionDir(uvFile, options):
     # Make a directory that can be used for the Miriad reduction
-    # of the specified uv dataset.
-    redDir = 'reduction.' + uvFile
+    # of the specified uv dataset, next to that dataset.
+    redDir = os.path.join(datasetDir(uvFile),
+                          'reduction.' + os.path.basename(uvFile))
     if options['verbose']:
         print('Preparing reduction directory', redDir)
 
@@ -891,22 +1218,20 @@ def prepareReductionDir(uvFile, options):
             print('Cannot make reduction directory', redDir)
             sys.exit(0)
 
-    # Change to the reduction directory and split out the
-    # uv dataset.
-    if not chReductionDir(redDir, options):
-        sys.exit(0)
-
     if not options['keep_reduction']:
-        # Split out the data.
-        bFile = '../' + uvFile
-        ur = miriad.uvsplit(vis=bFile)
+        # Split out the data into the reduction directory.
+        ur = miriadTask('uvsplit', redDir, vis=os.path.abspath(uvFile))
+        # Record which source is in which dataset, for findDataset.
+        sourceDatasets = {}
+        items = []
+        for d in sorted(os.listdir(redDir)):
+            if os.path.isfile(os.path.join(redDir, d, 'visdata')):
+                sourceDatasets.setdefault(d.split('.')[0], []).append(d)
+                items.append(os.path.join(d, 'visdata'))
+        writeMetadata(redDir, { 'sourceDatasets': sourceDatasets }, items)
     else:
         # Delete the calibration tables of any datasets here.
-        deleteCalTables('*', options)
-
-    # Go back to the lower directory.
-    if not chReductionDir('..', options):
-        sys.exit(0)
+        deleteCalTables(os.path.join(redDir, '*'), options)
 
     if options['verbose']:
         print('Reduction directory prepared.')
@@ -944,25 +1269,10 @@ def calibrateBandpass(calSet, refAnt, options):
         sys.exit(0)
 
     # Run mfcal.
-    miriad.set_filter('mfcal', lineFilter)
-    mfr = miriad.mfcal(vis=calSet, refant=refAnt, interval=0.1)
-    rDict = { 'converged': True,
-              'iterations': 0,
-              'fluxDensity': None }
-    # Check for conditions.
-    for l in mfr:
-        lsp = re.split('\s+', l)
-        if len(lsp) < 1:
-            continue
-        # Some possible matches.
-        a = re.match('Iter=(\d+)\,', lsp[0])
-        if lsp[0] == 'I' and lsp[1] == 'flux':
-            rDict['fluxDensity'] = float(lsp[3])
-        elif lsp[0] == '###' and lsp[2] == 'Failed' and lsp[4] == 'converge':
-            rDict['converged'] = False
-        elif a is not None:
-            rDict['iterations'] = int(a.group(1))
-            
+    rDict = miriadParse('mfcal', datasetDir(calSet), MfcalParser(),
+                        vis=os.path.abspath(calSet), refant=refAnt,
+                        interval=0.1)
+
     if options['verbose']:
         print('Bandpass calibration complete.')
     return rDict
@@ -986,28 +1296,101 @@ def calibrateGains(calSet, refAnt, calOptions, options):
     optStr = ','.join(optList)
 
     # Run gpcal.
-    miriad.set_filter('gpcal', lineFilter)
-    gcr = miriad.gpcal(vis=calSet, refant=refAnt, interval=0.1,
-                       options=optStr)
-    rDict = { 'converged': True,
-              'iterations': 0,
-              'fluxDensity': None,
-              'leakageSolved': False }
-    for l in gcr:
-        lsp = re.split('\s+', l)
-        if len(lsp) < 1:
-            continue
-        # Some possible matches.
-        a = re.match('Iter=\s*(\d+),', lsp[0])
-        if lsp[0] == 'I' and lsp[1] == 'flux':
-            rDict['fluxDensity'] = float(lsp[3])
-        elif lsp[0] == 'Leakage' and lsp[1] == 'terms:':
-            rDict['leakageSolved'] = True
-        elif a is not None:
-            rDict['iterations'] = int(a.group(1))
+    rDict = miriadParse('gpcal', datasetDir(calSet), GpcalParser(),
+                        vis=os.path.abspath(calSet), refant=refAnt,
+                        interval=0.1, options=optStr)
 
     if options['verbose']:
         print('Gain calibration complete.')
     return rDict
+
+def bootstrapGains(gainSet, fluxSet, options):
+    # Scale the gains of a gain calibrator to the flux density scale of
+    # the flux calibrator, and return the scaling factor.
+    if options['verbose']:
+        print('Bootstrapping the flux scale of', gainSet, 'from', fluxSet)
+
+    # Check we have access to both the datasets.
+    if not uvPresent(gainSet, options):
+        sys.exit(0)
+    if not uvPresent(fluxSet, options):
+        sys.exit(0)
+
+    # Run gpboot.
+    factor = miriadParse('gpboot', datasetDir(gainSet), GpbootParser(),
+                         vis=os.path.abspath(gainSet),
+                         cal=os.path.abspath(fluxSet))
+
+    if options['verbose']:
+        print('Bootstrapping complete.')
+    return factor
+
+def mergeGains(gainSet, mergeSet, options):
+    # Merge the gains of a gain calibrator into those of another.
+    if options['verbose']:
+        print('Merging the gains of', gainSet, 'into', mergeSet)
+
+    # Check we have access to both the datasets.
+    if not uvPresent(gainSet, options):
+        sys.exit(0)
+    if not uvPresent(mergeSet, options):
+        sys.exit(0)
+
+    # Run gpmerge.
+    gmr = miriadTask('gpmerge', datasetDir(mergeSet),
+                     vis=os.path.abspath(gainSet),
+                     out=os.path.abspath(mergeSet))
+
+    if options['verbose']:
+        print('Gains merged.')
+    return True
+
+def checkCalibration(calSet, options):
+    # Read the calibration tables of a dataset and check the solutions.
+    # Returns the checks and some lines describing them.
+    from cabb_pipeline_caltables import calibrationQA, summariseQA
+    if not uvPresent(calSet, options):
+        return (None, [])
+    try:
+        qa = calibrationQA(calSet)
+    except (IOError, OSError, ValueError) as e:
+        print('Unable to read the calibration tables of', calSet + ':', e)
+        return (None, [])
+    lines = summariseQA(qa)
+    if options['verbose']:
+        for l in lines:
+            print(l)
+    return (qa, lines)
+
+def visibilityStatistics(uvFile, options):
+    # Summarise the amplitudes of a dataset in one pass over its
+    # visibilities, keeping the spectra next to it. Returns the summary,
+    # or None if it couldn't be made.
+    # As many chunks are read at once as the tasks we're allowed to run
+    # (or CPUs, if that wasn't limited), as long as they fit in the
+    # memory the admission controller would give them.
+    from cabb_pipeline_visstats import (visibilityStats, writeStats,
+                                        statsSummary, chunkPlan)
+    from cabb_pipeline_resources import makeController
+    if not uvPresent(uvFile, options):
+        return None
+    workers = os.cpu_count() or 1
+    if options['limit_tasks']:
+        workers = options['max_tasks']
+    (workers, chunk) = chunkPlan(
+        makeController(options, datasetDir(uvFile)).memory, workers)
+    try:
+        stats = visibilityStats(uvFile, workers=workers, chunk=chunk)
+        if stats is None:
+            return None
+        path = writeStats(uvFile, stats)
+    except (IOError, OSError, ValueError) as e:
+        print('Unable to summarise the visibilities of', uvFile + ':', e)
+        return None
+    summary = statsSummary(stats)
+    summary['file'] = path
+    if options['verbose']:
+        print('Visibility statistics of', uvFile, 'written to', path)
+    return summary
     
     
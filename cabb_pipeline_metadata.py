@@ -0,0 +1,128 @@
+from __future__ import print_function
+import os
+import json
+import zlib
+import struct
+
+"""
+A metadata sidecar for Miriad datasets, so the pipeline does not have to
+run uvindex and search the filesystem every time it starts on data that
+has already been loaded.
+
+The sidecar is a small binary file. It starts with a list of the items
+it depends on, with their sizes and modification times, so that it can
+be checked against the dataset with a few stat calls before the rest is
+read. The rest is the compressed description of the observation: the
+header, source table, IF table and the dataset-to-IF map.
+"""
+
+MAGIC = b'CABBMETA'
+VERSION = 1
+SIDECAR_NAME = 'cabbmeta'
+
+# The items of a dataset that do not change after it has been made.
+# The flags and history are changed by flagging, and the header by
+# calibration, without changing what the sidecar describes.
+datasetItems = [ 'visdata', 'vartable' ]
+
+def sidecarPath(dataset):
+    # Where the sidecar for a dataset or directory lives.
+    if os.path.isdir(dataset):
+        return os.path.join(dataset, SIDECAR_NAME)
+    return dataset + '.' + SIDECAR_NAME
+
+def itemStats(baseDir, items):
+    # Get the size and modification time of each of the items.
+    stats = []
+    for i in items:
+        st = os.stat(os.path.join(baseDir, i))
+        stats.append((i, st.st_size, st.st_mtime))
+    return stats
+
+def writeMetadata(dataset, payload, items=None):
+    # Write a sidecar for a dataset (or a directory of datasets, or
+    # an observation, in which case the items should be given relative
+    # to the directory holding it).
+    path = sidecarPath(dataset)
+    baseDir = dataset if os.path.isdir(dataset) else os.path.dirname(path)
+    if items is None:
+        items = datasetItems
+    try:
+        stats = itemStats(baseDir, items)
+    except OSError:
+        # Not a complete dataset, so there is nothing to describe.
+        return False
+    out = [ MAGIC, struct.pack('>HH', VERSION, len(stats)) ]
+    for (name, size, mtime) in stats:
+        n = name.encode('utf-8')
+        out.append(struct.pack('>H', len(n)) + n +
+                   struct.pack('>Qd', size, mtime))
+    body = zlib.compress(json.dumps(payload).encode('utf-8'))
+    out.append(struct.pack('>I', len(body)))
+    out.append(body)
+    tmpPath = path + '.tmp'
+    try:
+        with open(tmpPath, 'wb') as f:
+            f.write(b''.join(out))
+        os.rename(tmpPath, path)
+    except (IOError, OSError):
+        return False
+    return True
+
+def readMetadata(dataset):
+    # Read the sidecar of a dataset, returning None if it is missing or
+    # no longer matches the dataset.
+    path = sidecarPath(dataset)
+    baseDir = dataset if os.path.isdir(dataset) else os.path.dirname(path)
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            (version, nitems) = struct.unpack('>HH', f.read(4))
+            if version != VERSION:
+                return None
+            for i in range(0, nitems):
+                (nl,) = struct.unpack('>H', f.read(2))
+                name = f.read(nl).decode('utf-8')
+                (size, mtime) = struct.unpack('>Qd', f.read(16))
+                st = os.stat(os.path.join(baseDir, name))
+                if st.st_size != size or st.st_mtime != mtime:
+                    return None
+            (bl,) = struct.unpack('>I', f.read(4))
+            return json.loads(zlib.decompress(f.read(bl)).decode('utf-8'))
+    except (IOError, OSError, struct.error, zlib.error, ValueError):
+        return None
+
+def observationPayload(progressDict):
+    # The description of an observation that is stored with each of its
+    # datasets. The channel frequencies are left out, as they can be
+    # made again from the rest of the IF table.
+    freqConfigs = {}
+    for fc in progressDict['freqConfigs']:
+        freqConfigs[fc] = {}
+        for k in progressDict['freqConfigs'][fc]:
+            if k != 'chanFreqs':
+                freqConfigs[fc][k] = progressDict['freqConfigs'][fc][k]
+    return { 'header': { 'miriadData': progressDict['miriadData'],
+                         'rpfitsFiles': progressDict['rpfitsFiles'] },
+             'sources': progressDict['sources'],
+             'freqConfigs': freqConfigs,
+             'datasets': progressDict['datasets'],
+             'datasetIF': progressDict['datasetIF'],
+             'chains': progressDict['chains'] }
+
+def restoreObservation(payload, frequencyArray):
+    # Turn a stored observation description back into the parts of the
+    # progress dictionary it came from.
+    rDict = { 'sources': payload['sources'],
+              'freqConfigs': payload['freqConfigs'],
+              'datasets': payload['datasets'],
+              'datasetIF': payload['datasetIF'],
+              'chains': payload['chains'] }
+    for fc in rDict['freqConfigs']:
+        sfc = rDict['freqConfigs'][fc]
+        sfc['chanFreqs'] = [ frequencyArray(sfc['firstFreq'][i],
+                                            sfc['chanWidth'][i],
+                                            sfc['channels'][i])
+                             for i in range(0, len(sfc['channels'])) ]
+    return rDict
@@ -0,0 +1,372 @@
+from __future__ import print_function
+import os
+import mmap
+import struct
+import shutil
+import tempfile
+import numpy as np
+
+"""
+Direct access to the parts of a Miriad uv dataset that the pipeline
+needs to read or change itself, without running a Miriad task.
+
+The uv variables are kept in the visdata item as a stream of entries,
+each with a 4 byte header: the index of the variable in the vartable
+item, a pad byte, the kind of entry and another pad byte. A size entry
+gives the length of a variable (bytes) in the following 4 bytes, a data
+entry is followed by the value of a variable, aligned to the size of its
+type, and an end-of-record entry closes each record. Every entry starts
+on an 8 byte boundary, and everything is big-endian. The spectrum of
+each record is the corr variable, as pairs of reals, or as pairs of 16
+bit integers to be multiplied by the tscale variable.
+
+The channel flags of each record are kept in the flags item, one bit
+per channel, with the records one after another. The bits are packed 31
+to each 4 byte integer, starting from the least significant bit, and
+the first integer is the header of the item. A set bit means the
+channel is good.
+
+Each item starts with 4 bytes giving the type of its data, which is
+then aligned to the size of that type. Small items, like the number of
+calibration solutions, are kept together in the header item instead of
+in their own files: each has 16 bytes with its name and the length of
+its data, then the data, padded to a multiple of 16 bytes. Items are
+changed by writing new files and renaming them over the old ones.
+"""
+
+# The kinds of entry in the visdata stream.
+VAR_SIZE = 0
+VAR_DATA = 1
+VAR_EOR = 2
+UV_ALIGN = 8
+UV_HDR_SIZE = 4
+
+# The size (bytes) of each type of uv variable, and how to unpack one.
+typeSizes = { 'a': 1, 'b': 1, 'j': 2, 'i': 4, 'r': 4, 'd': 8, 'c': 8,
+              'l': 8 }
+typeFormats = { 'j': '>h', 'i': '>i', 'r': '>f', 'd': '>d', 'l': '>q' }
+
+# The types of item data.
+H_BYTE = 1
+H_INT = 2
+H_INT2 = 3
+H_REAL = 4
+H_DBLE = 5
+H_TXT = 6
+H_CMPLX = 7
+H_INT8 = 8
+itemTypes = { H_INT: '>i4', H_INT2: '>i2', H_REAL: '>f4', H_DBLE: '>f8',
+              H_CMPLX: '>c8', H_INT8: '>i8' }
+HEADER_ALIGN = 16
+
+# The number of flags in each integer of the flags item.
+BITS_PER_INT = 31
+
+# Roughly how many flags to work on at once when changing them.
+CHUNK_BITS = 1 << 25
+
+def roundUp(offset, size):
+    return ((offset + size - 1) // size) * size
+
+def itemValue(data):
+    # The value of an item, from all its bytes: a string, a number, or
+    # an array of numbers.
+    if len(data) < 4:
+        return None
+    t = struct.unpack_from('>3xB', data)[0]
+    if t == H_BYTE or t == H_TXT:
+        return data[4:].decode('ascii', 'replace').rstrip('\0')
+    if t not in itemTypes:
+        raise IOError('Unrecognised item type ' + str(t))
+    dtype = np.dtype(itemTypes[t])
+    start = roundUp(4, min(dtype.itemsize, 8))
+    values = np.frombuffer(data[start:], dtype=dtype,
+                           count=(len(data) - start) // dtype.itemsize)
+    if len(values) == 1:
+        return values[0].item()
+    return values
+
+def headerEntries(uvFile):
+    # The small items of a dataset as a list of their names and bytes,
+    # in the order they are kept.
+    with open(os.path.join(uvFile, 'header'), 'rb') as f:
+        data = f.read()
+    entries = []
+    offset = 0
+    while offset + HEADER_ALIGN <= len(data):
+        name = data[offset:(offset + 15)].split(b'\0')[0].decode('ascii')
+        length = struct.unpack_from('>B', data, offset + 15)[0]
+        start = offset + HEADER_ALIGN
+        entries.append((name, data[start:(start + length)]))
+        offset = start + roundUp(length, HEADER_ALIGN)
+    return entries
+
+def readHeader(uvFile):
+    # The small items of a dataset, by name.
+    return dict([ (name, itemValue(data))
+                  for (name, data) in headerEntries(uvFile) ])
+
+def readItem(uvFile, name):
+    # All the bytes of an item, or None if the dataset doesn't have it.
+    path = os.path.join(uvFile, name)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+def stageFile(uvFile):
+    # A new file in a dataset, to be renamed over an item once it has
+    # been written.
+    (fd, path) = tempfile.mkstemp(prefix='.stage.', dir=uvFile)
+    os.close(fd)
+    if os.path.isfile(os.path.join(uvFile, 'header')):
+        shutil.copymode(os.path.join(uvFile, 'header'), path)
+    return path
+
+def stageHeader(uvFile, entries):
+    # Write the small items of a dataset to a new header, and return
+    # where it is.
+    path = stageFile(uvFile)
+    with open(path, 'wb') as f:
+        for (name, data) in entries:
+            f.write(name.encode('ascii')[:15].ljust(15, b'\0') +
+                    struct.pack('>B', len(data)))
+            f.write(data + b'\0' * (roundUp(len(data), HEADER_ALIGN) -
+                                    len(data)))
+    return path
+
+def copyItems(origSet, destSet, items, variables):
+    # Copy some items and header variables from one dataset to another,
+    # replacing any the other already has. Everything is written to new
+    # files first, which are then renamed over the old ones, so nothing
+    # ever sees an item half written.
+    staged = []
+    try:
+        for name in items:
+            path = stageFile(destSet)
+            staged.append((path, os.path.join(destSet, name)))
+            shutil.copyfile(os.path.join(origSet, name), path)
+        entries = headerEntries(destSet)
+        new = dict([ e for e in headerEntries(origSet) if e[0] in variables ])
+        names = [ e[0] for e in entries ]
+        entries = [ (n, new.get(n, d)) for (n, d) in entries ]
+        entries.extend([ (n, new[n]) for n in variables
+                         if n in new and n not in names ])
+        staged.append((stageHeader(destSet, entries),
+                       os.path.join(destSet, 'header')))
+    except:
+        for (path, dest) in staged:
+            os.remove(path)
+        raise
+    for (path, dest) in staged:
+        os.rename(path, dest)
+
+def deleteItems(uvFile, items):
+    # Delete some items from a dataset, and return the ones that were
+    # there to delete.
+    deleted = []
+    for name in items:
+        path = os.path.join(uvFile, name)
+        if os.path.isfile(path):
+            os.remove(path)
+            deleted.append(name)
+    return deleted
+
+def readVartable(uvFile):
+    # The names and types of the uv variables, in the order they are
+    # numbered in the visdata stream.
+    variables = []
+    with open(os.path.join(uvFile, 'vartable')) as f:
+        for l in f:
+            lsp = l.split()
+            if len(lsp) == 2:
+                variables.append((lsp[1], lsp[0]))
+    return variables
+
+def readRecords(uvFile, names=('time', 'baseline', 'pol')):
+    # The values some uv variables have in each record of a dataset.
+    # Variables the dataset doesn't have are 0 in every record.
+    return scanRecords(uvFile, names)[0]
+
+def locateRecords(uvFile, names=('baseline', 'pol', 'tscale'),
+                  data='corr'):
+    # The values of some uv variables in each record, and where the
+    # value of a data variable (usually the spectrum) is in the visdata
+    # item: its byte offset in each record, its length (bytes) in each
+    # record, and its type.
+    return scanRecords(uvFile, names, data)
+
+def scanRecords(uvFile, names, data=None):
+    # Go through the visdata stream once, keeping the values of some
+    # variables, and where a data variable is, in each record.
+    variables = readVartable(uvFile)
+    wanted = {}
+    dataIndex = None
+    for i in range(0, len(variables)):
+        if variables[i][0] in names:
+            wanted[i] = variables[i][0]
+        if variables[i][0] == data:
+            dataIndex = i
+    lengths = [ 0 ] * len(variables)
+    current = dict([ (n, 0) for n in names ])
+    values = dict([ (n, []) for n in names ])
+    dataOffset = 0
+    offsets = []
+    dataLengths = []
+    path = os.path.join(uvFile, 'visdata')
+    size = os.path.getsize(path)
+    if size > 0:
+        with open(path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                offset = 0
+                while offset + UV_HDR_SIZE <= size:
+                    (v, kind) = struct.unpack_from('>BxBx', m, offset)
+                    if kind == VAR_SIZE:
+                        lengths[v] = struct.unpack_from(
+                            '>i', m, offset + UV_HDR_SIZE)[0]
+                        offset += UV_ALIGN
+                    elif kind == VAR_DATA:
+                        t = variables[v][1]
+                        offset = roundUp(offset + UV_HDR_SIZE, typeSizes[t])
+                        if v in wanted:
+                            current[wanted[v]] = struct.unpack_from(
+                                typeFormats[t], m, offset)[0]
+                        elif v == dataIndex:
+                            dataOffset = offset
+                        offset = roundUp(offset + lengths[v], UV_ALIGN)
+                    elif kind == VAR_EOR:
+                        for n in names:
+                            values[n].append(current[n])
+                        if dataIndex is not None:
+                            offsets.append(dataOffset)
+                            dataLengths.append(lengths[dataIndex])
+                        offset += UV_ALIGN
+                    else:
+                        raise IOError('Unrecognised entry at byte ' +
+                                      str(offset) + ' of ' + path)
+            finally:
+                m.close()
+    values = dict([ (n, np.array(values[n])) for n in names ])
+    if data is None:
+        return (values, None, None, None)
+    return (values, np.array(offsets, dtype=np.int64),
+            np.array(dataLengths, dtype=np.int64),
+            None if dataIndex is None else variables[dataIndex][1])
+
+def readSpectra(uvFile, offsets, length, dtype, scale=None):
+    # The complex spectra, of length bytes each, at some offsets in the
+    # visdata item, as an array of (record, channel). Spectra kept as
+    # scaled integers are multiplied by their scale in each record.
+    with open(os.path.join(uvFile, 'visdata'), 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            raw = b''.join([ m[o:(o + length)] for o in offsets ])
+        finally:
+            m.close()
+    if dtype == 'j':
+        v = np.frombuffer(raw, dtype='>i2').astype(np.float32)
+    else:
+        v = np.frombuffer(raw, dtype='>f4').astype(np.float32)
+    v = v.view(np.complex64).reshape(len(offsets), -1)
+    if scale is not None:
+        v *= np.asarray(scale, dtype=np.float32)[:, None]
+    return v
+
+def matchRecords(reference, other):
+    # For each record of other, the index of the record in reference
+    # with the same values of the variables, or -1 if there isn't one.
+    names = sorted(reference.keys())
+    nRef = len(reference[names[0]])
+    nOther = len(other[names[0]])
+    if all(np.array_equal(reference[n], other[n]) for n in names):
+        # Datasets split from the same one have the same records.
+        return np.arange(nOther)
+    keys = np.empty(nRef + nOther,
+                    dtype=[ (n, np.result_type(reference[n], other[n]))
+                            for n in names ])
+    for n in names:
+        keys[n] = np.concatenate((reference[n], other[n]))
+    (unique, inverse) = np.unique(keys, return_inverse=True)
+    inverse = inverse.ravel()
+    table = np.full(len(unique), -1, dtype=np.int64)
+    # Reversed, so the first of any repeated records wins.
+    table[inverse[:nRef][::-1]] = np.arange(nRef)[::-1]
+    return table[inverse[nRef:]]
+
+def unpackFlags(words):
+    # The flags in some integers of the flags item.
+    b = np.unpackbits(words.astype('<u4').view(np.uint8), bitorder='little')
+    return b.reshape(-1, 32)[:, :BITS_PER_INT].ravel().astype(bool)
+
+def packFlags(flags):
+    # Pack flags into integers for the flags item.
+    n = roundUp(len(flags), BITS_PER_INT)
+    padded = np.zeros(n, dtype=np.uint8)
+    padded[:len(flags)] = flags
+    b = np.zeros((n // BITS_PER_INT, 32), dtype=np.uint8)
+    b[:, :BITS_PER_INT] = padded.reshape(-1, BITS_PER_INT)
+    return np.packbits(b, axis=1, bitorder='little').view('<u4').ravel()
+
+def flagWords(uvFile, mode='r'):
+    # The integers of the flags item, after its header.
+    path = os.path.join(uvFile, 'flags')
+    return np.memmap(path, dtype='>u4', mode=mode)[1:]
+
+def flagRecords(uvFile, nchan):
+    # The number of records of nchan channels in the flags item.
+    return len(flagWords(uvFile)) * BITS_PER_INT // nchan
+
+def readFlagBlock(uvFile, nchan, first, n, words=None):
+    # The flags of n records starting from the first, as an array of
+    # (record, channel) that is True where the data is good.
+    if words is None:
+        words = flagWords(uvFile)
+    w0 = first * nchan // BITS_PER_INT
+    w1 = ((first + n) * nchan + BITS_PER_INT - 1) // BITS_PER_INT
+    bits = unpackFlags(np.asarray(words[w0:w1]))
+    start = first * nchan - w0 * BITS_PER_INT
+    good = np.ones(n * nchan, dtype=bool)
+    have = min(n * nchan, len(bits) - start)
+    # Anything past the end of the item has never been flagged.
+    good[:have] = bits[start:(start + have)]
+    return good.reshape(n, nchan)
+
+def readFlagColumns(uvFile, nchan, nrec, channels):
+    # The flags of some channels in every record, as an array of
+    # (record, channel) that is True where the data is good.
+    words = flagWords(uvFile)
+    pos = (np.arange(nrec, dtype=np.int64)[:, None] * nchan +
+           np.asarray(channels, dtype=np.int64)[None, :])
+    inFile = pos // BITS_PER_INT < len(words)
+    # Anything past the end of the item has never been flagged.
+    good = np.ones(pos.shape, dtype=bool)
+    w = words[(pos // BITS_PER_INT)[inFile]]
+    good[inFile] = ((w >> (pos % BITS_PER_INT)[inFile].astype('>u4')) &
+                    1).astype(bool)
+    return good
+
+def updateFlags(uvFile, nchan, nrec, change):
+    # Change the flags of a dataset in place, a block of records at a
+    # time. change(first, good) is given the index of the first record
+    # in the block and its flags as (record, channel), and returns the
+    # new flags. Returns the number of flags that changed.
+    words = flagWords(uvFile, 'r+')
+    if (nrec * nchan + BITS_PER_INT - 1) // BITS_PER_INT > len(words):
+        raise IOError('The flags of ' + uvFile + ' are shorter than ' +
+                      str(nrec) + ' records')
+    # Blocks of a multiple of 31 records start on an integer boundary.
+    block = BITS_PER_INT * max(1, CHUNK_BITS // (BITS_PER_INT * nchan))
+    changed = 0
+    for first in range(0, nrec, block):
+        n = min(block, nrec - first)
+        w0 = first * nchan // BITS_PER_INT
+        w1 = (((first + n) * nchan + BITS_PER_INT - 1) // BITS_PER_INT)
+        bits = unpackFlags(words[w0:w1])
+        good = bits[:n * nchan].reshape(n, nchan)
+        new = change(first, good.copy())
+        changed += int(np.count_nonzero(good != new))
+        bits[:n * nchan] = new.ravel()
+        words[w0:w1] = packFlags(bits)[:w1 - w0]
+    words.flush()
+    return changed
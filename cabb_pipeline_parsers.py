@@ -0,0 +1,404 @@
+from __future__ import print_function
+import re
+import sys
+import time
+from optparse import OptionParser
+
+"""
+Parsers for the output of the Miriad tasks the pipeline reads: uvindex,
+uvsplit, uvfstats, mfboot, mfcal, gpcal and gpboot.
+
+Each parser is a generator that is sent the output one line at a time,
+as the task produces it, and keeps what it has found so far in the
+parser's result. All the patterns are compiled once, when this module is
+loaded. A parser can be fed from a running task:
+
+  result = miriadParse('uvfstats', workDir, UvfstatsParser(), vis=...)
+
+or from output that has already been collected:
+
+  result = UvfstatsParser().parse(lines)
+
+Run this file directly to check the parsers against sample outputs and
+to time them on large outputs, like the uvindex of a long observation.
+"""
+
+# The patterns used to pick the output apart.
+whitespace = re.compile(r'\s+')
+scanTime = re.compile(r'^\d\d\D\D\D\d\d\:\d\d\:\d\d\:\d\d\.\d$')
+splitName = re.compile(r'^uvsplit.([^\.]+)')
+mfcalIteration = re.compile(r'Iter=(\d+)\,')
+gpcalIteration = re.compile(r'Iter=\s*(\d+),')
+
+def num(s):
+    # Try to turn some string into a number.
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+def percentage(s):
+    # Turn a string like '12.5%' into a fraction.
+    return float(s.replace('%', '')) / 100.0
+
+def splitFrequency(name):
+    # The frequency (MHz) in the name of a dataset made by uvsplit.
+    return int(splitName.match(name).group(1))
+
+class LineParser(object):
+    # Feed the lines of a task's output to a grammar, which is a
+    # generator that takes the parser and keeps its findings in
+    # parser.result.
+    def __init__(self, grammar, *args):
+        self.result = None
+        self.consumer = grammar(self, *args)
+        next(self.consumer)
+
+    def feed(self, l):
+        self.consumer.send(l)
+
+    def parse(self, lines):
+        # Parse output that has already been collected.
+        for l in lines:
+            self.consumer.send(l)
+        return self.result
+
+# The grammars of each task.
+
+def uvindexGrammar(parser, frequencyArray, characteriseIF):
+    # The sources and frequency configurations in an observation.
+    sources = {}
+    freqConfigs = {}
+    parser.result = (sources, freqConfigs)
+    config = None
+    # Which of the IF lines of a configuration comes next: 'first',
+    # 'more', or None when we're not in a configuration.
+    expect = None
+
+    def addIF(fc, lsp):
+        channels = num(lsp[1])
+        firstFreq = num(lsp[2])
+        chanWidth = num(lsp[3])
+        centreFreq = (channels - 1) / 2 * chanWidth + firstFreq
+        fc['channels'].append(channels)
+        fc['firstFreq'].append(firstFreq)
+        fc['chanWidth'].append(chanWidth)
+        fc['restFreq'].append(num(lsp[4]))
+        fc['centreFreq'].append(centreFreq)
+        fc['sideband'].append('LSB' if firstFreq > centreFreq else 'USB')
+        fc['dataset'].append('')
+        fc['chanFreqs'].append(frequencyArray(lsp[2], lsp[3], lsp[1]))
+        fc['classification'].append(characteriseIF(lsp[1], lsp[2], lsp[3]))
+        if len(lsp) == 7:
+            # We have zooms here probably.
+            fc['ifChain'].append(num(lsp[6]))
+        else:
+            fc['ifChain'].append(len(fc['ifChain']) + 1)
+
+    while True:
+        l = yield
+        lsp = whitespace.split(l)
+        n = len(lsp)
+        if n == 8 and scanTime.match(lsp[0]) is not None:
+            # A scan.
+            s = sources.get(lsp[1])
+            if s is None:
+                sources[lsp[1]] = { 'freqConfig': [ lsp[6] ],
+                                    'startTime': [ lsp[0] ],
+                                    'calCode': [ lsp[2] ] }
+            else:
+                s['freqConfig'].append(lsp[6])
+                s['startTime'].append(lsp[0])
+                s['calCode'].append(lsp[2])
+        elif n == 6:
+            # A source position.
+            if lsp[0] in sources:
+                sources[lsp[0]]['rightAscension'] = lsp[2]
+                sources[lsp[0]]['declination'] = lsp[3]
+        elif n > 2 and lsp[0] == 'Frequency' and lsp[1] == 'Configuration':
+            config = lsp[2]
+            expect = 'first'
+        elif expect == 'first':
+            freqConfigs[config] = {
+                'channels': [], 'firstFreq': [], 'chanWidth': [],
+                'restFreq': [], 'centreFreq': [], 'sideband': [],
+                'dataset': [], 'chanFreqs': [], 'classification': [],
+                'ifChain': [] }
+            addIF(freqConfigs[config], lsp)
+            expect = 'more'
+        elif expect == 'more':
+            if n == 1:
+                expect = None
+            else:
+                addIF(freqConfigs[config], lsp)
+
+def uvsplitGrammar(parser):
+    # The datasets uvsplit made, in order.
+    parser.result = []
+    while True:
+        l = yield
+        if l.startswith('Creating'):
+            lsp = whitespace.split(l)
+            if lsp[0] == 'Creating':
+                parser.result.append(lsp[1])
+
+def uvfstatsGrammar(parser):
+    # The fraction flagged for each row of a uvfstats table.
+    parser.result = {}
+    # Nothing counts until the line under the table heading.
+    while True:
+        lsp = whitespace.split((yield))
+        if len(lsp) > 1 and lsp[1].startswith('---'):
+            break
+    while True:
+        lsp = whitespace.split((yield))
+        if len(lsp) == 3 and not lsp[1].startswith('---'):
+            parser.result[lsp[1]] = percentage(lsp[2])
+
+def mfbootGrammar(parser):
+    # The last adjustment mfboot made to the flux scale, or None if it
+    # didn't make one.
+    while True:
+        l = yield
+        if l.startswith('Adjusting'):
+            lsp = whitespace.split(l)
+            if lsp[0] == 'Adjusting':
+                parser.result = float(lsp[4])
+
+def mfcalGrammar(parser):
+    # Whether mfcal converged, how many iterations it took and the flux
+    # density it found.
+    parser.result = { 'converged': True, 'iterations': 0,
+                      'fluxDensity': None }
+    while True:
+        lsp = whitespace.split((yield))
+        a = mfcalIteration.match(lsp[0])
+        if a is not None:
+            parser.result['iterations'] = int(a.group(1))
+        elif lsp[0] == 'I' and len(lsp) > 3 and lsp[1] == 'flux':
+            parser.result['fluxDensity'] = float(lsp[3])
+        elif (lsp[0] == '###' and len(lsp) > 4 and lsp[2] == 'Failed' and
+              lsp[4] == 'converge'):
+            parser.result['converged'] = False
+
+def gpcalGrammar(parser):
+    # Whether gpcal converged, how many iterations it took, the flux
+    # density it found and whether it solved for the leakages.
+    parser.result = { 'converged': True, 'iterations': 0,
+                      'fluxDensity': None, 'leakageSolved': False }
+    while True:
+        lsp = whitespace.split((yield))
+        a = gpcalIteration.match(lsp[0])
+        if a is not None:
+            parser.result['iterations'] = int(a.group(1))
+        elif lsp[0] == 'I' and len(lsp) > 3 and lsp[1] == 'flux':
+            parser.result['fluxDensity'] = float(lsp[3])
+        elif lsp[0] == 'Leakage' and len(lsp) > 1 and lsp[1] == 'terms:':
+            parser.result['leakageSolved'] = True
+
+def gpbootGrammar(parser):
+    # The factor gpboot scaled the gains by, or None if it didn't say.
+    while True:
+        l = yield
+        if 'scaling factor' in l:
+            lsp = whitespace.split(l.strip())
+            parser.result = float(lsp[-1])
+
+# The parsers to hand to the routines that run the tasks.
+
+class UvindexParser(LineParser):
+    # The routines that describe each IF come from the caller, so this
+    # module doesn't depend on the rest of the pipeline.
+    def __init__(self, frequencyArray, characteriseIF):
+        LineParser.__init__(self, uvindexGrammar, frequencyArray,
+                            characteriseIF)
+
+class UvsplitParser(LineParser):
+    def __init__(self):
+        LineParser.__init__(self, uvsplitGrammar)
+
+class UvfstatsParser(LineParser):
+    def __init__(self):
+        LineParser.__init__(self, uvfstatsGrammar)
+
+class MfbootParser(LineParser):
+    def __init__(self):
+        LineParser.__init__(self, mfbootGrammar)
+
+class MfcalParser(LineParser):
+    def __init__(self):
+        LineParser.__init__(self, mfcalGrammar)
+
+class GpcalParser(LineParser):
+    def __init__(self):
+        LineParser.__init__(self, gpcalGrammar)
+
+class GpbootParser(LineParser):
+    def __init__(self):
+        LineParser.__init__(self, gpbootGrammar)
+
+# Sample outputs for checking the parsers, and ways to make large ones
+# for timing them.
+
+samples = {
+    'uvindex': [
+        'UVINDEX: version 1.0',
+        'Summary listing for data-set 2015-01-01_0000.C999.uv',
+        '',
+        '15JAN01:00:00:04.9 1934-638     C      6      4098      0      1 0',
+        '15JAN01:00:10:14.9 0823-500     C      6      4098      0      1 0',
+        '15JAN01:00:15:24.9 target       R      6      4098      0      1 0',
+        '15JAN01:00:45:34.9 0823-500     C      6      4098      0      1 0',
+        '',
+        'Frequency Configuration 1',
+        '    2049   4.57700   0.001000   0.00000   GHz   1',
+        '    2049   6.62500   0.001000   0.00000   GHz   2',
+        '    2049   5.50000   0.000001   0.00000   GHz   1',
+        '',
+        '1934-638     C    19:39:25.03  -63:42:45.6  0.0  0.0',
+        '0823-500     C    08:25:26.87  -50:10:38.5  0.0  0.0',
+        'target       R    08:00:00.00  -50:00:00.0  0.0  0.0' ],
+    'uvsplit': [
+        'UVSPLIT: version 1.0',
+        'Creating uvsplit.5577',
+        'Creating uvsplit.7625',
+        'Creating uvsplit.5500' ],
+    'uvfstats': [
+        'UVFSTATS: version 1.0',
+        '  Antenna  Percentage',
+        ' -------  ----------',
+        ' 1  12.50%',
+        ' 3  0.00%',
+        ' 6  100.00%' ],
+    'mfboot': [
+        'Adjusting flux scale by 1.200 (0.0791 dB)',
+        'Adjusting flux scale by 1.00 0.0010' ],
+    'mfcal': [
+        'MFCAL: version 1.0',
+        'Iter=1, Amplit/Phase Solution Error: 0.100',
+        'Iter=12, Amplit/Phase Solution Error: 0.001',
+        'I flux density: 14.95 Jy',
+        '### Warning: Failed to converge' ],
+    'gpcal': [
+        'GPCAL: version 1.0',
+        'Iter= 1, Amplit/Phase Solution Error: 0.100',
+        'Iter=7, Amplit/Phase Solution Error: 0.001',
+        'I flux density: 5.66 Jy',
+        'Leakage terms:' ],
+    'gpboot': [
+        'GPBOOT: version 1.0',
+        'Secondary flux density scaling factor is:   1.074' ] }
+
+def expectedSamples():
+    # What the parsers should make of the samples.
+    return {
+        'uvsplit': [ 'uvsplit.5577', 'uvsplit.7625', 'uvsplit.5500' ],
+        'uvfstats': { '1': 0.125, '3': 0.0, '6': 1.0 },
+        'mfboot': 1.0,
+        'mfcal': { 'converged': False, 'iterations': 12,
+                   'fluxDensity': 14.95 },
+        'gpcal': { 'converged': True, 'iterations': 7,
+                   'fluxDensity': 5.66, 'leakageSolved': True },
+        'gpboot': 1.074 }
+
+def checkUvindex(result):
+    # Check the parsed uvindex sample, returning a list of problems.
+    (sources, freqConfigs) = result
+    problems = []
+    if sorted(sources.keys()) != [ '0823-500', '1934-638', 'target' ]:
+        problems.append('wrong sources ' + str(sorted(sources.keys())))
+    elif (len(sources['0823-500']['startTime']) != 2 or
+          sources['0823-500']['rightAscension'] != '08:25:26.87' or
+          sources['target']['calCode'] != [ 'R' ]):
+        problems.append('wrong scans or positions')
+    fc = freqConfigs.get('1', None)
+    if fc is None:
+        problems.append('no frequency configuration')
+    elif (fc['channels'] != [ 2049, 2049, 2049 ] or
+          fc['ifChain'] != [ 1, 2, 1 ] or
+          [ round(f, 3) for f in fc['centreFreq'] ] != [ 5.601, 7.649, 5.501 ]
+          or fc['classification'][0]['bandType'] != 'wide' or
+          fc['classification'][2]['bandType'] != 'zoom'):
+        problems.append('wrong frequency configuration')
+    return problems
+
+def largeOutput(task, size):
+    # Make up a long output for a task, in the same form as the samples.
+    if task == 'uvindex':
+        names = [ 'source%03d' % s for s in range(0, 50) ]
+        lines = [ 'Summary listing for data-set large.uv', '' ]
+        for i in range(0, size):
+            lines.append('15JAN%02d:%02d:%02d:04.9 %-12s C  6  4098  0  %d 0'
+                         % (1 + i // 1440, (i // 60) % 24, i % 60,
+                            names[i % len(names)], 1 + i % 2))
+        for c in [ 1, 2 ]:
+            lines += [ '', 'Frequency Configuration %d' % c ]
+            for f in range(0, 18):
+                lines.append('    2049   %.5f   0.000001   0.00000   GHz   %d'
+                             % (4.5 + c + f * 0.01, 1 + f % 2))
+            lines.append('')
+        for n in names:
+            lines.append('%-12s C  08:25:26.87  -50:10:38.5  0.0  0.0' % n)
+        return lines
+    if task == 'uvfstats':
+        return ([ ' Channel  Percentage', ' -------  ----------' ] +
+                [ ' %d  %.2f%%' % (c, (c % 100) * 1.0)
+                  for c in range(1, size + 1) ])
+    if task == 'mfcal':
+        return [ 'Iter=%d, Amplit/Phase Solution Error: 0.001' % i
+                 for i in range(1, size + 1) ]
+    return []
+
+if __name__ == '__main__':
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--scans', type='int', default=20000,
+                      help='the number of scans in the timed uvindex ' +
+                      'output (default: 20000)')
+    parser.add_option('--channels', type='int', default=16385,
+                      help='the number of channels in the timed uvfstats ' +
+                      'output (default: 16385)')
+    parser.add_option('--repeats', type='int', default=5,
+                      help='the number of times to time each parser ' +
+                      '(default: 5)')
+    (options, args) = parser.parse_args()
+
+    from cabb_pipeline_main_modules import frequencyArray, characteriseIF
+    makers = { 'uvindex': lambda: UvindexParser(frequencyArray,
+                                                characteriseIF),
+               'uvsplit': UvsplitParser, 'uvfstats': UvfstatsParser,
+               'mfboot': MfbootParser, 'mfcal': MfcalParser,
+               'gpcal': GpcalParser, 'gpboot': GpbootParser }
+
+    # Check the parsers.
+    failed = False
+    expected = expectedSamples()
+    for task in sorted(samples):
+        result = makers[task]().parse(samples[task])
+        if task == 'uvindex':
+            problems = checkUvindex(result)
+        elif result != expected[task]:
+            problems = [ 'got ' + str(result) ]
+        else:
+            problems = []
+        if len(problems) > 0:
+            print(task + ':', "; ".join(problems))
+            failed = True
+        else:
+            print(task + ': ok')
+
+    # Time them.
+    for (task, size) in [ ('uvindex', options.scans),
+                          ('uvfstats', options.channels),
+                          ('mfcal', options.scans) ]:
+        lines = largeOutput(task, size)
+        times = []
+        for i in range(0, options.repeats):
+            start = time.time()
+            makers[task]().parse(lines)
+            times.append(time.time() - start)
+        times.sort()
+        t = times[len(times) // 2]
+        print('%s: %d lines in %.1f ms, %.0f lines/s' %
+              (task, len(lines), t * 1000.0, len(lines) / max(t, 1e-9)))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,352 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+"""
+Diagnostic plots of each dataset: where the automatic flagger found RFI
+(with the amplitude spectrum kept by the visibility statistics, if there
+is one), how much was flagged at each stage on each baseline and
+antenna, and the xy amplitude variance the midweek RFI detector works
+from.
+
+The pipeline only gathers what is to be plotted; the drawing is done by
+this file, run as a separate process with a pool of workers and a lower
+priority, so the reduction carries on while the plots are made. The
+plots are drawn straight to PNG files with the Agg backend, so no
+display is needed. Spectra with more channels than can be seen are cut
+down to the minimum and maximum of each block of channels before they
+are drawn, so a narrow spike still shows.
+"""
+
+PLOT_DIR = 'plots'
+PLOT_SUFFIX = '.png'
+PLOT_DPI = 100
+
+# The most blocks a spectrum is cut down to; each gives two points.
+ENVELOPE_BLOCKS = 2000
+
+# How long to wait for the plots at the end of the pipeline (s).
+PLOT_TIMEOUT = 600
+
+PLOT_NICENESS = 10
+
+# The stages of the flag statistics, in the order they happen.
+flagStages = [ ('loadFlagStats', 'load'), ('startFlagStats', 'start'),
+               ('midweekStats', 'midweek'), ('autoFlagStats', 'auto') ]
+
+def envelope(x, y, blocks=ENVELOPE_BLOCKS):
+    # Cut a spectrum down to the minimum and maximum of each block of
+    # channels, in channel order. Returns the x and y to draw.
+    import numpy as np
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(y) <= 2 * blocks:
+        return (x, y)
+    size = -(-len(y) // blocks)
+    nblock = -(-len(y) // size)
+    pad = nblock * size - len(y)
+    yb = np.concatenate([ y, np.full(pad, np.nan) ]).reshape(nblock, size)
+    xb = np.concatenate([ x, np.full(pad, np.nan) ]).reshape(nblock, size)
+    # Blank channels count as neither the minimum nor the maximum.
+    blank = np.isnan(yb)
+    lo = np.where(blank, np.inf, yb).argmin(axis=1)
+    hi = np.where(blank, -np.inf, yb).argmax(axis=1)
+    first = np.minimum(lo, hi)
+    last = np.maximum(lo, hi)
+    rows = np.arange(nblock)
+    ex = np.empty(2 * nblock)
+    ey = np.empty(2 * nblock)
+    ex[0::2] = xb[rows, first]
+    ex[1::2] = xb[rows, last]
+    ey[0::2] = yb[rows, first]
+    ey[1::2] = yb[rows, last]
+    return (ex, ey)
+
+# Gathering what is to be plotted.
+
+def channelFrequencies(progressDict, dataset):
+    # The frequency (GHz) of each channel of a dataset, or None.
+    for f in progressDict['freqConfigs']:
+        c = progressDict['freqConfigs'][f]
+        if dataset in c['dataset']:
+            return list(c['chanFreqs'][c['dataset'].index(dataset)])
+    return None
+
+def channelPercentages(stats):
+    # The percentage flagged in each channel, in channel order.
+    return [ stats['channel'][c] * 100.0 for c in
+             sorted(stats['channel'], key=int) ]
+
+def plotName(plotDir, dataset, kind):
+    return os.path.join(plotDir, dataset + '.' + kind + PLOT_SUFFIX)
+
+def plotJobs(progressDict, plotDir=PLOT_DIR):
+    # The plots to make of each dataset, described by plain values so
+    # they can be handed to another process.
+    jobs = []
+    for p in progressDict['datasets']:
+        if (p in progressDict.get('autoFlagStats', {}) and
+            p in progressDict.get('loadFlagStats', {})):
+            jobs.append({
+                'kind': 'occupancy', 'dataset': p,
+                'file': plotName(plotDir, p, 'occupancy'),
+                'freqs': channelFrequencies(progressDict, p),
+                'load': channelPercentages(progressDict['loadFlagStats'][p]),
+                'auto': channelPercentages(progressDict['autoFlagStats'][p]),
+                'stats': progressDict.get('visibilityStats', {}).get(
+                    p, {}).get('file', None) })
+        stages = [ (s, n) for (s, n) in flagStages
+                   if p in progressDict.get(s, {}) ]
+        if len(stages) > 0:
+            jobs.append({
+                'kind': 'flagging', 'dataset': p,
+                'file': plotName(plotDir, p, 'flagging'),
+                'stages': [ n for (s, n) in stages ],
+                'baseline': [ progressDict[s][p]['baseline']
+                              for (s, n) in stages ],
+                'antenna': [ progressDict[s][p]['antenna']
+                             for (s, n) in stages ] })
+        if p in progressDict.get('midweekRFI', {}):
+            m = progressDict['midweekRFI'][p]
+            if 'binTimes' not in m or len(m['binTimes']) == 0:
+                continue
+            jobs.append({
+                'kind': 'midweek', 'dataset': p,
+                'file': plotName(plotDir, p, 'midweek'),
+                'times': [ float(t) for t in m['binTimes'] ],
+                'variance': [ float(v) for v in m['binVariance'] ],
+                'limit': m['varianceLimit'],
+                'regions': [ [ float(m['onTimes'][i]),
+                               float(m['offTimes'][i]) ]
+                             for i in range(0, min(len(m['onTimes']),
+                                                   len(m['offTimes']))) ] })
+    return jobs
+
+# Drawing, in the plotting processes.
+
+def drawOccupancy(fig, job):
+    if job['freqs'] is not None and len(job['freqs']) == len(job['auto']):
+        x = job['freqs']
+        xlabel = 'Frequency (GHz)'
+    else:
+        x = range(1, len(job['auto']) + 1)
+        xlabel = 'Channel'
+    panels = 2 if job['stats'] is not None else 1
+    ax = fig.add_subplot(panels, 1, 1)
+    (ex, ey) = envelope(x, job['auto'])
+    ax.fill_between(ex, 0, ey, color='firebrick', linewidth=0,
+                    label='automatic')
+    (ex, ey) = envelope(x, job['load'])
+    ax.plot(ex, ey, color='black', linewidth=0.6, label='at load')
+    ax.set_ylim(0, 100)
+    ax.set_ylabel('Flagged (%)')
+    ax.legend(loc='upper right', fontsize='small')
+    ax.set_title(job['dataset'] + ': RFI occupancy')
+    if job['stats'] is not None:
+        from cabb_pipeline_visstats import readStatsFile, polNames
+        stats = readStatsFile(job['stats'])
+        ax.tick_params(labelbottom=False)
+        ax = fig.add_subplot(panels, 1, 2, sharex=ax)
+        if stats is not None and stats['channelMean'].shape[1] == len(x):
+            for i in range(0, len(stats['pols'])):
+                (ex, ey) = envelope(x, stats['channelMean'][i])
+                ax.plot(ex, ey, linewidth=0.6,
+                        label=polNames.get(int(stats['pols'][i]),
+                                           str(stats['pols'][i])))
+            ax.set_yscale('log')
+            ax.legend(loc='upper right', fontsize='small')
+        ax.set_ylabel('Mean amplitude')
+    ax.set_xlabel(xlabel)
+
+def drawFlagging(fig, job):
+    import numpy as np
+    for (i, k) in enumerate([ 'baseline', 'antenna' ]):
+        ax = fig.add_subplot(2, 1, i + 1)
+        names = sorted(set().union(*[ s.keys() for s in job[k] ]))
+        pos = np.arange(len(names))
+        width = 0.8 / len(job['stages'])
+        for (j, s) in enumerate(job['stages']):
+            ax.bar(pos + j * width, [ job[k][j].get(n, 0) * 100.0
+                                      for n in names ],
+                   width, align='edge', label=s)
+        ax.set_xticks(pos + 0.4)
+        ax.set_xticklabels(names, rotation=90 if len(names) > 10 else 0,
+                           fontsize='small')
+        ax.set_ylim(0, 100)
+        ax.set_ylabel('Flagged (%)')
+        ax.set_xlabel(k.capitalize())
+        if i == 0:
+            ax.set_title(job['dataset'] + ': flagging at each stage')
+            ax.legend(loc='upper right', fontsize='small', ncol=4)
+
+def drawMidweek(fig, job):
+    t0 = job['times'][0]
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot([ (t - t0) / 3600.0 for t in job['times'] ], job['variance'],
+            color='black', linewidth=0.8, drawstyle='steps-post')
+    ax.axhline(job['limit'], color='grey', linestyle='--')
+    for (on, off) in job['regions']:
+        ax.axvspan((on - t0) / 3600.0, (off - t0) / 3600.0,
+                   color='firebrick', alpha=0.3, linewidth=0)
+    ax.set_yscale('log')
+    ax.set_xlabel('Hours from ' + time.strftime('%Y-%m-%d %H:%M:%S UTC',
+                                                 time.gmtime(t0)))
+    ax.set_ylabel('Variance of xy amplitude')
+    ax.set_title(job['dataset'] + ': midweek RFI')
+
+drawers = { 'occupancy': drawOccupancy, 'flagging': drawFlagging,
+            'midweek': drawMidweek }
+
+def drawPlot(job):
+    # Draw one plot. Returns its file, and why it couldn't be made.
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    try:
+        fig = Figure(figsize=(10, 6))
+        FigureCanvasAgg(fig)
+        drawers[job['kind']](fig, job)
+        fig.tight_layout()
+        (fd, tmpPath) = tempfile.mkstemp(prefix='.plot.', suffix=PLOT_SUFFIX,
+                                         dir=os.path.dirname(job['file']))
+        os.close(fd)
+        fig.savefig(tmpPath, dpi=PLOT_DPI)
+        os.rename(tmpPath, job['file'])
+    except Exception as e:
+        return (job['file'], str(e))
+    return (job['file'], None)
+
+def drawPlots(jobs, processes=1):
+    # Draw the plots with a pool of processes.
+    if processes < 2 or len(jobs) < 2:
+        return [ drawPlot(j) for j in jobs ]
+    import multiprocessing
+    pool = multiprocessing.Pool(min(processes, len(jobs)))
+    try:
+        return pool.map(drawPlot, jobs, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+# Running the plotting process from the pipeline.
+
+class Plotter(object):
+    # The plotting process, started with the plots to make.
+    def __init__(self, jobs, plotDir, options):
+        self.options = options
+        self.jobs = jobs
+        self.plotDir = plotDir
+        if not os.path.isdir(plotDir):
+            os.makedirs(plotDir)
+        (fd, self.jobFile) = tempfile.mkstemp(prefix='.jobs.', suffix='.json',
+                                              dir=plotDir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(jobs, f)
+        self.resultFile = self.jobFile + '.done'
+        processes = options.get('plot_processes', 0)
+        if processes < 1:
+            processes = os.cpu_count() or 1
+        self.log = open(os.path.join(plotDir, 'plots.log'), 'w')
+        self.process = subprocess.Popen(
+            [ sys.executable, os.path.abspath(__file__), self.jobFile,
+              '--processes', str(processes), '--results', self.resultFile ],
+            stdout=self.log, stderr=subprocess.STDOUT)
+
+    def finish(self, timeout=PLOT_TIMEOUT):
+        # Wait for the plots, and return those made for each dataset.
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            print('The diagnostic plots took too long and were abandoned.')
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+        made = {}
+        try:
+            with open(self.resultFile) as f:
+                results = json.load(f)
+        except (IOError, OSError, ValueError):
+            results = []
+        for (j, r) in zip(self.jobs, results):
+            if r[1] is not None:
+                print('Unable to make the plot', r[0] + ':', r[1])
+                continue
+            made.setdefault(j['dataset'], []).append(r[0])
+        for f in [ self.jobFile, self.resultFile ]:
+            if os.path.exists(f):
+                os.remove(f)
+        if self.options['verbose']:
+            print('Made', sum([ len(made[d]) for d in made ]), 'of',
+                  len(self.jobs), 'diagnostic plots.')
+        return made
+
+def startPlotting(progressDict, options, plotDir=PLOT_DIR):
+    # Start making the plots of the datasets in the background.
+    jobs = plotJobs(progressDict, plotDir)
+    if len(jobs) == 0:
+        return None
+    try:
+        return Plotter(jobs, plotDir, options)
+    except (IOError, OSError) as e:
+        print('Unable to start making the diagnostic plots:', e)
+        return None
+
+def timeSpectrum(nchan):
+    # How long it takes to plot the occupancy of nchan channels.
+    import numpy as np
+    plotDir = tempfile.mkdtemp(prefix='cabb_pipeline_plots.')
+    rng = np.random.RandomState(1)
+    auto = np.clip(rng.normal(5.0, 2.0, nchan), 0, 100)
+    auto[rng.randint(0, nchan, 20)] = 100.0
+    job = { 'kind': 'occupancy', 'dataset': 'synthetic',
+            'file': os.path.join(plotDir, 'synthetic.occupancy.png'),
+            'freqs': list(np.linspace(1.1, 3.1, nchan)),
+            'load': list(np.zeros(nchan)), 'auto': list(auto),
+            'stats': None }
+    drawPlot(job)
+    start = time.time()
+    r = drawPlot(job)
+    elapsed = time.time() - start
+    os.remove(job['file'])
+    os.rmdir(plotDir)
+    return (elapsed, r[1])
+
+if __name__ == '__main__':
+    usage = "usage: %prog [options] job-file"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--processes', type='int', default=1,
+                      help='the number of plots to draw at once')
+    parser.add_option('--results', metavar='FILE',
+                      help='write what was made to FILE')
+    parser.add_option('--time', type='int', metavar='NCHAN',
+                      help='report how long an occupancy plot of NCHAN ' +
+                      'channels takes, and exit')
+    (options, args) = parser.parse_args()
+
+    if options.time is not None:
+        (elapsed, error) = timeSpectrum(options.time)
+        if error is not None:
+            print('Unable to make the plot:', error)
+            sys.exit(1)
+        print('%d channels plotted in %.3f s' % (options.time, elapsed))
+        sys.exit(0)
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(0)
+    if hasattr(os, 'nice'):
+        os.nice(PLOT_NICENESS)
+    with open(args[0]) as f:
+        jobs = json.load(f)
+    results = drawPlots(jobs, options.processes)
+    for (plot, error) in results:
+        if error is None:
+            print('Made', plot)
+        else:
+            print('Unable to make', plot + ':', error)
+    if options.results is not None:
+        with open(options.results, 'w') as f:
+            json.dump(results, f)
@@ -0,0 +1,304 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+from optparse import OptionParser
+
+"""
+A record of the intermediate products the pipeline makes that can be
+made again, and a quota on the space used by the working directory.
+
+Each regenerable product is registered with the recipe that makes it
+and what it is made from: the master dataset from the RPFITS files, a
+split dataset from the master dataset, a MeasurementSet from its
+dataset, and a reduction directory from its dataset. When the working
+directory goes over its quota, the products that were used least
+recently are deleted until it fits again. If a later stage wants a
+product that was deleted, ensure() makes it again first, after making
+anything it needs (like the master dataset of a split dataset) again.
+
+The flagging of a split dataset can't be made again by splitting, so
+before one is deleted its flag table and flag versions are kept beside
+it, in <dataset>.flagversions, and they are put back when it has been
+split again. The final products (a MeasurementSet, or a reduction
+directory once calibration has started in it) are never deleted before
+a copy of them has been written back to the run directory, since a
+recipe can only make them as they were before the pipeline worked on
+them.
+
+The record is kept in products.json in the working directory. Run this
+file directly to list the products of a run, or to bring one back.
+"""
+
+REGISTRY_NAME = 'products.json'
+FLAG_KEEP_SUFFIX = '.flagversions'
+GB = 1024 * 1024 * 1024
+
+def pathSize(path):
+    # The space used by a file or directory (bytes).
+    if not os.path.isdir(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+    total = 0
+    for (d, dirs, files) in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(d, f))
+            except OSError:
+                pass
+    return total
+
+def removeProduct(path):
+    # Delete a product, whether it's a file or a directory.
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+# How to make each kind of product again. Each is given the working
+# directory, the arguments it was registered with and the options.
+
+def regenerateLoad(workDir, args, options):
+    from cabb_pipeline_main_modules import cabbLoad
+    loadOptions = dict(options)
+    loadOptions['no_atlod'] = False
+    cabbLoad(args['rpfitsFiles'], loadOptions, workDir)
+
+def regenerateSplit(workDir, args, options):
+    # Split the master dataset again, somewhere out of the way, keep
+    # only the dataset we want, and put its flagging back.
+    import tempfile
+    from cabb_pipeline_main_modules import miriadParse
+    from cabb_pipeline_parsers import UvsplitParser
+    splitDir = tempfile.mkdtemp(prefix='resplit.', dir=workDir)
+    try:
+        dsets = miriadParse('uvsplit', splitDir, UvsplitParser(),
+                            vis=os.path.join(workDir, args['miriadData']),
+                            options='nosource')
+        if args['dataset'] not in dsets:
+            print('Splitting', args['miriadData'], 'did not make',
+                  args['dataset'])
+            sys.exit(0)
+        os.rename(os.path.join(splitDir, args['dataset']),
+                  os.path.join(workDir, args['dataset']))
+    finally:
+        shutil.rmtree(splitDir)
+    restoreSplitFlags(workDir, args['dataset'])
+
+def keepSplitFlags(workDir, name):
+    # Keep the flag table and flag versions of a split dataset that is
+    # about to be deleted.
+    keepDir = os.path.join(workDir, name + FLAG_KEEP_SUFFIX)
+    if os.path.isdir(keepDir):
+        shutil.rmtree(keepDir)
+    os.mkdir(keepDir)
+    for f in os.listdir(os.path.join(workDir, name)):
+        if f == 'flags' or f.startswith('flags.'):
+            shutil.copyfile(os.path.join(workDir, name, f),
+                            os.path.join(keepDir, f))
+
+def restoreSplitFlags(workDir, name):
+    # Put back the flagging of a split dataset that was made again.
+    keepDir = os.path.join(workDir, name + FLAG_KEEP_SUFFIX)
+    if not os.path.isdir(keepDir):
+        return
+    for f in os.listdir(keepDir):
+        shutil.copyfile(os.path.join(keepDir, f),
+                        os.path.join(workDir, name, f))
+    shutil.rmtree(keepDir)
+
+def regenerateMeasurementSet(workDir, args, options):
+    from cabb_pipeline_main_modules import uvToMeasurementSet
+    uvToMeasurementSet(os.path.join(workDir, args['dataset']), options)
+
+def regenerateReduction(workDir, args, options):
+    from cabb_pipeline_main_modules import prepareReductionDir
+    redOptions = dict(options)
+    redOptions['keep_reduction'] = False
+    prepareReductionDir(os.path.join(workDir, args['dataset']), redOptions)
+
+recipes = { 'load': regenerateLoad,
+            'uvsplit': regenerateSplit,
+            'uv2ms': regenerateMeasurementSet,
+            'reduction': regenerateReduction }
+
+# What has to be kept of each kind of product before it is deleted.
+keepers = { 'uvsplit': keepSplitFlags }
+
+class ProductManager(object):
+    # Keep track of the regenerable products in a working directory, and
+    # keep the directory within its quota.
+    def __init__(self, workDir, quota, options, isBusy=None, isSaved=None):
+        self.workDir = os.path.abspath(workDir)
+        self.quota = quota
+        self.options = options
+        # Something that can tell us a product is still being used by
+        # something else (like being written back) and can't go yet.
+        self.isBusy = isBusy
+        # Something that can tell us a product has been copied somewhere
+        # safe, so a final product can go.
+        self.isSaved = isSaved
+        self.path = os.path.join(self.workDir, REGISTRY_NAME)
+        self.products = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.products = json.load(f)
+        # How many times each product has been pinned.
+        self.pinned = {}
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.products, f)
+        os.rename(self.path + '.tmp', self.path)
+
+    def register(self, name, recipe, final=False, needs=(), **args):
+        # Note that a product has been made, how to make it again, and
+        # the other products it would be made from.
+        self.products[name] = { 'recipe': recipe, 'args': args,
+                                'final': final, 'needs': list(needs),
+                                'lastUsed': time.time(), 'evicted': False,
+                                'size': pathSize(os.path.join(self.workDir,
+                                                              name)) }
+        self.save()
+        return self.enforce()
+
+    def touch(self, name):
+        # Note that a product has just been used.
+        if name in self.products:
+            self.products[name]['lastUsed'] = time.time()
+            self.save()
+
+    def markFinal(self, name):
+        # Note that a product can no longer be made again by its recipe.
+        if name in self.products:
+            self.products[name]['final'] = True
+            self.save()
+
+    def pin(self, name):
+        # Keep a product until it is unpinned, whatever the quota.
+        self.pinned[name] = self.pinned.get(name, 0) + 1
+
+    def unpin(self, name):
+        if self.pinned.get(name, 0) > 1:
+            self.pinned[name] -= 1
+        else:
+            self.pinned.pop(name, None)
+
+    def ensure(self, name):
+        # Make sure a product is there, making it again if it was
+        # deleted. Returns False if it isn't one we know how to make.
+        if name not in self.products:
+            return os.path.exists(os.path.join(self.workDir, name))
+        p = self.products[name]
+        if p['evicted'] or not os.path.exists(os.path.join(self.workDir,
+                                                           name)):
+            if p.get('final', False):
+                # Only its copy in the run directory is left.
+                print('Product', name, 'can not be made again.')
+                return False
+            pinned = [ name ]
+            self.pin(name)
+            try:
+                for n in p.get('needs', []):
+                    # Pinned first, so making it doesn't delete it again.
+                    self.pin(n)
+                    pinned.append(n)
+                    if not self.ensure(n):
+                        print('Product', name, 'can not be made again ' +
+                              'without', n)
+                        return False
+                if not self.options['quiet']:
+                    print('Making', name, 'again.')
+                recipes[p['recipe']](self.workDir, p['args'], self.options)
+            finally:
+                for n in pinned:
+                    self.unpin(n)
+            p['evicted'] = False
+            p['size'] = pathSize(os.path.join(self.workDir, name))
+        p['lastUsed'] = time.time()
+        self.save()
+        # Whatever else has to go, this is wanted now.
+        self.pin(name)
+        self.enforce()
+        self.unpin(name)
+        return True
+
+    def byRecipe(self, recipe):
+        # The products made by a recipe.
+        return sorted([ n for n in self.products
+                        if self.products[n]['recipe'] == recipe ])
+
+    def usage(self):
+        # The space used by the working directory.
+        return pathSize(self.workDir)
+
+    def evictable(self):
+        # The products that could be deleted, least recently used first.
+        names = [ n for n in self.products
+                  if not self.products[n]['evicted'] and
+                  n not in self.pinned and
+                  (self.isBusy is None or not self.isBusy(n)) and
+                  (not self.products[n].get('final', False) or
+                   (self.isSaved is not None and self.isSaved(n))) and
+                  os.path.exists(os.path.join(self.workDir, n)) ]
+        return sorted(names, key=lambda n: self.products[n]['lastUsed'])
+
+    def enforce(self):
+        # Delete products until the working directory fits its quota.
+        if self.quota is None or self.quota <= 0:
+            return True
+        used = self.usage()
+        if used <= self.quota:
+            return True
+        for name in self.evictable():
+            if used <= self.quota:
+                break
+            size = pathSize(os.path.join(self.workDir, name))
+            if self.options['verbose']:
+                print('Deleting', name, 'to free %.1f GB' % (size / GB))
+            if self.products[name]['recipe'] in keepers:
+                keepers[self.products[name]['recipe']](self.workDir, name)
+            removeProduct(os.path.join(self.workDir, name))
+            self.products[name]['evicted'] = True
+            self.products[name]['size'] = size
+            used -= size
+        self.save()
+        if used > self.quota and not self.options['quiet']:
+            print('Working directory is over its quota by %.1f GB' %
+                  ((used - self.quota) / GB))
+        return used <= self.quota
+
+def makeProductManager(options, workDir='.', isBusy=None, isSaved=None):
+    # Make the product manager the options ask for.
+    quota = None
+    if options.get('scratch_quota', 0) > 0:
+        quota = int(options['scratch_quota'] * GB)
+    return ProductManager(workDir, quota, options, isBusy, isSaved)
+
+if __name__ == '__main__':
+    usage = "usage: %prog [options] [directory]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--ensure', metavar='NAME',
+                      help='make the product NAME again if it was deleted')
+    parser.add_option('-v', '--verbose', action='store_true')
+    (options, args) = parser.parse_args()
+    workDir = args[0] if len(args) > 0 else '.'
+    from cabb_pipeline_main_modules import interactiveMode
+    ioptions = interactiveMode()
+    ioptions['verbose'] = options.verbose
+    pm = ProductManager(workDir, None, ioptions)
+    if options.ensure is not None:
+        if not pm.ensure(options.ensure):
+            print('Unknown product', options.ensure)
+            sys.exit(1)
+    for n in sorted(pm.products):
+        p = pm.products[n]
+        print(n, p['recipe'] + (' (final)' if p.get('final', False) else ''),
+              'deleted' if p['evicted'] else 'present',
+              '%.1f GB' % (p['size'] / GB),
+              time.strftime('%Y-%m-%d %H:%M:%S',
+                            time.localtime(p['lastUsed'])))
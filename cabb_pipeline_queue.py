@@ -0,0 +1,631 @@
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import errno
+import time
+import socket
+import threading
+from optparse import OptionParser
+
+"""
+A job queue kept on a shared filesystem, so the reduction of many
+observations can be spread over any number of worker processes on any
+number of hosts, with no server to run.
+
+Each observation starts as a single load task. When it has been loaded,
+it adds a task for each of its IFs and stages: midweek RFI detection for
+the wide 16cm IF chains, flagging and flag statistics for every IF, and
+conversion to a MeasurementSet. Tasks can depend on others, and are
+only started when everything they depend on is done.
+
+The queue is a directory:
+  tasks/    one JSON file describing each task
+  locks/    a lock file for each task that a worker has claimed
+  attempts/ a file for each time a task has been started
+  done/     the results of each finished task
+  failed/   the last error of each task that ran out of attempts
+A worker claims a task by making its lock file, which only one worker
+can do. While it runs the task it keeps touching the lock file; if it
+stops (because its host died, say) the lock expires after the lease
+time and another worker can take the task over. The worker that breaks
+an expired lock checks that what it moved aside is still the stale lock
+it judged expired, and puts it back if not. A task that fails or
+expires is tried again, up to a limit.
+
+Run this file directly to add observations, run workers or show the
+state of a queue; for example, on each of several hosts:
+  python cabb_pipeline_queue.py worker /shared/queue
+and "check" runs several workers on a scratch queue of stand-in tasks,
+to make sure each task runs exactly once.
+"""
+
+QUEUE_DIRS = [ 'tasks', 'locks', 'attempts', 'done', 'failed' ]
+
+def initQueue(queueDir):
+    # Make the queue directories if they aren't already there.
+    for d in QUEUE_DIRS:
+        p = os.path.join(queueDir, d)
+        if not os.path.isdir(p):
+            try:
+                os.makedirs(p)
+            except OSError:
+                # Another process got there first.
+                if not os.path.isdir(p):
+                    raise
+    return queueDir
+
+def taskId(*parts):
+    # A task name that is safe to use as a file name.
+    return re.sub('[^A-Za-z0-9_.+-]', '_', '.'.join([ str(p) for p in parts ]))
+
+def writeJSON(path, data):
+    # Write a file so that it never appears half-written.
+    tmpPath = (path + '.' + socket.gethostname() + '.' + str(os.getpid()) +
+               '.tmp')
+    with open(tmpPath, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmpPath, path)
+
+def readJSON(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def addTask(queueDir, task):
+    # Put a task in the queue, unless it's already there.
+    path = os.path.join(queueDir, 'tasks', task['id'] + '.json')
+    if os.path.exists(path):
+        return False
+    writeJSON(path, task)
+    return True
+
+def submitObservation(queueDir, workDir, rpfitsFiles, taskOptions):
+    # Add the load task for an observation.
+    initQueue(queueDir)
+    workDir = os.path.abspath(workDir)
+    name = os.path.basename(os.path.normpath(workDir))
+    task = { 'id': taskId(name, 'load'), 'stage': 'load',
+             'observation': name, 'workDir': workDir,
+             'rpfitsFiles': [ os.path.abspath(f) for f in rpfitsFiles ],
+             'after': [], 'options': taskOptions }
+    addTask(queueDir, task)
+    return task['id']
+
+def taskState(queueDir, tid, lease, maxAttempts):
+    # Work out where a task is up to.
+    if os.path.exists(os.path.join(queueDir, 'done', tid + '.json')):
+        return 'done'
+    if os.path.exists(os.path.join(queueDir, 'failed', tid + '.json')):
+        return 'failed'
+    lock = os.path.join(queueDir, 'locks', tid + '.lock')
+    try:
+        if time.time() - os.path.getmtime(lock) < lease:
+            return 'running'
+        return 'expired'
+    except OSError:
+        pass
+    if attemptCount(queueDir, tid) >= maxAttempts:
+        return 'exhausted'
+    return 'waiting'
+
+def attemptCount(queueDir, tid):
+    prefix = tid + '.'
+    return len([ f for f in os.listdir(os.path.join(queueDir, 'attempts'))
+                 if f.startswith(prefix) and f[len(prefix):].isdigit() ])
+
+def sameLock(a, b):
+    # Whether two lock descriptions are of the same claim.
+    return (a is not None and b is not None and
+            [ a.get(k, None) for k in [ 'host', 'pid', 'claimed' ] ] ==
+            [ b.get(k, None) for k in [ 'host', 'pid', 'claimed' ] ])
+
+def breakLock(queueDir, tid, expired, lease):
+    # Take away an expired lock; only one worker will manage it. The
+    # lock we judged expired might have been touched, or replaced by
+    # another claim, before we moved it, so we check what we moved and
+    # put it back if it isn't the stale lock we meant to break.
+    lock = os.path.join(queueDir, 'locks', tid + '.lock')
+    moved = (lock + '.expired.' + socket.gethostname() + '.' +
+             str(os.getpid()) + '.' + str(int(time.time())))
+    try:
+        os.rename(lock, moved)
+    except OSError:
+        return False
+    try:
+        fresh = time.time() - os.path.getmtime(moved) < lease
+    except OSError:
+        fresh = True
+    if not fresh and sameLock(readJSON(moved), expired):
+        return True
+    try:
+        # Don't put it back over a claim someone has made since.
+        os.link(moved, lock)
+        os.remove(moved)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            try:
+                os.rename(moved, lock)
+            except OSError:
+                pass
+    return False
+
+def failTask(queueDir, tid, error):
+    writeJSON(os.path.join(queueDir, 'failed', tid + '.json'),
+              { 'id': tid, 'error': error, 'time': time.time() })
+
+def claimTask(queueDir, tid, lease):
+    # Try to take a task for ourselves.
+    lock = os.path.join(queueDir, 'locks', tid + '.lock')
+    owner = { 'host': socket.gethostname(), 'pid': os.getpid(),
+              'claimed': time.time(), 'lease': lease }
+    try:
+        fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except OSError:
+        return None
+    os.write(fd, json.dumps(owner).encode('utf-8'))
+    os.close(fd)
+    # Someone might have finished it between us looking and claiming.
+    if os.path.exists(os.path.join(queueDir, 'done', tid + '.json')):
+        os.remove(lock)
+        return None
+    n = attemptCount(queueDir, tid) + 1
+    while True:
+        try:
+            fd = os.open(os.path.join(queueDir, 'attempts',
+                                      tid + '.' + str(n)),
+                         os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            os.write(fd, json.dumps(owner).encode('utf-8'))
+            os.close(fd)
+            break
+        except OSError:
+            n += 1
+    owner['attempt'] = n
+    return owner
+
+def ownsLock(queueDir, tid, owner):
+    # Whether the lock on a task is still ours. Another worker checking
+    # whether it has expired can move it away for a moment.
+    for i in range(3):
+        l = readJSON(os.path.join(queueDir, 'locks', tid + '.lock'))
+        if l is not None:
+            break
+        time.sleep(0.1)
+    return (l is not None and l['host'] == owner['host'] and
+            l['pid'] == owner['pid'] and l['claimed'] == owner['claimed'])
+
+def releaseTask(queueDir, tid, owner):
+    if ownsLock(queueDir, tid, owner):
+        try:
+            os.remove(os.path.join(queueDir, 'locks', tid + '.lock'))
+        except OSError:
+            pass
+
+def findTask(queueDir, options):
+    # Find a task that can be started, and claim it.
+    lease = options['lease']
+    maxAttempts = options['max_attempts']
+    states = {}
+
+    def state(t):
+        if t not in states:
+            states[t] = taskState(queueDir, t, lease, maxAttempts)
+        return states[t]
+
+    for f in sorted(os.listdir(os.path.join(queueDir, 'tasks'))):
+        if not f.endswith('.json'):
+            continue
+        tid = f[:-5]
+        s = state(tid)
+        if s in [ 'done', 'failed', 'running' ]:
+            continue
+        if s == 'exhausted':
+            failTask(queueDir, tid, 'Ran out of attempts.')
+            continue
+        task = readJSON(os.path.join(queueDir, 'tasks', f))
+        if task is None:
+            continue
+        deps = [ state(d) for d in task['after'] ]
+        if 'failed' in deps or 'exhausted' in deps:
+            failTask(queueDir, tid, 'A task it depends on failed.')
+            states[tid] = 'failed'
+            continue
+        if len([ d for d in deps if d != 'done' ]) > 0:
+            continue
+        if s == 'expired':
+            if options['verbose']:
+                print('Lease on', tid, 'has expired.')
+            expired = readJSON(os.path.join(queueDir, 'locks',
+                                            tid + '.lock'))
+            if not breakLock(queueDir, tid, expired, lease):
+                continue
+            if attemptCount(queueDir, tid) >= maxAttempts:
+                failTask(queueDir, tid, 'Ran out of attempts.')
+                continue
+        owner = claimTask(queueDir, tid, lease)
+        if owner is not None:
+            return (task, owner)
+    return (None, None)
+
+def queueFinished(queueDir):
+    # Whether every task is either done or has failed.
+    for f in os.listdir(os.path.join(queueDir, 'tasks')):
+        if not f.endswith('.json'):
+            continue
+        if (not os.path.exists(os.path.join(queueDir, 'done', f)) and
+            not os.path.exists(os.path.join(queueDir, 'failed', f))):
+            return False
+    return True
+
+# The stages themselves. Each returns its results, and the new tasks
+# that follow from it.
+
+def taskOptions(task):
+    # The pipeline options a task runs with.
+    from cabb_pipeline_main_modules import interactiveMode
+    options = interactiveMode()
+    options['no_atlod'] = False
+    options['no_split'] = False
+    options['no_flag'] = False
+    options['verbose'] = False
+    options.update(task['options'])
+    return options
+
+def observationDict(task):
+    # The description of an observation we loaded earlier, which is
+    # kept with each of its datasets.
+    from cabb_pipeline_main_modules import loadMetadata, indexDatasets
+    rDict = loadMetadata(os.path.join(task['workDir'], task['dataset']))
+    if rDict is None:
+        raise RuntimeError('The metadata of ' + task['observation'] +
+                           ' is missing.')
+    rDict['workDir'] = task['workDir']
+    return indexDatasets(rDict)
+
+def runLoad(task, options):
+    from cabb_pipeline_main_modules import (cabbLoad, cabbParallelLoad,
+                                            splitIFs, recordMetadata, getIF,
+                                            frequencyBand)
+    workDir = task['workDir']
+    if not os.path.isdir(workDir):
+        os.makedirs(workDir)
+    rDict = None
+    if options['parallel_load']:
+        rDict = cabbParallelLoad(task['rpfitsFiles'], options, workDir)
+    if rDict is None:
+        rDict = cabbLoad(task['rpfitsFiles'], options, workDir)
+        rDict['datasets'] = splitIFs(
+            os.path.join(workDir, rDict['miriadData']),
+            rDict['freqConfigs'], options)
+    recordMetadata(rDict, options)
+
+    # Now we know the IFs, we can add their tasks.
+    base = { 'observation': task['observation'], 'workDir': workDir,
+             'miriadData': rDict['miriadData'], 'options': task['options'] }
+    tasks = []
+    midweek = {}
+    for p in rDict['datasets']:
+        t = getIF(rDict, p)
+        if (not options['no_midweek'] and t is not None and
+            t['classification']['bandType'] == 'wide' and
+            frequencyBand(t['centerFreq']) == '16cm'):
+            key = (t['freqConfig'], t['ifChain'])
+            midweek[key] = taskId(task['observation'], 'midweek', p)
+            d = dict(base)
+            d.update({ 'id': midweek[key], 'stage': 'midweek',
+                       'dataset': p, 'after': [ task['id'] ] })
+            tasks.append(d)
+    for p in rDict['datasets']:
+        t = getIF(rDict, p)
+        after = [ task['id'] ]
+        if t is not None and (t['freqConfig'], t['ifChain']) in midweek:
+            after.append(midweek[(t['freqConfig'], t['ifChain'])])
+        d = dict(base)
+        d.update({ 'id': taskId(task['observation'], 'flag', p),
+                   'stage': 'flag', 'dataset': p, 'after': after })
+        tasks.append(d)
+        if not options['no_casa']:
+            m = dict(base)
+            m.update({ 'id': taskId(task['observation'], 'uv2ms', p),
+                       'stage': 'uv2ms', 'dataset': p,
+                       'after': [ d['id'] ] })
+            tasks.append(m)
+    return ({ 'datasets': rDict['datasets'] }, tasks)
+
+def runMidweek(task, options):
+    # Find midweek RFI in a wide band, and flag it in its whole chain.
+    from cabb_pipeline_main_modules import (getIF, chainDatasets, flagStats,
+                                            keepMiriadFlagTable,
+                                            midweekDetector, midweekFlagger)
+    rDict = observationDict(task)
+    t = getIF(rDict, task['dataset'])
+    chain = chainDatasets(rDict, t['freqConfig'], t['ifChain'])
+    result = { 'loadFlagStats': {}, 'flagRegions': [] }
+    # The flagging of the whole chain before we change it.
+    for d in chain:
+        path = os.path.join(task['workDir'], d)
+        result['loadFlagStats'][d] = flagStats(path, options)
+        keepMiriadFlagTable(path, 'original', options)
+    mw = midweekDetector(os.path.join(task['workDir'], task['dataset']),
+                         options)
+    result['flagRegions'] = mw['flagRegions']
+    for d in chain:
+        path = os.path.join(task['workDir'], d)
+        if midweekFlagger(path, mw['flagRegions'], options):
+            keepMiriadFlagTable(path, 'midweek', options)
+    return (result, [])
+
+def runFlag(task, options):
+    # Flag an IF and gather its flagging statistics.
+    from cabb_pipeline_main_modules import (getIF, flagStats, autoPgflag,
+                                            checkMiriadFlagTable,
+                                            keepMiriadFlagTable)
+    rDict = observationDict(task)
+    path = os.path.join(task['workDir'], task['dataset'])
+    result = {}
+    if not checkMiriadFlagTable(path, 'original', options):
+        # Nothing has been done to this one yet.
+        result['loadFlagStats'] = flagStats(path, options)
+        keepMiriadFlagTable(path, 'original', options)
+    t = getIF(rDict, task['dataset'])
+    if (not options['no_flag'] and t is not None and
+        t['classification']['bandType'] == 'wide'):
+        autoPgflag(path, options)
+        keepMiriadFlagTable(path, 'auto', options)
+    result['autoFlagStats'] = flagStats(path, options)
+    return (result, [])
+
+def runMeasurementSet(task, options):
+    from cabb_pipeline_main_modules import uvToMeasurementSet
+    msFile = uvToMeasurementSet(os.path.join(task['workDir'],
+                                             task['dataset']), options)
+    return ({ 'measurementSet': msFile }, [])
+
+def runCheck(task, options):
+    # A stand-in task for checking the queue: note that it ran, and
+    # take a while about it.
+    fd = os.open(os.path.join(task['workDir'], 'runs'),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    os.write(fd, (task['id'] + '\n').encode('utf-8'))
+    os.close(fd)
+    time.sleep(task['seconds'])
+    return ({}, [])
+
+stageRoutines = { 'load': runLoad, 'midweek': runMidweek, 'flag': runFlag,
+                  'uv2ms': runMeasurementSet, 'check': runCheck }
+
+class LeaseKeeper(threading.Thread):
+    # Keep touching the lock of a task while it runs.
+    def __init__(self, queueDir, tid, owner):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queueDir = queueDir
+        self.tid = tid
+        self.owner = owner
+        self.lock = os.path.join(queueDir, 'locks', tid + '.lock')
+        self.interval = max(1.0, owner['lease'] / 4.0)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if ownsLock(self.queueDir, self.tid, self.owner):
+                try:
+                    os.utime(self.lock, None)
+                except OSError:
+                    pass
+            elif os.path.exists(self.lock):
+                # Someone else has taken it over, and will finish it.
+                break
+            # Otherwise another worker has moved our lock away for a
+            # moment, and will put it back when it sees it's fresh.
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def runTask(queueDir, task, owner, options):
+    # Run a task we've claimed, and record what happened.
+    tid = task['id']
+    if not options['quiet']:
+        print('Running', tid, '(attempt ' + str(owner['attempt']) + ')')
+    keeper = LeaseKeeper(queueDir, tid, owner)
+    keeper.start()
+    error = None
+    try:
+        (result, newTasks) = stageRoutines[task['stage']](
+            task, taskOptions(task))
+    except SystemExit:
+        # The pipeline routines exit when they can't go on.
+        error = 'The ' + task['stage'] + ' stage stopped.'
+    except Exception as e:
+        error = str(e)
+    keeper.stop()
+    if not ownsLock(queueDir, tid, owner):
+        # We took too long, and someone else has taken it over.
+        if not options['quiet']:
+            print('Lost the lease on', tid)
+        return False
+    if error is not None:
+        if not options['quiet']:
+            print('Task', tid, 'failed:', error)
+        if owner['attempt'] >= options['max_attempts']:
+            failTask(queueDir, tid, error)
+        releaseTask(queueDir, tid, owner)
+        return False
+    for t in newTasks:
+        addTask(queueDir, t)
+    writeJSON(os.path.join(queueDir, 'done', tid + '.json'),
+              { 'id': tid, 'result': result, 'host': owner['host'],
+                'started': owner['claimed'], 'finished': time.time() })
+    releaseTask(queueDir, tid, owner)
+    return True
+
+def runWorker(queueDir, options):
+    # Keep running tasks until there are none left (or forever, if
+    # we've been asked to wait for more).
+    initQueue(queueDir)
+    nDone = 0
+    while True:
+        (task, owner) = findTask(queueDir, options)
+        if task is not None:
+            if runTask(queueDir, task, owner, options):
+                nDone += 1
+            continue
+        if not options['wait'] and queueFinished(queueDir):
+            break
+        time.sleep(options['poll'])
+    if not options['quiet']:
+        print('Worker finished after', nDone, 'tasks.')
+    return nDone
+
+def queueStatus(queueDir, options):
+    # Count the tasks in each state.
+    counts = {}
+    for f in sorted(os.listdir(os.path.join(queueDir, 'tasks'))):
+        if not f.endswith('.json'):
+            continue
+        s = taskState(queueDir, f[:-5], options['lease'],
+                      options['max_attempts'])
+        counts[s] = counts.get(s, 0) + 1
+        if options['verbose']:
+            print(f[:-5], s)
+    return counts
+
+def checkQueue(queueDir, nWorkers, nTasks, options):
+    # Check that a lock that is touched, or claimed again, after it was
+    # judged expired isn't broken, and that several workers sharing a
+    # queue run each task exactly once. Returns what went wrong.
+    import shutil
+    import multiprocessing
+    problems = []
+    initQueue(queueDir)
+    lease = options['lease']
+    lock = os.path.join(queueDir, 'locks', 'stale.lock')
+    for replaced in [ False, True ]:
+        claimTask(queueDir, 'stale', lease)
+        old = time.time() - 2 * lease
+        os.utime(lock, (old, old))
+        expired = readJSON(lock)
+        if replaced:
+            os.remove(lock)
+            claimTask(queueDir, 'stale', lease)
+        else:
+            os.utime(lock, None)
+        current = readJSON(lock)
+        if breakLock(queueDir, 'stale', expired, lease):
+            problems.append('A ' + ('reclaimed' if replaced else 'touched') +
+                            ' lock was broken.')
+        elif not sameLock(readJSON(lock), current):
+            problems.append('A lock was not put back.')
+        if os.path.exists(lock):
+            os.remove(lock)
+    claimTask(queueDir, 'stale', lease)
+    old = time.time() - 2 * lease
+    os.utime(lock, (old, old))
+    if not breakLock(queueDir, 'stale', readJSON(lock), lease):
+        problems.append('An expired lock was not broken.')
+    shutil.rmtree(queueDir)
+
+    # Tasks that outlast the lease, so the workers have to keep them.
+    initQueue(queueDir)
+    workDir = os.path.abspath(queueDir)
+    ids = [ taskId('check', n) for n in range(nTasks) ]
+    for n in range(nTasks):
+        addTask(queueDir, { 'id': ids[n], 'stage': 'check',
+                            'workDir': workDir, 'options': {},
+                            'seconds': 1.5 * lease * (n % 3) / 2,
+                            'after': ids[:n:4] })
+    workers = [ multiprocessing.Process(target=runWorker,
+                                        args=(queueDir, options))
+                for i in range(nWorkers) ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    with open(os.path.join(workDir, 'runs')) as f:
+        runs = f.read().split()
+    for t in ids:
+        if runs.count(t) != 1:
+            problems.append('Task ' + t + ' ran ' + str(runs.count(t)) +
+                            ' times.')
+        if not os.path.exists(os.path.join(queueDir, 'done', t + '.json')):
+            problems.append('Task ' + t + ' is not done.')
+    shutil.rmtree(queueDir)
+    return problems
+
+if __name__ == '__main__':
+    usage = ("usage: %prog submit queue-dir obs-dir rpfits-file " +
+             "[rpfits-file ...]\n" +
+             "       %prog worker queue-dir\n" +
+             "       %prog status queue-dir\n" +
+             "       %prog check scratch-dir")
+    parser = OptionParser(usage=usage)
+    parser.add_option('--lease', type='float', default=600,
+                      help='the number of seconds a claimed task stays ' +
+                      'claimed without word from its worker (default: 600)')
+    parser.add_option('--max-attempts', type='int', default=3,
+                      help='the number of times a task is tried before it ' +
+                      'is given up on (default: 3)')
+    parser.add_option('--poll', type='float', default=10,
+                      help='the number of seconds a worker waits before ' +
+                      'looking for more tasks (default: 10)')
+    parser.add_option('--wait', action='store_true',
+                      help='keep the worker running when the queue is empty')
+    parser.add_option('--workers', type='int', default=4,
+                      help='(check) the number of workers to run (default: 4)')
+    parser.add_option('--parallel-load', action='store_true',
+                      help='(submit) load each IF with its own atlod')
+    parser.add_option('--no-midweek', action='store_true',
+                      help='(submit) disable midweek RFI detection')
+    parser.add_option('--no-flag', action='store_true',
+                      help='(submit) disable automatic flagging')
+    parser.add_option('--no-casa', action='store_true',
+                      help='(submit) disable conversion to MeasurementSets')
+    parser.add_option('-v', '--verbose', action='store_true')
+    parser.add_option('-q', '--quiet', action='store_true')
+    (options, args) = parser.parse_args()
+    if len(args) < 2:
+        parser.print_usage()
+        sys.exit(0)
+    qoptions = { 'lease': options.lease,
+                 'max_attempts': options.max_attempts,
+                 'poll': options.poll, 'wait': options.wait,
+                 'verbose': options.verbose, 'quiet': options.quiet }
+    command = args[0]
+    queueDir = args[1]
+    if command == 'submit':
+        if len(args) < 4:
+            parser.print_usage()
+            sys.exit(0)
+        tid = submitObservation(queueDir, args[2], args[3:], {
+            'parallel_load': bool(options.parallel_load),
+            'no_midweek': bool(options.no_midweek),
+            'no_flag': bool(options.no_flag),
+            'no_casa': bool(options.no_casa),
+            'quiet': bool(options.quiet) })
+        print('Added task', tid)
+    elif command == 'worker':
+        runWorker(queueDir, qoptions)
+    elif command == 'check':
+        if os.path.exists(queueDir):
+            print('The check needs a directory that does not exist yet.')
+            sys.exit(0)
+        # Short leases, so that they are kept and checked many times.
+        qoptions.update({ 'lease': 2.0, 'poll': 0.2, 'wait': False,
+                          'quiet': not options.verbose })
+        problems = checkQueue(queueDir, options.workers, 24, qoptions)
+        for p in problems:
+            print(p)
+        if len(problems) > 0:
+            sys.exit(1)
+        print('Each task ran exactly once.')
+    elif command == 'status':
+        initQueue(queueDir)
+        counts = queueStatus(queueDir, qoptions)
+        for s in sorted(counts):
+            print(s + ':', counts[s])
+    else:
+        parser.print_usage()
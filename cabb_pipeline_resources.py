@@ -0,0 +1,175 @@
+from __future__ import print_function
+import os
+import threading
+from cabb_pipeline_metadata import readMetadata
+
+"""
+Estimates of how much memory and scratch disk each Miriad task will need,
+and admission control that uses them to run as many tasks at once as a
+node can take without running out of either.
+
+The estimates come from the shape of the dataset: the number of
+channels (from the IF table recorded with the dataset), the number of
+baselines and polarisations, and the number of records, worked out from
+the size of the visdata item. They are deliberately on the generous
+side, since guessing too low gets the whole job killed.
+"""
+
+MB = 1024 * 1024
+
+# CABB data as loaded by the pipeline: six antennas without
+# autocorrelations, and four polarisation products.
+DEFAULT_BASELINES = 15
+DEFAULT_POLARISATIONS = 4
+DEFAULT_CHANNELS = 2049
+
+def availableMemory():
+    # The memory (bytes) that could be used without swapping.
+    try:
+        with open('/proc/meminfo') as f:
+            for l in f:
+                if l.startswith('MemAvailable:'):
+                    return int(l.split()[1]) * 1024
+    except IOError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 * MB
+
+def availableScratch(directory):
+    # The free space (bytes) on the disk holding a directory.
+    st = os.statvfs(directory)
+    return st.f_bavail * st.f_frsize
+
+def datasetShape(uvFile):
+    # Work out the shape of a dataset from its recorded metadata and the
+    # size of its items.
+    shape = { 'channels': DEFAULT_CHANNELS,
+              'baselines': DEFAULT_BASELINES,
+              'polarisations': DEFAULT_POLARISATIONS,
+              'visBytes': 0, 'records': 0 }
+    meta = readMetadata(uvFile)
+    name = os.path.basename(os.path.normpath(uvFile))
+    if (meta is not None and 'datasetIF' in meta and
+        name in meta['datasetIF']):
+        (fc, i) = meta['datasetIF'][name]
+        shape['channels'] = meta['freqConfigs'][fc]['channels'][i]
+    try:
+        shape['visBytes'] = os.path.getsize(os.path.join(uvFile, 'visdata'))
+    except OSError:
+        pass
+    # Each record is a complex spectrum plus around 100 bytes of
+    # preamble and variables.
+    shape['records'] = int(shape['visBytes'] /
+                           (shape['channels'] * 8 + 100))
+    return shape
+
+def estimateFootprint(task, shape):
+    # Predict the peak memory and scratch disk (bytes) a task will use.
+    spectrum = shape['channels'] * shape['polarisations'] * 8
+    allSpectra = spectrum * shape['baselines']
+    vis = shape['visBytes']
+    fp = { 'memory': 64 * MB, 'scratch': 0 }
+    if task == 'pgflag':
+        # Holds the whole time-frequency plane, plus flags and the
+        # Stokes parameters it works on.
+        fp['memory'] += int(vis * 1.5)
+    elif task == 'mfcal':
+        # Copies the data to a scratch file and accumulates solutions
+        # per channel.
+        fp['memory'] += allSpectra * 4
+        fp['scratch'] += vis
+    elif task == 'gpcal':
+        # Works on channel-averaged data.
+        fp['memory'] += shape['records'] * shape['polarisations'] * 16
+        fp['scratch'] += shape['records'] * shape['polarisations'] * 16
+    elif task == 'uv2ms':
+        # Buffers a full integration and writes a MeasurementSet that is
+        # a bit larger than the dataset.
+        fp['memory'] += 192 * MB + allSpectra * 2
+        fp['scratch'] += int(vis * 1.3)
+    elif task == 'uvsplit':
+        fp['scratch'] += vis
+    elif task == 'atlod':
+        fp['memory'] += 64 * MB + allSpectra * 3
+        fp['scratch'] += vis
+    elif task in [ 'uvfstats', 'uvflag', 'varplt', 'mfboot' ]:
+        # These stream through the data a record at a time.
+        fp['memory'] += spectrum * 4
+    return fp
+
+class AdmissionController(object):
+    # Only let tasks start when their footprint fits in what is left of
+    # the node. A task that is bigger than the whole node is still
+    # allowed to start, but only when nothing else is running.
+    def __init__(self, memory=None, scratch=None, scratchDir='.'):
+        if memory is None:
+            memory = int(availableMemory() * 0.9)
+        if scratch is None:
+            scratch = int(availableScratch(scratchDir) * 0.95)
+        self.memory = memory
+        self.scratch = scratch
+        self.usedMemory = 0
+        self.usedScratch = 0
+        self.running = 0
+        self.lock = threading.Condition()
+        self.asyncCondition = None
+        self.loop = None
+
+    def fits(self, fp):
+        if self.running == 0:
+            return True
+        return (self.usedMemory + fp['memory'] <= self.memory and
+                self.usedScratch + fp['scratch'] <= self.scratch)
+
+    def take(self, fp):
+        self.usedMemory += fp['memory']
+        self.usedScratch += fp['scratch']
+        self.running += 1
+
+    def give(self, fp):
+        self.usedMemory -= fp['memory']
+        self.usedScratch -= fp['scratch']
+        self.running -= 1
+
+    def acquire(self, fp):
+        # Wait, in a thread, until the task can start.
+        with self.lock:
+            while not self.fits(fp):
+                self.lock.wait()
+            self.take(fp)
+
+    def release(self, fp):
+        with self.lock:
+            self.give(fp)
+            self.lock.notify_all()
+
+    def condition(self):
+        # The asyncio condition has to belong to the running event loop.
+        import asyncio
+        loop = asyncio.get_event_loop()
+        if self.asyncCondition is None or self.loop is not loop:
+            self.asyncCondition = asyncio.Condition()
+            self.loop = loop
+        return self.asyncCondition
+
+    async def acquireAsync(self, fp):
+        # Wait, in a coroutine, until the task can start.
+        c = self.condition()
+        async with c:
+            await c.wait_for(lambda: self.fits(fp))
+            self.take(fp)
+
+    async def releaseAsync(self, fp):
+        c = self.condition()
+        async with c:
+            self.give(fp)
+            c.notify_all()
+
+def makeController(options, scratchDir='.'):
+    # Make the admission controller the options ask for.
+    memory = None
+    if options.get('max_memory', 0) > 0:
+        memory = int(options['max_memory'] * 1024 * MB)
+    return AdmissionController(memory=memory, scratchDir=scratchDir)
@@ -0,0 +1,315 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import sqlite3
+from optparse import OptionParser
+from cabb_pipeline_main_modules import getIF, frequencyBand
+
+"""
+A library of the frequency ranges known to be full of RFI in each band,
+which are flagged before the automatic flagger runs. Without it pgflag
+has to find the same satellite and navigation signals in every dataset
+of every observation, and how much it finds of them changes the flagging
+statistics from one run to the next.
+
+The library is kept in ~/.cabb_pipeline/rfi_masks.sqlite unless another
+file is given, and is made of numbered versions so a run can say which
+masks it used. The first version is made from the spectrum plan: the
+bands used by satellite navigation and mobile satellite downlinks, which
+are always overhead, less the parts of them protected for radio
+astronomy (like the 1612 MHz OH line), which are only masked in the
+bands that ask for it. Every run also adds the fraction of each MHz of its
+wide bands that pgflag flagged (outside the masks) to the occupancy
+history, and later versions add the frequencies that have been flagged
+in most runs. Run this file directly to list or show the versions, or
+to make a new one from the history.
+"""
+
+LIBRARY_PATH = os.path.join(os.path.expanduser('~'), '.cabb_pipeline',
+                            'rfi_masks.sqlite')
+
+# The uses of the spectrum that mean a range is always occupied, unless
+# it is also set aside for passive use.
+PERSISTENT_USAGES = [ 'Radionavigation - Satellite', 'Mobile - Satellite' ]
+
+# The ranges (MHz) set aside for radio astronomy, which are left out of
+# the masks made from the spectrum plan even where they fall within an
+# allocation to a persistent use.
+PROTECTED_RANGES = [ (1400.0, 1427.0, 'HI'),
+                     (1610.6, 1613.8, 'OH 1612 MHz'),
+                     (1660.0, 1670.0, 'OH 1665 and 1667 MHz'),
+                     (1718.8, 1722.2, 'OH 1720 MHz') ]
+
+# The width (MHz) of the bins the occupancy is kept in, how much of a bin
+# has to be flagged on average for it to be masked, and in how many runs.
+BIN_WIDTH = 1.0
+OCCUPANCY_THRESHOLD = 0.8
+MIN_RUNS = 5
+
+schema = [
+    """CREATE TABLE IF NOT EXISTS occupancy (
+         band TEXT, freq_mhz INTEGER, flagged REAL, runs INTEGER,
+         PRIMARY KEY (band, freq_mhz))""",
+    """CREATE TABLE IF NOT EXISTS versions (
+         version INTEGER PRIMARY KEY, created REAL, description TEXT)""",
+    """CREATE TABLE IF NOT EXISTS masks (
+         version INTEGER, band TEXT, low_mhz REAL, high_mhz REAL,
+         origin TEXT, usage TEXT)""",
+    "CREATE INDEX IF NOT EXISTS masks_version ON masks (version, band)" ]
+
+def openLibrary(path=None):
+    # Open (and make if necessary) the library, seeding it from the
+    # spectrum plan if it has no versions yet.
+    if path is None:
+        path = LIBRARY_PATH
+    if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+        os.makedirs(os.path.dirname(os.path.abspath(path)))
+    db = sqlite3.connect(path, timeout=60)
+    for s in schema:
+        db.execute(s)
+    db.commit()
+    if latestVersion(db) is None:
+        buildVersion(db, 'Seeded from the spectrum plan', useHistory=False)
+    return db
+
+def latestVersion(db):
+    r = db.execute('SELECT MAX(version) FROM versions').fetchone()
+    return r[0]
+
+def mergeRanges(ranges):
+    # Join ranges (low, high, origin, usage) that overlap or touch.
+    merged = []
+    for (low, high, origin, usage) in sorted(ranges):
+        if len(merged) == 0 or low > merged[-1][1]:
+            merged.append([ low, high, set(), set() ])
+        m = merged[-1]
+        m[1] = max(m[1], high)
+        m[2].add(origin)
+        if usage != '':
+            m[3].update(usage.split(', '))
+    return [ (m[0], m[1], ','.join(sorted(m[2])), ', '.join(sorted(m[3])))
+             for m in merged ]
+
+def removeProtected(low, high):
+    # The parts of a range outside the ranges protected for radio
+    # astronomy.
+    parts = [ (low, high) ]
+    for (pl, ph, line) in PROTECTED_RANGES:
+        cut = []
+        for (l, h) in parts:
+            if ph <= l or pl >= h:
+                cut.append((l, h))
+                continue
+            if l < pl:
+                cut.append((l, pl))
+            if ph < h:
+                cut.append((ph, h))
+        parts = cut
+    return parts
+
+def planRanges(maskProtected=()):
+    # The persistently occupied ranges in the spectrum plan. The ranges
+    # protected for radio astronomy are left out, except in the bands
+    # listed in maskProtected.
+    from cabb_pipeline_rfi_calculator import specUse
+    ranges = {}
+    for u in specUse:
+        if 'Passive' in u['usage']:
+            continue
+        if any(p in u['usage'] for p in PERSISTENT_USAGES):
+            band = frequencyBand(u['lowFreq'] / 1000.0)
+            parts = [ (float(u['lowFreq']), float(u['highFreq'])) ]
+            if band not in maskProtected:
+                parts = removeProtected(*parts[0])
+            for (low, high) in parts:
+                ranges.setdefault(band, []).append(
+                    (low, high, 'plan', ', '.join(u['usage'])))
+    return ranges
+
+def historyRanges(db, threshold=OCCUPANCY_THRESHOLD, minRuns=MIN_RUNS):
+    # The bins that have been mostly flagged in enough runs.
+    ranges = {}
+    for (band, f) in db.execute(
+            'SELECT band, freq_mhz FROM occupancy WHERE runs >= ? AND ' +
+            'flagged >= ? * runs ORDER BY band, freq_mhz',
+            (minRuns, threshold)):
+        ranges.setdefault(band, []).append(
+            (f - BIN_WIDTH / 2.0, f + BIN_WIDTH / 2.0, 'history', ''))
+    return ranges
+
+def buildVersion(db, description, usePlan=True, useHistory=True,
+                 threshold=OCCUPANCY_THRESHOLD, minRuns=MIN_RUNS,
+                 maskProtected=()):
+    # Make a new version of the masks, and return its number.
+    ranges = {}
+    if usePlan:
+        for (band, r) in planRanges(maskProtected).items():
+            ranges.setdefault(band, []).extend(r)
+    if useHistory:
+        for (band, r) in historyRanges(db, threshold, minRuns).items():
+            ranges.setdefault(band, []).extend(r)
+    version = (latestVersion(db) or 0) + 1
+    db.execute('INSERT INTO versions (version, created, description) ' +
+               'VALUES (?, ?, ?)', (version, time.time(), description))
+    for band in ranges:
+        for (low, high, origin, usage) in mergeRanges(ranges[band]):
+            db.execute('INSERT INTO masks (version, band, low_mhz, high_mhz, ' +
+                       'origin, usage) VALUES (?, ?, ?, ?, ?, ?)',
+                       (version, band, low, high, origin, usage))
+    db.commit()
+    return version
+
+def loadMasks(db, version=None):
+    # The ranges (MHz) masked in each band by a version of the library,
+    # as sorted lists of lows and highs.
+    if version is None:
+        version = latestVersion(db)
+    masks = {}
+    for (band, low, high) in db.execute(
+            'SELECT band, low_mhz, high_mhz FROM masks WHERE version=? ' +
+            'ORDER BY band, low_mhz', (version,)):
+        m = masks.setdefault(band, ([], []))
+        m[0].append(low)
+        m[1].append(high)
+    return (version, masks)
+
+def channelMask(chanFreqs, ranges):
+    # Which channels (frequencies in GHz) fall in the masked ranges.
+    import numpy as np
+    f = np.asarray(chanFreqs, dtype=float) * 1000.0
+    if ranges is None or len(ranges[0]) == 0:
+        return np.zeros(len(f), dtype=bool)
+    lows = np.asarray(ranges[0])
+    highs = np.asarray(ranges[1])
+    i = np.searchsorted(lows, f, side='right') - 1
+    return (i >= 0) & (f < highs[np.maximum(i, 0)])
+
+def maskDatasets(db, progressDict, uvFiles, options):
+    # Flag the known RFI in each of the datasets, and return the mask
+    # of each dataset's channels.
+    from cabb_pipeline_miriadio import flagRecords, updateFlags
+    (version, masks) = loadMasks(db, options.get('rfi_mask_version', None))
+    if version is None:
+        return {}
+    if not options['quiet']:
+        print('Flagging known RFI with mask version', version)
+    progressDict['rfiMaskVersion'] = version
+    channelMasks = {}
+    for p in uvFiles:
+        t = getIF(progressDict, p)
+        if t is None:
+            continue
+        mask = channelMask(t['chanFreqs'],
+                           masks.get(frequencyBand(t['centerFreq']), None))
+        channelMasks[p] = mask
+        if not mask.any():
+            continue
+        path = os.path.join(progressDict.get('workDir', '.'), p)
+        try:
+            nrec = flagRecords(path, t['channels'])
+            updateFlags(path, t['channels'], nrec,
+                        lambda first, good: good & ~mask[None, :])
+        except (IOError, OSError, ValueError) as e:
+            print('Unable to flag known RFI in', p + ':', e)
+            del channelMasks[p]
+            continue
+        if options['verbose']:
+            print('Flagged', int(mask.sum()), 'channels of known RFI in', p)
+        n = progressDict['datasets'].index(p)
+        if 'logs' in progressDict and n < len(progressDict['logs']):
+            progressDict['logs'][n].write(
+                'Flagged ' + str(int(mask.sum())) + ' channels of known ' +
+                'RFI (mask version ' + str(version) + ').\n')
+    return channelMasks
+
+def recordOccupancy(db, progressDict, uvFiles, channelMasks):
+    # Add how much of each bin the automatic flagger flagged, outside
+    # the masks, to the occupancy history.
+    import numpy as np
+    for p in uvFiles:
+        t = getIF(progressDict, p)
+        if (t is None or p not in progressDict.get('autoFlagStats', {}) or
+            p not in progressDict.get('startFlagStats', {})):
+            continue
+        auto = progressDict['autoFlagStats'][p]['channel']
+        start = progressDict['startFlagStats'][p]['channel']
+        n = t['channels']
+        flagged = np.array([ max(0.0, auto.get(str(i + 1), 0.0) -
+                                 start.get(str(i + 1), 0.0))
+                             for i in range(0, n) ])
+        # Channels that were already flagged tell us nothing.
+        use = np.array([ start.get(str(i + 1), 0.0) < 1.0
+                         for i in range(0, n) ])
+        if p in channelMasks:
+            use &= ~channelMasks[p]
+        if not use.any():
+            continue
+        bins = np.rint(np.asarray(t['chanFreqs'])[use] * 1000.0 /
+                       BIN_WIDTH).astype(np.int64)
+        (binFreqs, index) = np.unique(bins, return_inverse=True)
+        occupancy = (np.bincount(index.ravel(), weights=flagged[use]) /
+                     np.bincount(index.ravel()))
+        band = frequencyBand(t['centerFreq'])
+        for (f, o) in zip(binFreqs, occupancy):
+            db.execute('INSERT OR IGNORE INTO occupancy (band, freq_mhz, ' +
+                       'flagged, runs) VALUES (?, ?, 0, 0)',
+                       (band, int(f * BIN_WIDTH)))
+            db.execute('UPDATE occupancy SET flagged = flagged + ?, ' +
+                       'runs = runs + 1 WHERE band=? AND freq_mhz=?',
+                       (float(o), band, int(f * BIN_WIDTH)))
+    db.commit()
+
+if __name__ == '__main__':
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--library', metavar='FILE',
+                      help='the mask library (default: ' +
+                      '~/.cabb_pipeline/rfi_masks.sqlite)')
+    parser.add_option('--show', type='int', metavar='N',
+                      help='show the masks in version N')
+    parser.add_option('--rebuild', action='store_true',
+                      help='make a new version from the spectrum plan and ' +
+                      'the occupancy history')
+    parser.add_option('--no-plan', action='store_true',
+                      help='when rebuilding, only use the history')
+    parser.add_option('--mask-protected', action='append', default=[],
+                      metavar='BAND',
+                      help='when rebuilding, also mask the parts of the ' +
+                      'spectrum plan protected for radio astronomy in ' +
+                      'BAND (may be given more than once)')
+    parser.add_option('--threshold', type='float',
+                      default=OCCUPANCY_THRESHOLD,
+                      help='the average fraction of a bin that must have ' +
+                      'been flagged for it to be masked (default: ' +
+                      str(OCCUPANCY_THRESHOLD) + ')')
+    parser.add_option('--min-runs', type='int', default=MIN_RUNS,
+                      help='the fewest runs a bin must have been seen in ' +
+                      '(default: ' + str(MIN_RUNS) + ')')
+    parser.add_option('--description', default='Rebuilt from the history',
+                      help='a description of the new version')
+    (options, args) = parser.parse_args()
+
+    db = openLibrary(options.library)
+    if options.rebuild:
+        v = buildVersion(db, options.description, not options.no_plan, True,
+                         options.threshold, options.min_runs,
+                         options.mask_protected)
+        print('Made version', v)
+        options.show = v
+    if options.show is not None:
+        (version, masks) = loadMasks(db, options.show)
+        if len(masks) == 0:
+            print('Version', options.show, 'has no masks.')
+            sys.exit(1)
+        for (band, low, high, origin, use) in db.execute(
+                'SELECT band, low_mhz, high_mhz, origin, usage FROM masks ' +
+                'WHERE version=? ORDER BY band, low_mhz', (version,)):
+            print('%-5s %8.1f - %8.1f MHz  %-12s %s' %
+                  (band, low, high, origin, use))
+    else:
+        for (v, created, description) in db.execute(
+                'SELECT version, created, description FROM versions ' +
+                'ORDER BY version'):
+            print(v, time.strftime('%Y-%m-%d %H:%M:%S',
+                                   time.localtime(created)), description)
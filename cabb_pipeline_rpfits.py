@@ -0,0 +1,296 @@
+from __future__ import print_function
+import os
+import mmap
+import math
+import struct
+from datetime import datetime, timedelta
+from cabb_pipeline_main_modules import frequencyArray, characteriseIF
+
+"""
+A reader for the headers of RPFITS files, so the pipeline can learn
+about an observation before atlod has run. Only the ASCII scan headers
+are decoded; the visibility payload between them is skipped over, so
+even a large file can be scanned in a few seconds.
+
+The structures produced are the same as those cabbLoad compiles from
+uvindex, so they can be used anywhere a progressDict is expected.
+"""
+
+# RPFITS files are written in blocks of this many bytes, and every
+# scan header begins at the start of a block.
+BLOCK_SIZE = 2560
+CARD_SIZE = 80
+HEADER_START = b'SIMPLE  ='
+
+def cardValue(card):
+    # Return the value of a header card, as a string or number.
+    v = card[10:]
+    if v.lstrip().startswith("'"):
+        v = v.lstrip()[1:]
+        return v[:v.find("'")].strip()
+    v = v.split('/')[0].strip()
+    try:
+        return int(v)
+    except ValueError:
+        pass
+    try:
+        return float(v)
+    except ValueError:
+        return v
+
+def parseHeader(cards):
+    # Split the cards of a scan header into keywords and tables.
+    rDict = { 'keywords': {}, 'tables': {} }
+    table = None
+    for card in cards:
+        key = card[:8].strip()
+        if key == 'END':
+            break
+        if card.startswith('TABLE '):
+            table = card[6:].strip()
+            rDict['tables'][table] = []
+        elif card.startswith('ENDTABLE'):
+            table = None
+        elif table is not None:
+            if card.strip() != '' and not card.lstrip().startswith('#'):
+                rDict['tables'][table].append(card.split())
+        elif card[8:10] == '= ':
+            rDict['keywords'][key] = cardValue(card)
+    return rDict
+
+def ifTable(rows):
+    # Decode the rows of the IF table:
+    # IF_NO FREQ(Hz) INVERT BW(Hz) NCHAN NSTOK STOKES SIMUL CHAIN
+    ifs = []
+    for r in rows:
+        try:
+            i = { 'number': int(r[0]), 'freq': float(r[1]),
+                  'invert': int(r[2]), 'bandwidth': float(r[3]),
+                  'nchan': int(r[4]), 'nstok': int(r[5]), 'chain': None }
+        except (ValueError, IndexError):
+            continue
+        if len(r) > 7:
+            try:
+                i['chain'] = int(r[-1])
+            except ValueError:
+                pass
+        ifs.append(i)
+    return ifs
+
+def suTable(rows):
+    # Decode the rows of the source table:
+    # SU_NO SU_NAME SU_RA(rad) SU_DEC(rad) SU_CALCODE
+    sources = {}
+    for r in rows:
+        try:
+            s = { 'rightAscension': float(r[2]), 'declination': float(r[3]),
+                  'calCode': '' }
+        except (ValueError, IndexError):
+            continue
+        if len(r) > 4 and not r[4][0].isdigit() and r[4][0] != '-':
+            s['calCode'] = r[4]
+        sources[r[1]] = s
+    return sources
+
+def firstGroupTime(buf, offset):
+    # The UT (seconds) of the first group after a header, from its random
+    # parameters (u, v, w, baseline, ut, ...), which are big-endian floats.
+    if offset + 20 > len(buf):
+        return None
+    p = struct.unpack('>5f', buf[offset:offset + 20])
+    if p[4] < 0 or p[4] > 2 * 86400 or math.isnan(p[4]):
+        return None
+    return p[4]
+
+def scanRPFITS(rpfitsFile):
+    # Return a list describing each scan in an RPFITS file.
+    scans = []
+    with open(rpfitsFile, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return scans
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # Find all the header starts. A header always begins a block,
+            # so only the start of each block is looked at, never the
+            # visibilities within it.
+            hl = len(HEADER_START)
+            starts = [ o for o in range(0, len(buf) - hl + 1, BLOCK_SIZE)
+                       if buf[o:o + hl] == HEADER_START ]
+            for n in range(0, len(starts)):
+                end = len(buf)
+                if n < len(starts) - 1:
+                    end = starts[n + 1]
+                # Read cards until END.
+                cards = []
+                o = starts[n]
+                while o + CARD_SIZE <= end:
+                    card = buf[o:o + CARD_SIZE].decode('ascii', 'replace')
+                    cards.append(card)
+                    o += CARD_SIZE
+                    if card[:8].strip() == 'END':
+                        break
+                # The data begins on the next block boundary.
+                dataStart = int(math.ceil(float(o - starts[n]) / BLOCK_SIZE))
+                dataStart = starts[n] + dataStart * BLOCK_SIZE
+                h = parseHeader(cards)
+                scans.append({ 'file': rpfitsFile, 'offset': starts[n],
+                               'dataBytes': max(0, end - dataStart),
+                               'keywords': h['keywords'],
+                               'ifs': ifTable(h['tables'].get('IF', [])),
+                               'sources': suTable(h['tables'].get('SU', [])),
+                               'firstUT': firstGroupTime(buf, dataStart) })
+        finally:
+            buf.close()
+    return scans
+
+def scanStartTime(scan):
+    # Work out the start time of a scan as a datetime.
+    k = scan['keywords']
+    date = k.get('DATE-OBS', k.get('DATE', None))
+    if date is None:
+        return None
+    try:
+        t = datetime.strptime(str(date)[:10], '%Y-%m-%d')
+    except ValueError:
+        return None
+    if scan['firstUT'] is not None:
+        return t + timedelta(seconds=scan['firstUT'])
+    return t
+
+def uvindexTime(t):
+    # Format a time in the way uvindex prints it.
+    if t is None:
+        return ''
+    return (t.strftime('%y%b%d:%H:%M:%S').upper() + '.' +
+            str(int(t.microsecond / 100000)))
+
+def sexagesimal(v, hours):
+    # Format an angle in radians as uvindex would.
+    d = math.degrees(v)
+    if hours:
+        d = (d / 15.0) % 24.0
+    sign = '-' if d < 0 else ''
+    d = math.fabs(d)
+    a = int(d)
+    m = int((d - a) * 60)
+    s = ((d - a) * 60 - m) * 60
+    if hours:
+        return '%s%02d:%02d:%05.2f' % (sign, a, m, s)
+    return '%s%02d:%02d:%04.1f' % (sign, a, m, s)
+
+def ifConfigKey(ifs):
+    # Something that identifies a frequency configuration uniquely.
+    return tuple((i['freq'], i['bandwidth'], i['nchan'], i['invert'],
+                  i['chain']) for i in ifs)
+
+def freqConfigEntry(ifs):
+    # Make a freqConfigs entry, as the uvindex parser would, from an IF table.
+    fc = { 'channels': [], 'firstFreq': [], 'chanWidth': [],
+           'restFreq': [], 'centreFreq': [], 'sideband': [],
+           'dataset': [], 'chanFreqs': [], 'classification': [],
+           'ifChain': [] }
+    for n in range(0, len(ifs)):
+        i = ifs[n]
+        nchan = i['nchan']
+        centreFreq = i['freq'] / 1e9
+        chanWidth = i['bandwidth'] / 1e9
+        if nchan > 1:
+            chanWidth /= (nchan - 1)
+        if i['invert'] < 0:
+            chanWidth *= -1.0
+        firstFreq = centreFreq - (nchan - 1) / 2.0 * chanWidth
+        fc['channels'].append(nchan)
+        fc['firstFreq'].append(firstFreq)
+        fc['chanWidth'].append(chanWidth)
+        fc['restFreq'].append(0.0)
+        fc['centreFreq'].append(centreFreq)
+        fc['sideband'].append('LSB' if chanWidth < 0 else 'USB')
+        fc['dataset'].append('')
+        fc['chanFreqs'].append(frequencyArray(firstFreq, chanWidth, nchan))
+        fc['classification'].append(characteriseIF(nchan, firstFreq,
+                                                   chanWidth))
+        if i['chain'] is not None:
+            fc['ifChain'].append(i['chain'])
+        else:
+            fc['ifChain'].append(n + 1)
+    return fc
+
+def scanRPFITSFiles(rpfitsFiles, options):
+    # Compile the sources and frequency configurations from the headers
+    # of a set of RPFITS files, without loading them.
+    if not options['quiet']:
+        print('Scanning RPFITS headers...', ", ".join(rpfitsFiles))
+    rDict = { 'rpfitsFiles': rpfitsFiles, 'sources': {}, 'freqConfigs': {},
+              'scans': [], 'loadSize': {} }
+    configKeys = {}
+    last = None
+    for f in rpfitsFiles:
+        if not os.path.isfile(f):
+            print('File', f, 'is not accessible.')
+            return None
+        for s in scanRPFITS(f):
+            if len(s['ifs']) == 0:
+                # Not a header we understand.
+                continue
+            key = ifConfigKey(s['ifs'])
+            if key not in configKeys:
+                configKeys[key] = str(len(configKeys) + 1)
+                rDict['freqConfigs'][configKeys[key]] = freqConfigEntry(
+                    s['ifs'])
+                rDict['loadSize'][configKeys[key]] = [ 0 ] * len(s['ifs'])
+            fc = configKeys[key]
+            name = str(s['keywords'].get('OBJECT', '')).strip()
+            calCode = str(s['keywords'].get('CAL', '')).strip()
+            if name in s['sources'] and calCode == '':
+                calCode = s['sources'][name]['calCode']
+            s['freqConfig'] = fc
+            s['source'] = name
+            s['startTime'] = scanStartTime(s)
+            rDict['scans'].append(s)
+
+            # Divide the scan's data among its IFs by size.
+            w = [ i['nchan'] * max(1, i['nstok']) for i in s['ifs'] ]
+            for n in range(0, len(w)):
+                rDict['loadSize'][fc][n] += int(s['dataBytes'] * w[n] /
+                                                sum(w))
+
+            # uvindex only lists a scan when the source or configuration
+            # changes, so we do the same.
+            if last is not None and last == (name, fc, calCode):
+                continue
+            last = (name, fc, calCode)
+            if name not in rDict['sources']:
+                rDict['sources'][name] = { 'freqConfig': [],
+                                           'startTime': [],
+                                           'calCode': [] }
+                if name in s['sources']:
+                    rDict['sources'][name]['rightAscension'] = sexagesimal(
+                        s['sources'][name]['rightAscension'], True)
+                    rDict['sources'][name]['declination'] = sexagesimal(
+                        s['sources'][name]['declination'], False)
+            rDict['sources'][name]['freqConfig'].append(fc)
+            rDict['sources'][name]['startTime'].append(
+                uvindexTime(s['startTime']))
+            # Keep a placeholder for an empty calcode so the lists
+            # stay aligned.
+            rDict['sources'][name]['calCode'].append(
+                calCode if calCode != '' else '.')
+
+    if len(rDict['freqConfigs']) == 0:
+        if not options['quiet']:
+            print('No RPFITS scan headers were understood.')
+        return None
+    if not options['quiet']:
+        print('Header scan complete.')
+    return rDict
+
+def estimateLoadSize(scanDict):
+    # Estimate the disk space (bytes) that each IF will need once
+    # loaded into Miriad. RPFITS stores real, imaginary and weight for
+    # each visibility, whereas Miriad stores a complex value and a
+    # flag bit.
+    rDict = {}
+    for fc in scanDict['loadSize']:
+        rDict[fc] = [ int(b * (8.0 + 1.0 / 8.0) / 12.0)
+                      for b in scanDict['loadSize'][fc] ]
+    return rDict
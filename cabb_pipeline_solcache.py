@@ -0,0 +1,200 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from optparse import OptionParser
+from cabb_pipeline_metadata import itemStats
+from cabb_pipeline_miriadio import copyItems, stageHeader
+from cabb_pipeline_caltables import tableItems, calTables
+
+"""
+A cache of the bandpass, flux and leakage solutions, so that a rerun on
+calibrators that haven't changed doesn't have to solve for them again.
+
+Each entry is found by a digest of everything the solutions depend on:
+which calibrator is used for what, the reference antenna, the size and
+modification time of each calibrator's visibilities (as for the metadata
+sidecar) and the contents of its flags. Solving flags the calibrators
+again, so an entry is found by the state of the calibrators both before
+and after the run that made it (the second as a link to the first); a
+rerun with --keep-reduction starts from the flags the earlier run left.
+
+An entry is a directory holding, for each calibrator dataset, its
+calibration items, its flags and a header with just the calibration
+variables, so it can be copied back like any other dataset. The cache is
+kept in ~/.cabb_pipeline/solutions unless another directory is given.
+Run this file directly to list the entries, or to remove old ones.
+"""
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cabb_pipeline',
+                          'solutions')
+
+# Change this whenever the way the solutions are made changes, so that
+# older entries are no longer found.
+CACHE_VERSION = 1
+
+ENTRY_NAME = 'entry.json'
+
+# What is kept of each calibrator.
+cachedItems = calTables + [ 'freqs', 'flags' ]
+cachedVariables = []
+for k in sorted(tableItems):
+    cachedVariables.extend([ v for v in tableItems[k][1]
+                             if v not in cachedVariables ])
+
+def openCache(path=None):
+    # The directory of the cache, made if necessary.
+    if path is None:
+        path = CACHE_PATH
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+def flagsDigest(uvFile):
+    # A digest of the flags of a dataset.
+    h = hashlib.sha1()
+    with open(os.path.join(uvFile, 'flags'), 'rb') as f:
+        while True:
+            b = f.read(1 << 20)
+            if not b:
+                break
+            h.update(b)
+    return h.hexdigest()
+
+def solutionKey(roles, calSets, refAnt):
+    # The digest of everything the solutions depend on. roles gives the
+    # source used for each part of the calibration, and calSets the
+    # dataset of each of those sources.
+    state = { 'version': CACHE_VERSION, 'roles': roles,
+              'refant': str(refAnt), 'datasets': {} }
+    for c in sorted(calSets):
+        state['datasets'][c] = {
+            'name': os.path.basename(os.path.normpath(calSets[c])),
+            'items': [ list(s) for s in
+                       itemStats(calSets[c], [ 'visdata', 'vartable' ]) ],
+            'flags': flagsDigest(calSets[c]) }
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode(
+        'utf-8')).hexdigest()
+
+def entryPath(cacheDir, key):
+    return os.path.join(cacheDir, key)
+
+def restoreSolutions(cacheDir, key, calSets):
+    # Copy the solutions of an entry back into the calibrator datasets,
+    # and return what was kept with them, or None if there's no entry.
+    path = entryPath(cacheDir, key)
+    try:
+        with open(os.path.join(path, ENTRY_NAME)) as f:
+            info = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    for c in calSets:
+        src = os.path.join(path, c)
+        if not os.path.isdir(src):
+            return None
+    for c in calSets:
+        src = os.path.join(path, c)
+        copyItems(src, calSets[c],
+                  [ i for i in cachedItems
+                    if os.path.isfile(os.path.join(src, i)) ],
+                  cachedVariables)
+        # Tables the entry doesn't have weren't there when it was made.
+        for i in calTables:
+            if (not os.path.isfile(os.path.join(src, i)) and
+                os.path.isfile(os.path.join(calSets[c], i))):
+                os.remove(os.path.join(calSets[c], i))
+    # Touch it, so the entries that are still used are kept longest.
+    os.utime(os.path.join(path, ENTRY_NAME), None)
+    return info
+
+def storeSolutions(cacheDir, key, roles, calSets, refAnt, info):
+    # Keep the solutions now in the calibrator datasets, found by the
+    # key they were made from and by the state they have left the
+    # calibrators in. Returns the second key.
+    from cabb_pipeline_miriadio import headerEntries
+    work = tempfile.mkdtemp(prefix='.store.', dir=cacheDir)
+    try:
+        for c in calSets:
+            dest = os.path.join(work, c)
+            os.mkdir(dest)
+            for i in cachedItems:
+                if os.path.isfile(os.path.join(calSets[c], i)):
+                    shutil.copyfile(os.path.join(calSets[c], i),
+                                    os.path.join(dest, i))
+            os.rename(stageHeader(dest, [ e for e in headerEntries(calSets[c])
+                                          if e[0] in cachedVariables ]),
+                      os.path.join(dest, 'header'))
+        with open(os.path.join(work, ENTRY_NAME), 'w') as f:
+            json.dump({ 'created': time.time(), 'roles': roles,
+                        'refant': str(refAnt), 'info': info }, f)
+        removeEntry(cacheDir, key)
+        os.rename(work, entryPath(cacheDir, key))
+    except OSError:
+        # Another run has just kept the same solutions.
+        shutil.rmtree(work)
+    after = solutionKey(roles, calSets, refAnt)
+    if after != key:
+        removeEntry(cacheDir, after)
+        try:
+            os.symlink(key, entryPath(cacheDir, after))
+        except OSError:
+            pass
+    return after
+
+def removeEntry(cacheDir, key):
+    # Remove an entry, or another key for one.
+    path = entryPath(cacheDir, key)
+    if os.path.islink(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+
+def listEntries(cacheDir):
+    # The entries in the cache, and when they were last used.
+    entries = []
+    for k in sorted(os.listdir(cacheDir)):
+        p = os.path.join(cacheDir, k, ENTRY_NAME)
+        if os.path.islink(entryPath(cacheDir, k)):
+            continue
+        if os.path.isfile(p):
+            with open(p) as f:
+                e = json.load(f)
+            entries.append((k, os.path.getmtime(p), e))
+    return entries
+
+if __name__ == '__main__':
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--cache', metavar='DIR',
+                      help='the solution cache (default: ' +
+                      '~/.cabb_pipeline/solutions)')
+    parser.add_option('--prune', type='float', metavar='DAYS',
+                      help='remove the entries not used in the last DAYS ' +
+                      'days')
+    (options, args) = parser.parse_args()
+
+    cacheDir = openCache(options.cache)
+    entries = listEntries(cacheDir)
+    if options.prune is not None:
+        cutoff = time.time() - options.prune * 86400.0
+        removed = 0
+        for (k, used, e) in entries:
+            if used < cutoff:
+                removeEntry(cacheDir, k)
+                removed += 1
+        # And the other keys of the entries that have gone.
+        for k in os.listdir(cacheDir):
+            if not os.path.exists(entryPath(cacheDir, k)):
+                removeEntry(cacheDir, k)
+        print('Removed', removed, 'of', len(entries), 'entries.')
+        sys.exit(0)
+    for (k, used, e) in entries:
+        print(k[:12], time.strftime('%Y-%m-%d %H:%M:%S',
+                                    time.localtime(used)),
+              ', '.join([ r + '=' + str(e['roles'][r])
+                          for r in sorted(e['roles']) ]),
+              'refant=' + e['refant'])
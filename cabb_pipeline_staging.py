@@ -0,0 +1,211 @@
+from __future__ import print_function
+import os
+import sys
+import zlib
+import shutil
+import tempfile
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+"""
+Staging of the pipeline's working data on node-local scratch space.
+
+Without staging, every intermediate product (the master dataset, the
+split datasets and their flag versions, the reduction directories and
+the MeasurementSets) is made in the run directory, which is usually on
+shared storage, and the Miriad tasks then do lots of small reads and
+writes over the network. With staging, the pipeline works in a
+directory on a local disk (or tmpfs). The RPFITS files are copied there
+before they are loaded, since atlod needs all of them at once, and
+each finished product is copied back to the run directory in the
+background while the next stage carries on. The pipeline is given the
+working directory and makes its products there; its own working
+directory doesn't change. Only the logs, the catalogue and the plots
+are written directly to the run directory.
+
+Every file copied back is checked against the original, and a product
+only appears in the run directory once all of it has been copied and
+checked.
+"""
+
+# How much to copy at once.
+BLOCK_SIZE = 4 * 1024 * 1024
+
+def copyFile(src, dest):
+    # Copy a file and return the CRC of what was read.
+    crc = 0
+    with open(src, 'rb') as fi:
+        with open(dest, 'wb') as fo:
+            while True:
+                b = fi.read(BLOCK_SIZE)
+                if not b:
+                    break
+                crc = zlib.crc32(b, crc)
+                fo.write(b)
+    shutil.copystat(src, dest)
+    return crc & 0xffffffff
+
+def fileCRC(path):
+    # The CRC of a file.
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            b = f.read(BLOCK_SIZE)
+            if not b:
+                break
+            crc = zlib.crc32(b, crc)
+    return crc & 0xffffffff
+
+def copyChecked(src, dest):
+    # Copy a file or directory, checking each file once it is written.
+    # Returns a list of the files that didn't copy correctly.
+    bad = []
+    if os.path.isdir(src):
+        os.mkdir(dest)
+        for f in sorted(os.listdir(src)):
+            bad += copyChecked(os.path.join(src, f), os.path.join(dest, f))
+        shutil.copystat(src, dest)
+        return bad
+    crc = copyFile(src, dest)
+    if (os.path.getsize(dest) != os.path.getsize(src) or
+        fileCRC(dest) != crc):
+        bad.append(src)
+    return bad
+
+def removePath(path):
+    # Remove a file or directory, if it is there.
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+class Stager(object):
+    # A working directory on local scratch space, and the copying of
+    # data to and from the shared run directory.
+    def __init__(self, scratchDir, sharedDir, options):
+        self.options = options
+        self.sharedDir = os.path.abspath(sharedDir)
+        self.workDir = tempfile.mkdtemp(prefix='cabb_pipeline.',
+                                        dir=scratchDir)
+        self.inputDir = os.path.join(self.workDir, 'rpfits')
+        os.mkdir(self.inputDir)
+        self.writeQueue = queue.Queue()
+        self.queued = set()
+        self.written = []
+        self.failed = []
+        self.writer = threading.Thread(target=self.writeLoop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    # Bringing the input files in.
+
+    def stageInputs(self, files):
+        # Copy the input files to scratch, and return where each is to
+        # be read from: the copy, or the original if it didn't copy.
+        rArr = []
+        for f in files:
+            l = os.path.join(self.inputDir, os.path.basename(f))
+            try:
+                if len(copyChecked(f, l)) == 0:
+                    rArr.append(l)
+                    continue
+            except (IOError, OSError) as e:
+                print('Unable to stage', f + ':', e)
+            removePath(l)
+            rArr.append(os.path.abspath(f))
+        return rArr
+
+    # Sending the products back.
+
+    def writeBack(self, name):
+        # Queue a product in the working directory to be copied back to
+        # the run directory.
+        if self.options['verbose']:
+            print('Queueing', name, 'to be written back.')
+        self.queued.add(name)
+        self.writeQueue.put(name)
+
+    def busy(self, name):
+        # Whether a product is still waiting to be written back.
+        return (name in self.queued and name not in self.written and
+                name not in self.failed)
+
+    def saved(self, name):
+        # Whether a product has been written back and checked.
+        return name in self.written
+
+    def writeLoop(self):
+        # Copy products back, one at a time, as they are queued.
+        while True:
+            name = self.writeQueue.get()
+            if name is None:
+                self.writeQueue.task_done()
+                break
+            try:
+                self.copyBack(name)
+            except (IOError, OSError) as e:
+                print('Unable to write back', name + ':', e)
+                self.failed.append(name)
+            self.writeQueue.task_done()
+
+    def copyBack(self, name):
+        # Copy a product to a temporary name in the run directory, check
+        # it, then move it into place.
+        src = os.path.join(self.workDir, name)
+        dest = os.path.join(self.sharedDir, name)
+        partial = os.path.join(self.sharedDir, '.' + name + '.partial')
+        removePath(partial)
+        bad = copyChecked(src, partial)
+        if len(bad) > 0:
+            removePath(partial)
+            print('Write back of', name, 'failed its checks:',
+                  ", ".join(bad))
+            self.failed.append(name)
+            return False
+        old = os.path.join(self.sharedDir, '.' + name + '.old')
+        removePath(old)
+        if os.path.lexists(dest):
+            os.rename(dest, old)
+        os.rename(partial, dest)
+        removePath(old)
+        self.written.append(name)
+        if self.options['verbose']:
+            print('Wrote back', name)
+        return True
+
+    def writeBackRemaining(self, exclude=[]):
+        # Queue everything made in the working directory that hasn't
+        # already been written back, apart from the excluded names.
+        for name in sorted(os.listdir(self.workDir)):
+            if (name in self.queued or name in exclude or
+                os.path.join(self.workDir, name) == self.inputDir):
+                continue
+            self.writeBack(name)
+
+    def finish(self, keep=False):
+        # Wait for all the products to be written back, and clear up the
+        # scratch space unless they all couldn't be.
+        self.writeQueue.put(None)
+        self.writer.join()
+        if len(self.failed) > 0:
+            print('Some products were not written back; they remain in',
+                  self.workDir)
+            return False
+        if not keep:
+            shutil.rmtree(self.workDir, ignore_errors=True)
+        return True
+
+def startStaging(options):
+    # Set up staging if the options ask for it.
+    if options.get('scratch', None) is None:
+        return None
+    if not os.path.isdir(options['scratch']):
+        print('Scratch directory', options['scratch'], 'is not accessible.')
+        sys.exit(0)
+    stager = Stager(options['scratch'], os.getcwd(), options)
+    if not options['quiet']:
+        print('Working in', stager.workDir)
+    return stager
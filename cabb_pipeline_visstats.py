@@ -0,0 +1,352 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import warnings
+import numpy as np
+from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
+from cabb_pipeline_miriadio import (locateRecords, readSpectra, readFlagBlock,
+                                    flagWords)
+
+"""
+Statistics of the visibility amplitudes of a dataset, for quality
+assurance, made by reading it once, a chunk of records at a time.
+
+For each polarisation and channel, and for each baseline and
+polarisation, the unflagged amplitudes are summarised by their number,
+mean, variance, minimum and maximum. Each chunk is summarised on its
+own, so the chunks can be read in parallel, and the summaries are merged
+in the way Chan, Golub and LeVeque give for Welford's running variance,
+which gives the same answer as one pass over all the data. The median
+and the median absolute deviation can't be merged like that, so they are
+estimated with a remedian (Rousseeuw and Bassett 1990) of the medians of
+the chunks, which only ever keeps a few of them at a time.
+
+The statistics are written as compressed arrays next to the dataset,
+in <dataset>.visstats.npz. Run this file directly to make and summarise
+them for some datasets.
+"""
+
+# Roughly how many visibilities each worker reads at once.
+CHUNK_VISIBILITIES = 1 << 22
+
+# The memory (bytes) each visibility of a chunk takes while it is being
+# summarised: the spectrum as read, its amplitudes, the flags, the
+# masked copy and the working copies of the medians.
+BYTES_PER_VISIBILITY = 64
+
+# How many medians each level of a remedian holds.
+REMEDIAN_BASE = 15
+
+STATS_SUFFIX = '.visstats.npz'
+
+# The bytes in each channel of the spectrum, for each type of corr.
+channelBytes = { 'r': 8, 'j': 4 }
+
+# The Miriad polarisation codes.
+polNames = { 1: 'i', 2: 'q', 3: 'u', 4: 'v', -1: 'rr', -2: 'll', -3: 'rl',
+             -4: 'lr', -5: 'xx', -6: 'yy', -7: 'xy', -8: 'yx' }
+
+def emptyMoments(shape):
+    return { 'n': np.zeros(shape, dtype=np.int64),
+             'mean': np.zeros(shape), 'm2': np.zeros(shape),
+             'min': np.full(shape, np.inf), 'max': np.full(shape, -np.inf) }
+
+def mergeMoments(a, b):
+    # Combine the moments of two sets of data.
+    n = a['n'] + b['n']
+    delta = b['mean'] - a['mean']
+    w = b['n'] / np.maximum(n, 1).astype(float)
+    return { 'n': n, 'mean': a['mean'] + delta * w,
+             'm2': a['m2'] + b['m2'] + delta * delta * a['n'] * w,
+             'min': np.minimum(a['min'], b['min']),
+             'max': np.maximum(a['max'], b['max']) }
+
+def groupMoments(x, good, key, ngroups):
+    # The moments of the good values in each group of rows.
+    count = good.sum(axis=1)
+    n = np.bincount(key, weights=count, minlength=ngroups).astype(np.int64)
+    total = np.bincount(key, weights=np.where(good, x, 0).sum(axis=1),
+                        minlength=ngroups)
+    mean = total / np.maximum(n, 1)
+    d = np.where(good, x - mean[key][:, None], 0)
+    m2 = np.bincount(key, weights=(d * d).sum(axis=1), minlength=ngroups)
+    low = np.full(ngroups, np.inf)
+    np.minimum.at(low, key, np.where(good, x, np.inf).min(axis=1))
+    high = np.full(ngroups, -np.inf)
+    np.maximum.at(high, key, np.where(good, x, -np.inf).max(axis=1))
+    return { 'n': n, 'mean': mean, 'm2': m2, 'min': low, 'max': high }
+
+def columnMoments(x, good):
+    # The moments of the good values in each column.
+    n = good.sum(axis=0)
+    mean = np.where(good, x, 0).sum(axis=0) / np.maximum(n, 1)
+    d = np.where(good, x - mean[None, :], 0)
+    return { 'n': n.astype(np.int64), 'mean': mean,
+             'm2': (d * d).sum(axis=0),
+             'min': np.where(good, x, np.inf).min(axis=0),
+             'max': np.where(good, x, -np.inf).max(axis=0) }
+
+def medianAndMAD(values, axis=None):
+    # The median and the median absolute deviation of some values, which
+    # are NaN where the data is bad.
+    median = np.nanmedian(values, axis=axis)
+    if axis is None:
+        return (median, np.nanmedian(np.abs(values - median)))
+    deviation = np.abs(values - np.expand_dims(median, axis))
+    return (median, np.nanmedian(deviation, axis=axis))
+
+class Remedian(object):
+    # A running estimate of the median of a stream of arrays, keeping no
+    # more than REMEDIAN_BASE of them at each of a few levels.
+    def __init__(self, base=REMEDIAN_BASE):
+        self.base = base
+        self.levels = []
+
+    def add(self, v, level=0):
+        while len(self.levels) <= level:
+            self.levels.append([])
+        self.levels[level].append(v)
+        if len(self.levels[level]) == self.base:
+            m = np.nanmedian(np.array(self.levels[level]), axis=0)
+            self.levels[level] = []
+            self.add(m, level + 1)
+
+    def estimate(self):
+        # The median of what is left, each weighted by how many of the
+        # original arrays it stands for.
+        values = []
+        weights = []
+        for l in range(0, len(self.levels)):
+            values.extend(self.levels[l])
+            weights.extend([ float(self.base ** l) ] * len(self.levels[l]))
+        if len(values) == 0:
+            return None
+        v = np.array(values)
+        w = np.broadcast_to(np.array(weights).reshape(
+            (-1,) + (1,) * (v.ndim - 1)), v.shape)
+        order = np.argsort(v, axis=0)
+        v = np.take_along_axis(v, order, axis=0)
+        w = np.where(np.isnan(v), 0.0, np.take_along_axis(w, order, axis=0))
+        c = np.cumsum(w, axis=0)
+        i = np.argmax(c >= c[-1] / 2.0, axis=0)
+        m = np.take_along_axis(v, np.expand_dims(i, 0), axis=0)[0]
+        return np.where(c[-1] > 0, m, np.nan)
+
+def chunkStats(uvFile, where, first, n, words):
+    # Summarise the amplitudes of n records, starting at the first.
+    (offsets, length, dtype, scale, bIndex, pIndex, nbase, npol,
+     nchan) = where
+    amp = np.abs(readSpectra(uvFile, offsets[first:(first + n)], length,
+                             dtype, None if scale is None
+                             else scale[first:(first + n)])).astype(float)
+    if words is None:
+        good = np.ones(amp.shape, dtype=bool)
+    else:
+        good = readFlagBlock(uvFile, nchan, first, n, words)
+    b = bIndex[first:(first + n)]
+    p = pIndex[first:(first + n)]
+    masked = np.where(good, amp, np.nan)
+    stats = { 'channel': emptyMoments((npol, nchan)),
+              'channelMedian': np.full((npol, nchan), np.nan),
+              'channelMAD': np.full((npol, nchan), np.nan),
+              'baseline': groupMoments(amp, good, b * npol + p,
+                                       nbase * npol),
+              'baselineMedian': np.full(nbase * npol, np.nan),
+              'baselineMAD': np.full(nbase * npol, np.nan) }
+    for i in np.unique(p):
+        rows = p == i
+        m = columnMoments(amp[rows], good[rows])
+        for k in m:
+            stats['channel'][k][i] = m[k]
+        (stats['channelMedian'][i],
+         stats['channelMAD'][i]) = medianAndMAD(masked[rows], axis=0)
+    for g in np.unique(b * npol + p):
+        (stats['baselineMedian'][g],
+         stats['baselineMAD'][g]) = medianAndMAD(masked[(b * npol + p) == g])
+    return stats
+
+def finalMoments(m, prefix):
+    # Turn merged moments into the arrays that are kept.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(m['m2'] / (m['n'] - 1))
+    bad = m['n'] == 0
+    return { prefix + 'N': m['n'],
+             prefix + 'Mean': np.where(bad, np.nan, m['mean']).astype(
+                 np.float32),
+             prefix + 'Std': np.where(m['n'] < 2, np.nan, std).astype(
+                 np.float32),
+             prefix + 'Min': np.where(bad, np.nan, m['min']).astype(
+                 np.float32),
+             prefix + 'Max': np.where(bad, np.nan, m['max']).astype(
+                 np.float32) }
+
+def chunkPlan(memory, workers, chunk=CHUNK_VISIBILITIES):
+    # The number of workers and the chunk size that keep the chunks
+    # being summarised at once within some memory (bytes).
+    workers = max(1, min(workers,
+                         memory // (chunk * BYTES_PER_VISIBILITY)))
+    if workers * chunk * BYTES_PER_VISIBILITY > memory:
+        # Even one chunk is too big.
+        chunk = max(1, memory // BYTES_PER_VISIBILITY)
+    return (workers, chunk)
+
+def visibilityStats(uvFile, workers=1, chunk=CHUNK_VISIBILITIES):
+    # Read a dataset once and summarise its unflagged amplitudes. Returns
+    # a dictionary of arrays, or None if the dataset has no spectra.
+    (rec, offsets, lengths, dtype) = locateRecords(uvFile)
+    if dtype not in channelBytes or len(offsets) == 0:
+        return None
+    if np.any(lengths != lengths[0]):
+        raise IOError('The spectra of ' + uvFile + ' change length')
+    nrec = len(offsets)
+    nchan = int(lengths[0]) // channelBytes[dtype]
+    (baselines, bIndex) = np.unique(rec['baseline'], return_inverse=True)
+    (pols, pIndex) = np.unique(rec['pol'], return_inverse=True)
+    where = (offsets, int(lengths[0]), dtype,
+             rec['tscale'] if dtype == 'j' else None,
+             bIndex.ravel(), pIndex.ravel(), len(baselines), len(pols), nchan)
+    words = None
+    if os.path.isfile(os.path.join(uvFile, 'flags')):
+        words = flagWords(uvFile)
+
+    block = max(1, chunk // nchan)
+    channel = emptyMoments((len(pols), nchan))
+    baseline = emptyMoments(len(baselines) * len(pols))
+    robust = dict([ (k, Remedian()) for k in
+                    [ 'channelMedian', 'channelMAD', 'baselineMedian',
+                      'baselineMAD' ] ])
+    pool = ThreadPool(max(1, workers))
+    try:
+        with warnings.catch_warnings():
+            # Chunks where something is all flagged have no medians.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for s in pool.imap(lambda first: chunkStats(
+                    uvFile, where, first, min(block, nrec - first), words),
+                               range(0, nrec, block)):
+                channel = mergeMoments(channel, s['channel'])
+                baseline = mergeMoments(baseline, s['baseline'])
+                for k in robust:
+                    robust[k].add(s[k])
+            stats = { 'records': np.array(nrec), 'channels': np.array(nchan),
+                      'baselines': baselines.astype(np.int32),
+                      'pols': pols.astype(np.int32) }
+            stats.update(finalMoments(channel, 'channel'))
+            b = finalMoments(baseline, 'baseline')
+            for k in b:
+                stats[k] = b[k].reshape(len(baselines), len(pols))
+            for k in robust:
+                e = robust[k].estimate().astype(np.float32)
+                if k.startswith('baseline'):
+                    e = e.reshape(len(baselines), len(pols))
+                stats[k] = e
+    finally:
+        pool.close()
+        pool.join()
+    return stats
+
+def statsPath(uvFile):
+    return os.path.normpath(uvFile) + STATS_SUFFIX
+
+def writeStats(uvFile, stats):
+    # Keep the statistics next to the dataset, and return where.
+    path = statsPath(uvFile)
+    tmpPath = path + '.tmp.npz'
+    np.savez_compressed(tmpPath, **stats)
+    os.rename(tmpPath, path)
+    return path
+
+def readStats(uvFile):
+    # The statistics kept for a dataset, or None.
+    return readStatsFile(statsPath(uvFile))
+
+def readStatsFile(path):
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as f:
+        return dict([ (k, f[k]) for k in f.files ])
+
+def statsSummary(stats):
+    # A short description of the statistics, for the progress dictionary
+    # and the logs.
+    summary = { 'records': int(stats['records']),
+                'channels': int(stats['channels']),
+                'baselines': len(stats['baselines']), 'pols': {} }
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for i in range(0, len(stats['pols'])):
+            name = polNames.get(int(stats['pols'][i]), str(stats['pols'][i]))
+            summary['pols'][name] = {
+                'mean': float(np.nanmedian(stats['channelMean'][i])),
+                'std': float(np.nanmedian(stats['channelStd'][i])),
+                'median': float(np.nanmedian(stats['channelMedian'][i])) }
+    return summary
+
+def checkStats(uvFile, stats):
+    # Compare the merged moments with those of all the data at once,
+    # returning the largest relative difference.
+    (rec, offsets, lengths, dtype) = locateRecords(uvFile)
+    amp = np.abs(readSpectra(uvFile, offsets, int(lengths[0]), dtype,
+                             rec['tscale'] if dtype == 'j' else None))
+    amp = amp.astype(float)
+    nchan = amp.shape[1]
+    if os.path.isfile(os.path.join(uvFile, 'flags')):
+        good = readFlagBlock(uvFile, nchan, 0, len(offsets))
+    else:
+        good = np.ones(amp.shape, dtype=bool)
+    worst = 0.0
+    for i in range(0, len(stats['pols'])):
+        rows = rec['pol'] == stats['pols'][i]
+        masked = np.where(good[rows], amp[rows], np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            direct = [ np.nanmean(masked, axis=0),
+                       np.nanstd(masked, axis=0, ddof=1),
+                       np.nanmin(masked, axis=0), np.nanmax(masked, axis=0) ]
+        for (d, k) in zip(direct, [ 'channelMean', 'channelStd',
+                                    'channelMin', 'channelMax' ]):
+            ok = np.isfinite(d)
+            diff = (np.abs(d[ok] - stats[k][i][ok]) /
+                    np.maximum(np.abs(d[ok]), 1e-30))
+            if len(diff) > 0:
+                worst = max(worst, float(diff.max()))
+    return worst
+
+if __name__ == '__main__':
+    usage = "usage: %prog [options] dataset [dataset ...]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--workers', type='int', default=os.cpu_count() or 1,
+                      help='the number of chunks to read at once ' +
+                      '(default: the number of CPUs)')
+    parser.add_option('--chunk', type='int', default=CHUNK_VISIBILITIES,
+                      help='roughly how many visibilities to read in each ' +
+                      'chunk (default: ' + str(CHUNK_VISIBILITIES) + ')')
+    parser.add_option('--check', action='store_true',
+                      help='also compare the merged moments with those of ' +
+                      'all the data read at once')
+    (options, args) = parser.parse_args()
+    if len(args) == 0:
+        parser.print_help()
+        sys.exit(1)
+    for uvFile in args:
+        if not os.path.isfile(os.path.join(uvFile, 'visdata')):
+            print('Dataset', uvFile, 'is not accessible.')
+            continue
+        start = time.time()
+        stats = visibilityStats(uvFile, options.workers, options.chunk)
+        if stats is None:
+            print('Dataset', uvFile, 'has no spectra.')
+            continue
+        path = writeStats(uvFile, stats)
+        s = statsSummary(stats)
+        print('%s: %d records of %d channels in %.1f s, written to %s' %
+              (uvFile, s['records'], s['channels'], time.time() - start,
+               path))
+        for p in sorted(s['pols']):
+            print(' %-3s mean %.4g, std %.4g, median %.4g' %
+                  (p, s['pols'][p]['mean'], s['pols'][p]['std'],
+                   s['pols'][p]['median']))
+        if options.check:
+            print(' Largest difference from one pass: %.2g' %
+                  checkStats(uvFile, stats))
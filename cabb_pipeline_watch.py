@@ -0,0 +1,275 @@
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import time
+from cabb_pipeline_main_modules import *
+from cabb_pipeline_rfi_calculator import USER_rfi_calculator
+from cabb_pipeline_costmodel import setStage, saveHistory
+from cabb_pipeline_logs import LogSink, appendText
+
+"""
+Watch mode for the CABB pipeline. While an observation is running, new
+RPFITS files appear in the data directory every few hours. Rather than
+waiting until the end and reducing everything at once, we load each new
+file as it closes into its own chunk directory, and flag it and gather
+its statistics there. Only the new time range is ever processed; the
+statistics of all the chunks are then combined so the per-dataset state
+and logs always describe the observation so far.
+
+The state is kept in watch.state.json, so watching can be stopped and
+restarted at any time.
+
+Each chunk is indexed on its own, so the frequency configurations it
+numbers 1, 2 and so on need not be the ones the other chunks number
+the same way. The watch keys each configuration by its IF table (the
+centre frequency and bandwidth of each IF) instead, and renames the
+configurations of each chunk to those keys before merging it.
+"""
+
+# The names the correlator gives to RPFITS files.
+rpfitsPattern = re.compile(r'^\d\d\d\d-\d\d-\d\d_\d\d\d\d\..+$')
+stateFile = 'watch.state.json'
+
+def readWatchState():
+    # Read the state of a previous watch, or start a new one.
+    if os.path.isfile(stateFile):
+        with open(stateFile) as f:
+            state = json.load(f)
+        state.setdefault('freqConfigs', {})
+        return state
+    return { 'files': [], 'chunks': [], 'datasets': {}, 'sources': {},
+             'freqConfigs': {}, 'pending': {} }
+
+def writeWatchState(state):
+    # Write the state so that it is never left half-written.
+    with open(stateFile + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(stateFile + '.tmp', stateFile)
+
+def findClosedFiles(watchDir, state, options):
+    # Return the RPFITS files that have appeared since we last looked
+    # and have stopped growing.
+    candidates = sorted([ f for f in os.listdir(watchDir)
+                          if rpfitsPattern.match(f) is not None ])
+    closed = []
+    now = time.time()
+    for n in range(0, len(candidates)):
+        f = os.path.abspath(os.path.join(watchDir, candidates[n]))
+        if f in state['files']:
+            continue
+        st = os.stat(f)
+        last = state['pending'].get(f, None)
+        state['pending'][f] = [ st.st_size, st.st_mtime ]
+        # A file is finished once a later one has been started, or when
+        # it has not changed for the settle time. A single pass takes
+        # everything, as the observation must be over.
+        if (options['watch_once'] or n < len(candidates) - 1 or
+            (last is not None and last[0] == st.st_size and
+             (now - st.st_mtime) > options['watch_settle'])):
+            closed.append(f)
+    return closed
+
+def combineStats(chunks, key):
+    # Combine the flagging fractions of all the chunks of a dataset,
+    # weighting each chunk by the amount of data in it.
+    rDict = {}
+    totWeight = {}
+    for c in chunks:
+        if key not in c:
+            continue
+        for mode in c[key]:
+            if mode not in rDict:
+                rDict[mode] = {}
+                totWeight[mode] = {}
+            for k in c[key][mode]:
+                if k not in rDict[mode]:
+                    rDict[mode][k] = 0.0
+                    totWeight[mode][k] = 0.0
+                rDict[mode][k] += c[key][mode][k] * c['weight']
+                totWeight[mode][k] += c['weight']
+    for mode in rDict:
+        for k in rDict[mode]:
+            if totWeight[mode][k] > 0:
+                rDict[mode][k] /= totWeight[mode][k]
+    return rDict
+
+def appendLog(name, text):
+    # Add some text to a log, without holding it open.
+    appendText(os.getcwd(), name, text)
+
+def reduceChunk(rpfitsFile, chunkNumber, options):
+    # Load, flag and check a single new RPFITS file in its own directory.
+    chunkDir = os.path.abspath('watch.' + str(chunkNumber))
+    if not os.path.isdir(chunkDir):
+        try:
+            os.mkdir(chunkDir)
+        except:
+            print('Cannot make chunk directory', chunkDir)
+            sys.exit(0)
+    chunkOptions = dict(options)
+    chunkOptions['no_atlod'] = False
+    chunkOptions['no_split'] = False
+    chunkDict = None
+    setStage('load')
+    if options['parallel_load']:
+        chunkDict = cabbParallelLoad([ rpfitsFile ], chunkOptions, chunkDir)
+    if chunkDict is None:
+        chunkDict = cabbLoad([ rpfitsFile ], chunkOptions, chunkDir)
+        chunkDict['datasets'] = splitIFs(
+            os.path.join(chunkDir, chunkDict['miriadData']),
+            chunkDict['freqConfigs'], chunkOptions)
+    chunkDict['chunkDir'] = chunkDir
+    chunkDict['results'] = {}
+    setStage('loadstats')
+    for p in chunkDict['datasets']:
+        r = { 'path': os.path.join(chunkDir, p),
+              'weight': os.path.getsize(os.path.join(chunkDir, p,
+                                                     'visdata')),
+              'midweek': [] }
+        r['loadFlagStats'] = flagStats(r['path'], chunkOptions)
+        keepMiriadFlagTable(r['path'], 'original', chunkOptions)
+        chunkDict['results'][p] = r
+
+    # Midweek RFI, only within the time range of this chunk.
+    setStage('midweek')
+    for p in chunkDict['datasets']:
+        t = getIF(chunkDict, p)
+        if (options['no_midweek'] or t is None or
+            t['classification']['bandType'] != 'wide' or
+            frequencyBand(t['centerFreq']) != '16cm'):
+            continue
+        mw = midweekDetector(os.path.join(chunkDir, p), chunkOptions)
+        if midweekFlagger(os.path.join(chunkDir, p), mw['flagRegions'],
+                          chunkOptions):
+            d = chainDatasets(chunkDict, t['freqConfig'], t['ifChain'])
+            for i in range(0, len(d)):
+                dPath = os.path.join(chunkDir, d[i])
+                if d[i] != p:
+                    midweekFlagger(dPath, mw['flagRegions'], chunkOptions)
+                keepMiriadFlagTable(dPath, 'midweek', chunkOptions)
+                chunkDict['results'][d[i]]['midweek'] = mw['flagRegions']
+
+    # Automatic flagging of the wide bands.
+    setStage('autoflag')
+    for p in chunkDict['datasets']:
+        t = getIF(chunkDict, p)
+        r = chunkDict['results'][p]
+        if (not options['no_flag'] and t is not None and
+            t['classification']['bandType'] == 'wide'):
+            autoPgflag(r['path'], chunkOptions)
+            keepMiriadFlagTable(r['path'], 'auto', chunkOptions)
+        r['autoFlagStats'] = flagStats(r['path'], chunkOptions)
+    return chunkDict
+
+def freqConfigKey(fc):
+    # A name for a frequency configuration that doesn't depend on the
+    # file it was found in: the centre frequency and bandwidth of each
+    # of its IFs.
+    return ','.join([ '%.6f:%.6f' % (fc['centreFreq'][i],
+                                     abs(fc['channels'][i] *
+                                         fc['chanWidth'][i]))
+                      for i in range(0, len(fc['centreFreq'])) ])
+
+def mergeSources(state, chunkDict):
+    # Add the frequency configurations and sources of a new chunk to
+    # those seen so far, with the configurations keyed by their IFs.
+    keys = {}
+    for c in chunkDict['freqConfigs']:
+        fc = chunkDict['freqConfigs'][c]
+        keys[c] = freqConfigKey(fc)
+        if keys[c] not in state['freqConfigs']:
+            state['freqConfigs'][keys[c]] = fc
+            continue
+        # The datasets of a configuration are named by their frequency,
+        # so only ones that weren't in earlier chunks need adding.
+        known = state['freqConfigs'][keys[c]]['dataset']
+        for i in range(0, len(known)):
+            if known[i] == '' and i < len(fc['dataset']):
+                known[i] = fc['dataset'][i]
+    for s in chunkDict['sources']:
+        cs = dict(chunkDict['sources'][s])
+        cs['freqConfig'] = [ keys.get(c, c) for c in cs['freqConfig'] ]
+        if s not in state['sources']:
+            state['sources'][s] = cs
+            continue
+        for k in [ 'freqConfig', 'startTime', 'calCode' ]:
+            state['sources'][s][k] += cs[k]
+
+def quickLook(state, options):
+    # Run the RFI calculator and choose calibrators for the observation
+    # so far, across all the frequency configurations seen.
+    progressDict = { 'datasets': [ p for p in sorted(state['datasets'])
+                                   if getIF(state, p) is not None ],
+                     'freqConfigs': state['freqConfigs'],
+                     'sources': state['sources'],
+                     'loadFlagStats': {}, 'autoFlagStats': {}, 'logs': [] }
+    logSink = LogSink(os.getcwd())
+    for p in progressDict['datasets']:
+        chunks = state['datasets'][p]['chunks']
+        progressDict['loadFlagStats'][p] = combineStats(chunks,
+                                                        'loadFlagStats')
+        progressDict['autoFlagStats'][p] = combineStats(chunks,
+                                                        'autoFlagStats')
+        progressDict['logs'].append(logSink.stream(p))
+    try:
+        if not options['no_user']:
+            USER_rfi_calculator(progressDict, options)
+        for c in progressDict['freqConfigs']:
+            cals = determineCalibrators(progressDict, c, options)
+            appendLog('watch',
+                      'Calibration sources so far for frequency config ' +
+                      c + ':\n' +
+                      'Bandpass: ' + str(cals['bandpass']) + '\n' +
+                      'Flux Density: ' + str(cals['flux']) + '\n' +
+                      'Leakages: ' + str(cals['leakages']) + '\n' +
+                      'Gain: ' + ", ".join(cals['gain']) + '\n')
+    finally:
+        logSink.close()
+
+def watchDirectory(watchDir, options):
+    # Reduce RPFITS files incrementally as they appear in a directory.
+    if not os.path.isdir(watchDir):
+        print('Directory', watchDir, 'is not accessible.')
+        sys.exit(0)
+    if not options['quiet']:
+        print('Watching', watchDir, 'for new RPFITS files.')
+    state = readWatchState()
+    while True:
+        for f in findClosedFiles(watchDir, state, options):
+            if not options['quiet']:
+                print('New RPFITS file', f)
+            chunkNumber = len(state['chunks']) + 1
+            chunkDict = reduceChunk(f, chunkNumber, options)
+            state['files'].append(f)
+            state['pending'].pop(f, None)
+            state['chunks'].append({ 'file': f,
+                                     'directory': chunkDict['chunkDir'],
+                                     'datasets': chunkDict['datasets'] })
+            mergeSources(state, chunkDict)
+            appendLog('watch', 'Chunk ' + str(chunkNumber) + ': ' + f + '\n')
+            for p in chunkDict['datasets']:
+                r = chunkDict['results'][p]
+                r['chunk'] = chunkNumber
+                if p not in state['datasets']:
+                    state['datasets'][p] = { 'chunks': [] }
+                state['datasets'][p]['chunks'].append(r)
+                text = ('Chunk ' + str(chunkNumber) + ' (' + f + ') ' +
+                        'loaded into ' + r['path'] + '\n')
+                if len(r['midweek']) > 0:
+                    text += ('Detected and flagged midweek RFI in the ' +
+                             'time ranges:\n')
+                    for m in r['midweek']:
+                        text += m['start'] + ' - ' + m['stop'] + '\n'
+                appendLog(p, text)
+            quickLook(state, options)
+            writeWatchState(state)
+            saveHistory()
+        if options['watch_once']:
+            break
+        writeWatchState(state)
+        time.sleep(options['watch_interval'])
+    if not options['quiet']:
+        print('Watch complete.')
+    return state